@@ -2,8 +2,19 @@
 import os
 import sys
 
+# Commands that only need the omrs app, which start with the minimal settings in
+# omrs/settings_cli.py unless other settings are given
+CLI_COMMANDS = ('extract_db', 'extract_db_sources', 'validate_export', 'sync_bahmni_db',
+                'snapshot_db', 'ensure_indexes', 'benchmark', 'serve_exports')
+
 if __name__ == "__main__":
-    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "omrs.settings")
+    from omrs import startup
+    startup.mark_start()
+
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "omrs.settings_cli")
+    else:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "omrs.settings")
 
     from django.core.management import execute_from_command_line
 
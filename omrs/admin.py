@@ -0,0 +1,211 @@
+"""
+Admin registrations for the concept dictionary models, tuned for large dictionaries (e.g.
+50,000 concepts and 500,000 names) so that curators can spot-check a sync:
+
+- Foreign keys shown in the change lists are loaded with list_select_related, and concept
+  display names are loaded in bulk, so that a page takes a fixed number of queries.
+- Unfiltered change lists use the database's estimate of the table row count instead of a
+  full COUNT(*), and filtered or searched change lists count at most MAX_EXACT_COUNT rows.
+- Searches use prefix matches ("name starts with"), which use the name and code indexes,
+  exact uuid matches, and concept IDs when the search term is a number.
+- Concept foreign keys are edited as raw IDs instead of selects of every concept.
+"""
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import InvalidPage, Paginator
+from django.db import connections
+from omrs.models import (Concept, ConceptAnswer, ConceptName, ConceptReferenceMap, ConceptSet,
+                         load_display_names)
+from omrs.schema import get_table_row_estimate
+
+
+# Tables with fewer rows than this (by estimate) are counted exactly
+ESTIMATED_COUNT_THRESHOLD = 20000
+
+# Maximum number of rows counted for a filtered or searched change list
+MAX_EXACT_COUNT = 10000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that does not count every row of a large table. An unfiltered queryset is counted
+    with the table row estimate of the database, and a filtered queryset is counted up to
+    MAX_EXACT_COUNT rows, so the last pages of a large result may not be reachable.
+    """
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = get_estimated_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+
+class EstimatedCountChangeList(ChangeList):
+    """ Change list that counts its rows with EstimatedCountPaginator """
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        result_count = paginator.count
+
+        # The total number of rows is estimated too, instead of ChangeList's full COUNT(*)
+        if self.get_filters_params() or self.query:
+            full_result_count = get_estimated_count(self.root_queryset)
+        else:
+            full_result_count = result_count
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.queryset._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        # Display names of the concepts referenced by the rows are loaded in bulk
+        if self.model_admin.display_name_fields:
+            result_list = list(result_list)
+            load_display_names([getattr(row, field) for row in result_list
+                                for field in self.model_admin.display_name_fields])
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+
+class DictionaryAdmin(admin.ModelAdmin):
+    """ Base admin for the dictionary models, with estimated counts and concept ID search """
+
+    paginator = EstimatedCountPaginator
+    list_per_page = 50
+    list_max_show_all = 200
+
+    # Concept fields searched by ID when the search term is a number
+    concept_id_search_fields = ()
+
+    # Fields that start with the whole search term, as one prefix rather than word by word
+    prefix_search_fields = ()
+
+    # Concept foreign keys whose display names are loaded in bulk for each page
+    display_name_fields = ()
+
+    def get_changelist(self, request, **kwargs):
+        return EstimatedCountChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if search_term.isdigit() and self.concept_id_search_fields:
+            query = None
+            for field in self.concept_id_search_fields:
+                condition = queryset.filter(**{field: int(search_term)})
+                query = condition if query is None else query | condition
+            return query, False
+        results, use_distinct = super(DictionaryAdmin, self).get_search_results(request, queryset, search_term)
+        if search_term:
+            for field in self.prefix_search_fields:
+                results |= queryset.filter(**{'%s__startswith' % field: search_term})
+        return results, use_distinct
+
+
+class ConceptAdmin(DictionaryAdmin):
+    list_display = ('concept_id', 'display_name', 'concept_class', 'datatype', 'is_set',
+                    'retired', 'uuid')
+    list_select_related = ('concept_class', 'datatype')
+    list_filter = ('concept_class', 'datatype', 'retired')
+    search_fields = ('=uuid',)
+    concept_id_search_fields = ('concept_id',)
+
+    def get_queryset(self, request):
+        return super(ConceptAdmin, self).get_queryset(request).with_display_names()
+
+    def get_search_results(self, request, queryset, search_term):
+        # Names are searched with a subquery on the name index, which does not join (and
+        # duplicate) the concept rows like a search on conceptname__name would
+        results, use_distinct = super(ConceptAdmin, self).get_search_results(request, queryset, search_term)
+        search_term = search_term.strip()
+        if search_term and not search_term.isdigit():
+            results |= queryset.filter(concept_id__in=ConceptName.objects.filter(
+                name__startswith=search_term).values('concept'))
+        return results, use_distinct
+
+
+class ConceptNameAdmin(DictionaryAdmin):
+    list_display = ('name', 'concept_number', 'locale', 'concept_name_type', 'locale_preferred',
+                    'voided', 'uuid')
+    list_filter = ('locale', 'concept_name_type', 'voided')
+    search_fields = ('=uuid',)
+    prefix_search_fields = ('name',)
+    raw_id_fields = ('concept',)
+    concept_id_search_fields = ('concept',)
+
+    def concept_number(self, name):
+        return name.concept_id
+    concept_number.short_description = 'Concept ID'
+    concept_number.admin_order_field = 'concept'
+
+
+class ConceptReferenceMapAdmin(DictionaryAdmin):
+    list_display = ('concept_map_id', 'concept_number', 'source', 'concept_reference_term',
+                    'map_type', 'uuid')
+    list_select_related = ('concept_reference_term__concept_source', 'map_type')
+    list_filter = ('map_type',)
+    search_fields = ('=uuid',)
+    prefix_search_fields = ('concept_reference_term__code',)
+    raw_id_fields = ('concept', 'concept_reference_term')
+    concept_id_search_fields = ('concept',)
+
+    def concept_number(self, mapping):
+        return mapping.concept_id
+    concept_number.short_description = 'Concept ID'
+    concept_number.admin_order_field = 'concept'
+
+    def source(self, mapping):
+        return mapping.concept_reference_term.concept_source.name
+    source.admin_order_field = 'concept_reference_term__concept_source__name'
+
+
+class ConceptAnswerAdmin(DictionaryAdmin):
+    list_display = ('concept_answer_id', 'question_concept', 'answer_concept', 'sort_weight', 'uuid')
+    list_select_related = ('question_concept', 'answer_concept')
+    search_fields = ('=uuid',)
+    raw_id_fields = ('question_concept', 'answer_concept')
+    concept_id_search_fields = ('question_concept', 'answer_concept')
+    display_name_fields = ('question_concept', 'answer_concept')
+
+
+class ConceptSetAdmin(DictionaryAdmin):
+    list_display = ('concept_set_id', 'concept_set_owner', 'concept', 'sort_weight', 'uuid')
+    list_select_related = ('concept_set_owner', 'concept')
+    search_fields = ('=uuid',)
+    raw_id_fields = ('concept_set_owner', 'concept')
+    concept_id_search_fields = ('concept_set_owner', 'concept')
+    display_name_fields = ('concept_set_owner', 'concept')
+
+
+admin.site.register(Concept, ConceptAdmin)
+admin.site.register(ConceptName, ConceptNameAdmin)
+admin.site.register(ConceptReferenceMap, ConceptReferenceMapAdmin)
+admin.site.register(ConceptAnswer, ConceptAnswerAdmin)
+admin.site.register(ConceptSet, ConceptSetAdmin)
+
+
+
+## HELPER METHODS
+
+def get_estimated_count(queryset):
+    """
+    Utility function: Returns the number of rows of a queryset without a full COUNT(*) of a
+    large table. An unfiltered queryset of a table with at least ESTIMATED_COUNT_THRESHOLD rows
+    returns the database's row estimate, and a filtered queryset is counted up to MAX_EXACT_COUNT.
+    """
+    if queryset.query.where:
+        return queryset.order_by()[:MAX_EXACT_COUNT].count()
+    estimate = get_table_row_estimate(connections[queryset.db], queryset.model._meta.db_table)
+    if estimate is not None and estimate >= ESTIMATED_COUNT_THRESHOLD:
+        return estimate
+    return queryset.count()
@@ -0,0 +1,56 @@
+"""
+In-process LRU cache with size-based eviction, used by the concept lookup views.
+"""
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    """
+    Least recently used cache of string values, limited by the total size of the values in
+    bytes rather than by the number of entries. Safe to share between request threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version=None):
+        """
+        Returns the cached value for the key, or None if it is not cached or was cached for a
+        different version (e.g. an older date_changed of the cached record).
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    self.num_bytes -= len(entry[1])
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, version=None):
+        """ Caches a value for the key, evicting the least recently used values if needed """
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.num_bytes -= len(entry[1])
+            self.entries[key] = (version, value)
+            self.num_bytes += len(value)
+            while self.num_bytes > self.max_bytes:
+                evicted_key, evicted_entry = self.entries.popitem(last=False)
+                self.num_bytes -= len(evicted_entry[1])
+
+    def clear(self):
+        """ Removes all cached values """
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
@@ -0,0 +1,84 @@
+"""
+On-demand JSON lines exports, with the same output as "extract_db --raw".
+
+get_export_command() configures an extract_db command for a concept, mapping or retired
+concept ID export, and iterate_export_lines() runs its export generator and yields the JSON
+lines of one concept at a time, so that the export can be streamed to a client as it is built.
+
+get_dictionary_stamp() returns a stamp of the whole concept dictionary, built from the row
+count and latest created/changed/retired/voided date of each dictionary table. It changes
+whenever a dictionary row is added, changed, retired or deleted, so it is used as the basis of
+the ETag of the exports.
+"""
+import hashlib
+import json
+import time
+from django.db.models import Count, Max
+from omrs.management.commands.extract_db import Command as ExtractDbCommand
+from omrs.models import DICTIONARY_MODELS
+from omrs.profiling import Profiler
+
+
+# Export types and the extract_db option that selects each of them
+EXPORT_TYPES = {
+    'concepts': 'concept',
+    'mappings': 'mapping',
+    'retired': 'retire_sw',
+}
+
+# Date fields whose latest value is part of the dictionary stamp
+STAMP_DATE_FIELDS = ('date_created', 'date_changed', 'date_retired', 'date_voided')
+
+# Number of seconds a dictionary stamp is reused before it is computed again
+STAMP_CACHE_SECONDS = 10
+
+# Last dictionary stamp and the time it was computed
+stamp_cache = {}
+
+
+def get_export_command(export_type, org_id=None, source_id=None, since=None, engine='sql'):
+    """
+    Returns an extract_db command configured for an export, ready for iterate_export_lines().
+    Raises a CommandError if the options are invalid.
+
+    :param export_type: 'concepts', 'mappings' or 'retired'.
+    :param since: Optional date or date and time, as accepted by the extract_db 'since' option.
+    :param engine: extract_db export engine; the raw SQL engine is used by default.
+    """
+    options = dict((option.dest, option.default) for option in ExtractDbCommand.option_list)
+    options.update(verbosity=0, raw=True, org_id=org_id, source_id=source_id, since=since,
+                   engine=engine)
+    options[EXPORT_TYPES[export_type]] = True
+    command = ExtractDbCommand()
+    command.configure(options)
+    command.validate_options()
+    command.init_counters()
+    command.profiler = Profiler('extract_db', enabled=False)
+    return command
+
+
+def iterate_export_lines(command):
+    """Utility function: Yields the JSON lines of an export, one string per concept"""
+    for concept_id, export_records in command.iterate_export_records():
+        if export_records:
+            yield ''.join(json.dumps(export_data) + '\n' for export_data in export_records)
+
+
+def get_dictionary_stamp():
+    """
+    Utility function: Returns a hash of the row count and latest dates of every dictionary
+    table, with one aggregate query per table. The stamp is reused for STAMP_CACHE_SECONDS.
+    """
+    now = time.time()
+    if stamp_cache and now - stamp_cache['time'] < STAMP_CACHE_SECONDS:
+        return stamp_cache['stamp']
+    table_stamps = []
+    for model in DICTIONARY_MODELS:
+        aggregates = dict((field.name, Max(field.name)) for field in model._meta.fields
+                          if field.name in STAMP_DATE_FIELDS)
+        aggregates['count'] = Count(model._meta.pk.name)
+        values = model.objects.aggregate(**aggregates)
+        table_stamps.append((model._meta.db_table, sorted((name, unicode(value))
+                                                          for name, value in values.items())))
+    stamp_cache.update(stamp=hashlib.sha1(repr(table_stamps)).hexdigest(), time=now)
+    return stamp_cache['stamp']
@@ -0,0 +1,172 @@
+"""
+Export, validation and plan jobs run by the worker processes of the serve_exports command.
+
+Each job is a dictionary decoded from a JSON request, with a "type" and an "output" file:
+
+    {"type": "export", "export": "concepts", "org": "CIEL", "source": "CIEL", "since": "2016-07-01", "output": "/data/c.json"}
+    {"type": "validate", "export": "/data/export.json", "ignore_retired_mappings": false, "output": "/data/report.txt"}
+    {"type": "plan", "concept_file": "/data/c.json", "mapping_file": "/data/m.json", "output": "/data/plan.json"}
+
+"export" jobs write the same JSON lines as "extract_db --raw" (see omrs/exports.py),
+"validate" jobs write the report of validate_export, and "plan" jobs write the change set of
+"sync_bahmni_db --plan" (the "concept_file" and "mapping_file" fields are required, the
+"source_file" and "class_file" fields are optional).
+
+A worker process keeps its database connection open between jobs, and keeps the dictionary
+index that plans are matched against (names, classes, datatypes, map types, sources and
+reference terms) loaded. The index is only loaded again when the dictionary stamp changes, and
+each plan works on a copy of it, since planning adds the planned rows to the index.
+"""
+import copy
+import signal
+import sys
+import time
+from django.core.management import CommandError
+from django.db import DatabaseError
+from omrs.exports import EXPORT_TYPES, get_dictionary_stamp, get_export_command, iterate_export_lines, stamp_cache
+from omrs.management.commands import close_connections
+from omrs.management.commands.sync_bahmni_db import Command as SyncCommand
+from omrs.management.commands.validate_export import Command as ValidateCommand
+from omrs.profiling import Profiler
+from omrs.routers import route_reads_to_primary, route_reads_to_replica
+from omrs.sync_plan import DictionaryIndex
+
+
+class JobError(Exception):
+    """ Raised if a job request is invalid """
+    pass
+
+
+class WarmDictionaryIndex(object):
+    """ Dictionary index of a worker process, loaded again only when the dictionary changes """
+
+    def __init__(self):
+        self.index = None
+        self.stamp = None
+
+    def load(self):
+        """ Loads the index if the dictionary changed since it was last loaded """
+        # The stamp is computed again rather than reused, so that plans never see an old index
+        stamp_cache.clear()
+        stamp = get_dictionary_stamp()
+        if self.index is None or stamp != self.stamp:
+            self.index = DictionaryIndex().load()
+            self.stamp = stamp
+
+    def get_copy(self):
+        """ Returns a copy of the current index for one plan """
+        self.load()
+        return copy.deepcopy(self.index)
+
+
+
+## WORKER PROCESSES
+
+# Dictionary index of a worker process, created by init_worker()
+worker_index = None
+
+
+def init_worker():
+    """Utility function: Sets up a worker process and loads its dictionary index"""
+    global worker_index
+    # Interrupting the server stops the workers, which do not handle the interrupt themselves
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_index = WarmDictionaryIndex()
+    try:
+        route_reads_to_primary()
+        worker_index.load()
+    except DatabaseError as e:
+        # The index is loaded by the first plan job instead
+        print >> sys.stderr, 'Could not load the dictionary index: %s' % e
+        close_connections()
+
+
+def run_job(job):
+    """
+    Utility function: Runs a job in a worker process. Returns a response dictionary with the
+    status ("ok" or "error"), the elapsed seconds and the job's counts or error message.
+    """
+    start_time = time.time()
+    try:
+        if not job.get('output'):
+            raise JobError('The job has no "output" file')
+        if job.get('type') == 'export':
+            counts = run_export(job)
+        elif job.get('type') == 'validate':
+            counts = run_validate(job)
+        elif job.get('type') == 'plan':
+            counts = run_plan(job)
+        else:
+            raise JobError('Unknown job type: %s' % job.get('type'))
+        response = {'status': 'ok', 'counts': counts}
+    except (JobError, CommandError, IOError) as e:
+        response = {'status': 'error', 'error': str(e)}
+    except DatabaseError as e:
+        # The next job reconnects
+        close_connections()
+        response = {'status': 'error', 'error': 'Database error: %s' % e}
+    except Exception as e:
+        # e.g. a concept class that does not exist or an invalid input file
+        response = {'status': 'error', 'error': '%s: %s' % (e.__class__.__name__, e)}
+    response['seconds'] = round(time.time() - start_time, 3)
+    return response
+
+
+def run_export(job):
+    """Utility function: Writes a concept, mapping or retired concept ID export"""
+    if job.get('export') not in EXPORT_TYPES:
+        raise JobError('Unknown export: %s' % job.get('export'))
+    route_reads_to_replica()
+    command = get_export_command(job['export'], org_id=job.get('org'), source_id=job.get('source'),
+                                 since=job.get('since'))
+    num_lines = 0
+    with open(job['output'], 'w') as output_file:
+        for lines in iterate_export_lines(command):
+            output_file.write(lines)
+            num_lines += lines.count('\n')
+    return {'records': num_lines}
+
+
+def run_validate(job):
+    """Utility function: Writes the validate_export report of an OCL export file"""
+    if not job.get('export'):
+        raise JobError('The validate job has no "export" file')
+    route_reads_to_replica()
+    command = ValidateCommand()
+    options = get_command_options(ValidateCommand, ocl_export_filename=job['export'],
+                                  ignore_retired_mappings=bool(job.get('ignore_retired_mappings')))
+    with open(job['output'], 'w') as output_file:
+        # validate_export prints its report
+        stdout = sys.stdout
+        sys.stdout = output_file
+        try:
+            command.handle(**options)
+        finally:
+            sys.stdout = stdout
+    return {}
+
+
+def run_plan(job):
+    """Utility function: Writes the change set that sync_bahmni_db would apply"""
+    if not job.get('concept_file') or not job.get('mapping_file'):
+        raise JobError('The plan job needs a "concept_file" and a "mapping_file"')
+    route_reads_to_primary()
+    command = SyncCommand()
+    command.configure(get_command_options(
+        SyncCommand, verbosity=0, plan_filename=job['output'],
+        concept_filename=job.get('concept_file'), mapping_filename=job.get('mapping_file'),
+        source_filename=job.get('source_file'), class_filename=job.get('class_file')))
+    command.profiler = Profiler('sync_bahmni_db', enabled=False)
+    command.dictionary_index = worker_index.get_copy()
+    command.process()
+    return command.plan_counts
+
+
+
+## HELPER METHODS
+
+def get_command_options(command_class, **options):
+    """Utility function: Returns the default options of a command, updated with options"""
+    command_options = dict((option.dest, option.default) for option in command_class.option_list)
+    command_options.update(options)
+    return command_options
@@ -1,4 +1,5 @@
 """ Init for commands """
+from django.db import connections
 
 
 class UnrecognizedSourceException(Exception):
@@ -82,3 +83,27 @@ class OclOpenmrsHelper(object):
             if src['ocl_id'] == ocl_source_id:
                 return src['omrs_id']
         raise UnrecognizedSourceException('Source %s not found in source directory.' % ocl_source_id)
+
+
+
+def iterate_batches(items, batch_size):
+    """ Yields successive lists of at most batch_size items from any iterable """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def increment(counts, name, value=1):
+    """ Increments a named count in a dictionary of counts """
+    counts[name] = counts.get(name, 0) + value
+
+
+def close_connections():
+    """ Closes the database connections of the current thread, e.g. before forking workers """
+    for conn in connections.all():
+        conn.close()
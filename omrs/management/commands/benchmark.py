@@ -0,0 +1,298 @@
+"""
+Command to benchmark export, validation and sync throughput on a synthetic concept dictionary.
+
+Generate a synthetic dictionary into a local SQLite file and time all commands end to end:
+
+    manage.py benchmark --settings=omrs.settings_benchmark --create_schema --generate --num_concepts=20000
+
+Re-run the timings against the same dictionary (e.g. before and after a change):
+
+    manage.py benchmark --settings=omrs.settings_benchmark --report=bench.json
+
+To benchmark against a local MySQL, point the settings at an empty local database. The
+'generate' option refuses to write into a database that already contains concepts.
+
+For each step the command reports the elapsed time, records per second, the number of
+queries, the DB time and the peak resident set size of the process so far.
+
+NOTES:
+- sync_bahmni_db is run against the same database, so it measures the cost of matching an
+  unchanged dictionary rather than of inserting a new one
+
+"""
+from optparse import make_option
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from django.core.management import BaseCommand, CommandError, call_command
+from omrs.models import Concept
+from omrs.profiling import Profiler
+from omrs.synthetic import SyntheticDictionaryGenerator
+
+
+class Command(BaseCommand):
+    """
+    Benchmark export, validation and sync throughput on a synthetic concept dictionary
+    """
+
+    # Command attributes
+    help = 'Benchmark export, validation and sync throughput on a synthetic concept dictionary'
+    option_list = BaseCommand.option_list + (
+        make_option('--create_schema',
+                    action='store_true',
+                    dest='create_schema',
+                    default=False,
+                    help='Create the concept dictionary tables before generating.'),
+        make_option('--generate',
+                    action='store_true',
+                    dest='generate',
+                    default=False,
+                    help='Generate a synthetic concept dictionary into an empty database.'),
+        make_option('--num_concepts',
+                    action='store',
+                    dest='num_concepts',
+                    default=1000,
+                    help='Number of concepts to generate.'),
+        make_option('--names_per_concept',
+                    action='store',
+                    dest='names_per_concept',
+                    default=3,
+                    help='Number of names to generate per concept.'),
+        make_option('--mappings_per_concept',
+                    action='store',
+                    dest='mappings_per_concept',
+                    default=2,
+                    help='Number of reference maps to generate per concept.'),
+        make_option('--answers_per_question',
+                    action='store',
+                    dest='answers_per_question',
+                    default=4,
+                    help='Number of linked answers to generate per coded question.'),
+        make_option('--members_per_set',
+                    action='store',
+                    dest='members_per_set',
+                    default=5,
+                    help='Number of members to generate per concept set.'),
+        make_option('--seed',
+                    action='store',
+                    dest='seed',
+                    default=0,
+                    help='Random seed for the synthetic dictionary.'),
+        make_option('--engines',
+                    action='store',
+                    dest='engines',
+                    default='orm,sql',
+                    help='Comma-separated list of extract_db engines to benchmark.'),
+        make_option('--skip_sync',
+                    action='store_true',
+                    dest='skip_sync',
+                    default=False,
+                    help='Do not benchmark sync_bahmni_db.'),
+        make_option('--work_dir',
+                    action='store',
+                    dest='work_dir',
+                    default=None,
+                    help='Directory for the export files, otherwise a temporary directory is used.'),
+        make_option('--report',
+                    action='store',
+                    dest='report_filename',
+                    default=None,
+                    help='Also write the benchmark results to this JSON file.'),
+    )
+
+    # All benchmark exports use the synthetic org/source
+    ORG_ID = 'CIEL'
+    SOURCE_ID = 'CIEL'
+
+
+
+    ## COMMAND LINE HANDLER
+
+    def handle(self, *args, **options):
+        """
+        This method is called first directly from the command line, optionally generates the
+        synthetic dictionary, and then runs and reports the benchmark steps.
+        """
+        self.verbosity = int(options['verbosity'])
+        self.engines = [engine.strip() for engine in options['engines'].split(',') if engine.strip()]
+        self.results = []
+        if not self.engines:
+            raise CommandError('ERROR: At least one extract_db engine must be benchmarked')
+
+        if options['create_schema']:
+            generator = self.get_generator(options)
+            generator.create_schema()
+        if options['generate']:
+            if Concept.objects.exists():
+                raise CommandError(
+                    'ERROR: The database already contains concepts. Synthetic dictionaries can '
+                    'only be generated into an empty database.')
+            generator = self.get_generator(options)
+            start_time = time.time()
+            counts = generator.generate()
+            if self.verbosity:
+                print 'Generated synthetic dictionary in %.1f seconds: %s' % (
+                    time.time() - start_time, json.dumps(counts, sort_keys=True))
+
+        work_dir = options['work_dir']
+        remove_work_dir = False
+        if not work_dir:
+            work_dir = tempfile.mkdtemp(prefix='omrs_benchmark_')
+            remove_work_dir = True
+        try:
+            self.run_benchmarks(work_dir, options['skip_sync'])
+        finally:
+            if remove_work_dir:
+                shutil.rmtree(work_dir)
+
+        self.print_results()
+        if options['report_filename']:
+            with open(options['report_filename'], 'w') as report_file:
+                json.dump(self.results, report_file, indent=4)
+
+    def get_generator(self, options):
+        """ Returns a synthetic dictionary generator configured from the command line options """
+        return SyntheticDictionaryGenerator(
+            num_concepts=int(options['num_concepts']),
+            names_per_concept=int(options['names_per_concept']),
+            mappings_per_concept=int(options['mappings_per_concept']),
+            answers_per_question=int(options['answers_per_question']),
+            members_per_set=int(options['members_per_set']),
+            org_source_name=self.ORG_ID,
+            seed=int(options['seed']))
+
+
+
+    ## BENCHMARK STEPS
+
+    def run_benchmarks(self, work_dir, skip_sync=False):
+        """ Runs each benchmark step, writing all exports and logs to work_dir """
+        path = lambda filename: os.path.join(work_dir, filename)
+        export_options = {'org_id': self.ORG_ID, 'source_id': self.SOURCE_ID, 'raw': True,
+                          'verbosity': 0}
+
+        # extract_db, once per engine
+        for engine in self.engines:
+            self.run_step('extract_db --concepts (%s)' % engine, path('concepts_%s.json' % engine),
+                          'extract_db', concept=True, engine=engine, **export_options)
+            self.run_step('extract_db --mappings (%s)' % engine, path('mappings_%s.json' % engine),
+                          'extract_db', mapping=True, engine=engine, **export_options)
+
+        # validate_export, using the export of the first engine converted to the OCL format
+        engine = self.engines[0]
+        num_records = self.write_ocl_export(path('concepts_%s.json' % engine),
+                                            path('mappings_%s.json' % engine),
+                                            path('ocl_export.json'))
+        self.run_step('validate_export', path('validate_export.log'), 'validate_export',
+                      num_records=num_records, ocl_export_filename=path('ocl_export.json'),
+                      verbosity=0)
+
+        # sync_bahmni_db, using the sync input files created by extract_db_sources
+        if not skip_sync:
+            self.run_step('extract_db_sources --concepts', path('sync_concepts.json'),
+                          'extract_db_sources', concept=True, **export_options)
+            self.run_step('extract_db_sources --mappings', path('sync_mappings.json'),
+                          'extract_db_sources', mapping=True, **export_options)
+            num_records = (count_lines(path('sync_concepts.json')) +
+                           count_lines(path('sync_mappings.json')))
+            self.run_step('sync_bahmni_db', path('sync_bahmni_db.log'), 'sync_bahmni_db',
+                          num_records=num_records, org_id=self.ORG_ID, source_id=self.SOURCE_ID,
+                          concept_filename=path('sync_concepts.json'),
+                          mapping_filename=path('sync_mappings.json'), verbosity=0)
+
+    def run_step(self, step_name, output_filename, command_name, num_records=None, **options):
+        """
+        Runs a management command with its output redirected to output_filename and records
+        its elapsed time, query count and throughput. If num_records is not specified, the
+        number of lines written to the output file is used.
+        """
+        if self.verbosity:
+            print 'Running %s...' % step_name
+        stdout = sys.stdout
+        profiler = Profiler(step_name)
+        with open(output_filename, 'w') as output_file:
+            sys.stdout = output_file
+            profiler.install()
+            try:
+                start_time = time.time()
+                call_command(command_name, **options)
+                elapsed = time.time() - start_time
+            finally:
+                profiler.uninstall()
+                sys.stdout = stdout
+        if num_records is None:
+            num_records = count_lines(output_filename)
+
+        profile = profiler.get_report()
+        self.results.append({
+            'step': step_name,
+            'seconds': round(elapsed, 3),
+            'records': num_records,
+            'records_per_second': round(num_records / elapsed, 1) if elapsed else None,
+            'queries': profile['queries'],
+            'db_seconds': profile['db_seconds'],
+            'peak_rss_mb': round(get_peak_rss_mb(), 1),
+        })
+
+    def write_ocl_export(self, concepts_filename, mappings_filename, export_filename):
+        """
+        Converts extract_db concept and mapping files into the OCL export format expected by
+        validate_export. Returns the number of concepts and mappings written.
+        """
+        export = {'concepts': [], 'mappings': []}
+        for line in open(concepts_filename):
+            concept = json.loads(line)
+            export['concepts'].append({'id': str(concept['id']), 'retired': concept['retired']})
+        for num, line in enumerate(open(mappings_filename)):
+            mapping = json.loads(line)
+            ocl_mapping = {
+                'id': str(num),
+                'map_type': mapping['map_type'],
+                'retired': mapping['retired'],
+                'from_concept_code': mapping['from_concept_url'].split('/')[6],
+            }
+            if 'to_source_url' in mapping:
+                ocl_mapping['to_source_name'] = mapping['to_source_url'].split('/')[4]
+                ocl_mapping['to_concept_code'] = mapping['to_concept_code']
+            else:
+                ocl_mapping['to_source_name'] = mapping['to_concept_url'].split('/')[4]
+                ocl_mapping['to_concept_code'] = mapping['to_concept_url'].split('/')[6]
+            export['mappings'].append(ocl_mapping)
+        with open(export_filename, 'w') as export_file:
+            json.dump(export, export_file)
+        return len(export['concepts']) + len(export['mappings'])
+
+    def print_results(self):
+        """ Outputs a table of the benchmark results """
+        print '-' * 107
+        print '%-36s %10s %10s %12s %10s %10s %12s' % (
+            'STEP', 'SECONDS', 'RECORDS', 'RECORDS/SEC', 'QUERIES', 'DB SECONDS', 'PEAK RSS MB')
+        print '-' * 107
+        for result in self.results:
+            print '%-36s %10.2f %10d %12s %10d %10.2f %12.1f' % (
+                result['step'], result['seconds'], result['records'],
+                result['records_per_second'], result['queries'], result['db_seconds'],
+                result['peak_rss_mb'])
+        print '-' * 107
+
+
+
+## HELPER METHODS
+
+def count_lines(filename):
+    """Utility function: Returns the number of lines in a file"""
+    with open(filename) as input_file:
+        return sum(1 for line in input_file)
+
+
+def get_peak_rss_mb():
+    """Utility function: Returns the peak resident set size of this process in megabytes"""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes on Mac OS X and kilobytes on Linux
+        return peak_rss / (1024.0 * 1024.0)
+    return peak_rss / 1024.0
@@ -0,0 +1,117 @@
+"""
+Command to check that the OpenMRS database has the indexes that the lookups of this tool need,
+and optionally to create the missing ones.
+
+OpenMRS does not index the columns that sync_bahmni_db and validate_export match on (e.g.
+concept names by name, locale and type, or reference terms by code and source), so each of
+those lookups scans the whole table. Report the missing indexes with the size of the table
+each lookup scans without them:
+
+    manage.py ensure_indexes
+
+Create the missing indexes online (on MySQL with ALGORITHM=INPLACE, LOCK=NONE, so the tables
+stay readable and writable while the index is built):
+
+    manage.py ensure_indexes --apply
+
+The indexes are the lookup indexes in omrs/schema.py, which snapshot_db also creates in its
+snapshots. An existing index whose leading columns are the lookup columns counts as present.
+
+"""
+from optparse import make_option
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, DatabaseError
+from omrs.schema import LOOKUP_INDEXES, get_create_index_sql, get_index_columns, get_table_row_estimate
+
+
+class Command(BaseCommand):
+    """
+    Check for and create the indexes that the lookups of this tool need
+    """
+
+    # Command attributes
+    help = 'Check for and create the indexes that the lookups of this tool need'
+    option_list = BaseCommand.option_list + (
+        make_option('--apply',
+                    action='store_true',
+                    dest='apply',
+                    default=False,
+                    help='Create the missing indexes.'),
+        make_option('--database',
+                    action='store',
+                    dest='database',
+                    default='default',
+                    help='Database alias to check, "default" by default.'),
+    )
+
+
+
+    ## COMMAND LINE HANDLER
+
+    def handle(self, *args, **options):
+        """
+        This method is called first directly from the command line, reports the missing
+        indexes and creates them if the 'apply' option is set.
+        """
+        self.verbosity = int(options['verbosity'])
+        if options['database'] not in connections.databases:
+            raise CommandError('Database alias "%s" is not configured in settings.DATABASES' % options['database'])
+        self.connection = connections[options['database']]
+        if self.connection.vendor not in ('mysql', 'sqlite'):
+            raise CommandError('ensure_indexes supports MySQL and SQLite databases only')
+
+        missing_indexes = self.get_missing_indexes()
+        if self.verbosity:
+            self.print_report(missing_indexes)
+        if options['apply'] and missing_indexes:
+            self.create_indexes([index for index, num_rows in missing_indexes])
+
+    def get_missing_indexes(self):
+        """ Returns a list of (LookupIndex, table row count) for the missing lookup indexes """
+        missing_indexes = []
+        index_columns_by_table = {}
+        for index in LOOKUP_INDEXES:
+            if index.table not in index_columns_by_table:
+                index_columns_by_table[index.table] = get_index_columns(self.connection, index.table)
+            if not [columns for columns in index_columns_by_table[index.table]
+                    if columns[:len(index.columns)] == index.columns]:
+                missing_indexes.append((index, self.get_table_rows(index.table)))
+        return missing_indexes
+
+    def get_table_rows(self, table):
+        """ Returns the estimated number of rows of a table, or the exact count if there is no estimate """
+        num_rows = get_table_row_estimate(self.connection, table)
+        if num_rows is None:
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT COUNT(*) FROM %s' % self.connection.ops.quote_name(table))
+            num_rows = cursor.fetchone()[0]
+        return num_rows
+
+    def print_report(self, missing_indexes):
+        """ Prints the missing indexes, largest tables first """
+        print 'LOOKUP INDEXES: %d of %d present' % (
+            len(LOOKUP_INDEXES) - len(missing_indexes), len(LOOKUP_INDEXES))
+        for index, num_rows in sorted(missing_indexes, key=lambda missing: -missing[1]):
+            print '  MISSING %s(%s), used by %s: ~%d rows scanned per lookup without it' % (
+                index.table, ', '.join(index.columns), index.used_by, num_rows)
+
+    def create_indexes(self, indexes):
+        """ Creates the indexes one at a time, online on MySQL """
+        failed = []
+        for index in indexes:
+            if self.connection.vendor == 'mysql':
+                quote_name = self.connection.ops.quote_name
+                sql = 'ALTER TABLE %s ADD INDEX %s (%s), ALGORITHM=INPLACE, LOCK=NONE' % (
+                    quote_name(index.table), quote_name(index.name),
+                    ', '.join(quote_name(column) for column in index.columns))
+            else:
+                sql = get_create_index_sql(self.connection, index)
+            if self.verbosity:
+                print 'Creating %s on %s(%s)...' % (index.name, index.table, ', '.join(index.columns))
+            try:
+                self.connection.cursor().execute(sql)
+            except DatabaseError as e:
+                print 'ERROR: Could not create %s: %s' % (index.name, e)
+                failed.append(index.name)
+        if failed:
+            raise CommandError('Could not create %d index(es): %s' % (len(failed), ', '.join(failed)))
@@ -26,6 +26,50 @@ The OCL-CIEL test data set uses --concept_limit=2000:
     manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concept_limit=2000 --mappings > m2k.json
     manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concept_limit=2000 --retired > r2k.json
 
+To re-export a list of concepts, pass their IDs (or the name of a file of IDs) with "concept_ids":
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concept_ids=5839,1065 --concepts > c.json
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concept_ids=ids.txt --mappings > m.json
+
+Use "--engine=sql" to build the export directly from raw SQL rows instead of Django model
+instances, which is much faster for the full dictionary. The "compare_engines" option exports
+with both engines and reports any differences between them:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --engine=sql --concepts > concepts.json
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --concept_limit=2000 --concepts --mappings --compare_engines
+
+For the largest exports, add the "pipeline_workers" option to the raw SQL engine to fetch the
+next chunks of rows in a thread while worker processes build and serialize the records of the
+previous ones (see omrs/pipeline.py). The output is the same as without it:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --engine=sql --pipeline_workers=3 --mappings > m.json
+
+Add the "profile" option (or set the OMRS_PROFILE environment variable) to write a JSON report
+of the queries, DB time, serialization time and records/sec of each phase to stderr.
+
+Add the "progress" option to report concepts/sec, mappings/sec and the ETA on stderr, and the
+"state_file" option to periodically checkpoint the last concept ID exported and the counters:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --mappings --progress --state_file=m.state > m.json
+
+To be able to resume a long export, write it with the "output" option instead of redirecting
+stdout. If the run fails, "resume" truncates the output file to the last checkpoint, restores
+the counters and continues after the last exported concept, appending to the output file:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --mappings --output=m.json --state_file=m.state
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --mappings --resume=m.state
+
+Transient database errors (e.g. a MySQL timeout) during an export close the connection and
+retry from the last exported concept, up to the number of times set by "retries".
+
+Add the "since" option to only export the concepts created, changed or retired since a date,
+e.g. for an incremental update:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --since=2016-07-01 --concepts > c.json
+
+Add the "closure" option to also export all concepts referenced by the subset as linked answers
+or set members, so that the subset's mappings never point at concepts missing from the subset.
+
 NOTES:
 - OCL does not handle the OpenMRS drug table -- it is ignored for now
 
@@ -35,12 +79,23 @@ BUGS:
 
 """
 from optparse import make_option
+from itertools import izip_longest
+import datetime
 import json
+import os
+import sys
+import time
 from django.core.management import BaseCommand, CommandError
-from omrs.models import Concept, ConceptReferenceSource
-from omrs.management.commands import OclOpenmrsHelper, UnrecognizedSourceException
-import requests
-
+from django.db import connections, router, InterfaceError, OperationalError
+from django.db.models import Q
+from omrs.models import Concept, ConceptReferenceSource, ConceptAnswer, ConceptSet
+from omrs.pipeline import ExportPipeline
+from omrs.profiling import Profiler, PROFILE_OPTIONS
+from omrs.routers import route_reads_to_replica
+from omrs.progress import ProgressReporter, CheckpointWriter, read_checkpoint, PROGRESS_OPTIONS
+from omrs.sql_export import SqlConceptExporter
+from omrs.management.commands import (OclOpenmrsHelper, UnrecognizedSourceException,
+                                      iterate_batches)
 
 
 class Command(BaseCommand):
@@ -56,11 +111,29 @@ class Command(BaseCommand):
                     dest='concept_id',
                     default=None,
                     help='ID for concept to export, if specified only export this one. e.g. 5839'),
+        make_option('--concept_ids',
+                    action='store',
+                    dest='concept_ids',
+                    default=None,
+                    help=('Comma-separated list of concept IDs to export (e.g. 5839,1065), or the '
+                          'name of a file with one or more IDs per line.')),
         make_option('--concept_limit',
                     action='store',
                     dest='concept_limit',
                     default=None,
                     help='Use to limit the number of concepts exported. Useful for testing.'),
+        make_option('--closure',
+                    action='store_true',
+                    dest='closure',
+                    default=False,
+                    help=('Also export all concepts referenced by the selected concepts as linked '
+                          'answers or set members, so that the subset is self-contained.')),
+        make_option('--since',
+                    action='store',
+                    dest='since',
+                    default=None,
+                    help=('Only export concepts created, changed or retired since this date or time, '
+                          'e.g. 2016-07-01 or 2016-07-01T08:00:00.')),
         make_option('--mappings',
                     action='store_true',
                     dest='mapping',
@@ -81,6 +154,23 @@ class Command(BaseCommand):
                     dest='retire_sw',
                     default=False,
                     help='If specify, output a list of retired concepts.'),
+        make_option('--engine',
+                    action='store',
+                    dest='engine',
+                    default='orm',
+                    help=('Export engine: "orm" (default) builds Django model instances, "sql" '
+                          'assembles the export directly from raw SQL rows and is much faster.')),
+        make_option('--pipeline_workers',
+                    action='store',
+                    dest='pipeline_workers',
+                    default=0,
+                    help=('With the "sql" engine, fetch rows in a thread and build and serialize '
+                          'records in this many worker processes (default 0, no pipeline).')),
+        make_option('--compare_engines',
+                    action='store_true',
+                    dest='compare_engines',
+                    default=False,
+                    help='Export with both engines and report any differences instead of output.'),
         make_option('--org_id',
                     action='store',
                     dest='org_id',
@@ -106,7 +196,32 @@ class Command(BaseCommand):
                     dest='token',
                     default=None,
                     help='OCL API token to validate OpenMRS reference sources'),
-    )
+        make_option('--state_file',
+                    action='store',
+                    dest='state_filename',
+                    default=None,
+                    help='Periodically write the last exported concept ID and counters to this file.'),
+        make_option('--checkpoint_interval',
+                    action='store',
+                    dest='checkpoint_interval',
+                    default=30,
+                    help='Number of seconds between state file checkpoints (default 30).'),
+        make_option('--output',
+                    action='store',
+                    dest='output_filename',
+                    default=None,
+                    help='Write the export to this file instead of stdout. Required for "resume".'),
+        make_option('--resume',
+                    action='store',
+                    dest='resume_filename',
+                    default=None,
+                    help='Resume a failed export from the checkpoint in this state file.'),
+        make_option('--retries',
+                    action='store',
+                    dest='retries',
+                    default=5,
+                    help='Number of times to reconnect after a transient database error (default 5).'),
+    ) + PROFILE_OPTIONS + PROGRESS_OPTIONS
 
     OCL_API_URL = {
         'dev': 'http://api.dev.openconceptlab.com/',
@@ -114,6 +229,15 @@ class Command(BaseCommand):
         'production': 'http://api.openconceptlab.com/',
     }
 
+    ENGINE_ORM = 'orm'
+    ENGINE_SQL = 'sql'
+
+    # Number of concept IDs per IN query when fetching an explicit list of concepts
+    CONCEPT_BATCH_SIZE = 1000
+
+    # Accepted formats of the 'since' option
+    SINCE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S')
+
 
 
     ## EXTRACT_DB COMMAND LINE HANDLER AND VALIDATION
@@ -125,31 +249,71 @@ class Command(BaseCommand):
         """
 
         # Handle command line arguments
+        self.configure(options)
+
+        # Option debug output
+        if self.verbosity >= 2:
+            print 'COMMAND LINE OPTIONS:', options
+
+        # Validate the options
+        self.validate_options()
+
+        # The export only reads, so it reads from the replica database if there is one
+        route_reads_to_replica()
+
+        # Start query and timing instrumentation if the 'profile' option is set
+        self.profiler = Profiler.from_options('extract_db', options)
+        self.progress = ProgressReporter.from_options(
+            'extract_db', options, item_name='concepts', get_counts=self.get_progress_counts)
+        self.profiler.install()
+        try:
+            self.process(options)
+        finally:
+            self.profiler.uninstall()
+        self.profiler.emit_report()
+
+    def configure(self, options):
+        """ Sets the command attributes from the command line options """
         self.org_id = options['org_id']
         self.source_id = options['source_id']
         self.concept_id = options['concept_id']
+        self.concept_ids = None
+        if options['concept_ids']:
+            self.concept_ids = self.parse_concept_ids(options['concept_ids'])
         self.concept_limit = options['concept_limit']
         self.raw = options['raw']
         self.do_mapping = options['mapping']
         self.do_concept = options['concept']
         self.do_retire = options['retire_sw']
+        self.closure = options['closure']
+        self.since = None
+        if options['since']:
+            self.since = self.parse_since(options['since'])
+        self.engine = options['engine'].lower()
+        self.do_compare_engines = options['compare_engines']
+        self.pipeline_workers = int(options['pipeline_workers'])
         if self.concept_limit is not None:
             self.concept_limit = int(self.concept_limit)
         self.verbosity = int(options['verbosity'])
         self.ocl_api_token = options['token']
+        self.state_filename = options['state_filename']
+        self.checkpoint_interval = float(options['checkpoint_interval'])
+        self.output_filename = options['output_filename']
+        self.resume_filename = options['resume_filename']
+        self.retries = int(options['retries'])
+        if self.resume_filename and not self.state_filename:
+            # Keep checkpointing to the state file being resumed
+            self.state_filename = self.resume_filename
         if options['ocl_api_env']:
             self.ocl_api_env = options['ocl_api_env'].lower()
 
-        # Option debug output
-        if self.verbosity >= 2:
-            print 'COMMAND LINE OPTIONS:', options
-
-        # Validate the options
-        self.validate_options()
+    def process(self, options):
+        """ Runs the source check and export requested by the command line options """
 
         # Validate all reference sources
         if options['check_sources']:
-            self.check_sources()
+            with self.profiler.phase('check_sources'):
+                self.check_sources()
 
         # Determine if an export request
         self.do_export = False
@@ -157,6 +321,31 @@ class Command(BaseCommand):
             self.do_export = True
 
         # Initialize counters
+        self.init_counters()
+
+        # Restore the counters and position of a failed export from its checkpoint
+        if self.resume_filename:
+            self.restore_checkpoint()
+
+        # Process concepts, mappings, or retirement script
+        if self.do_compare_engines:
+            with self.profiler.phase('compare_engines'):
+                self.compare_engines()
+        elif self.do_export:
+            self.open_output()
+            try:
+                with self.profiler.phase('export'):
+                    self.export()
+            finally:
+                if self.output is not sys.stdout:
+                    self.output.close()
+
+        # Display final counts
+        if self.verbosity:
+            self.print_debug_summary()
+
+    def init_counters(self):
+        """ Initializes the counters and the export position """
         self.cnt_total_concepts_processed = 0
         self.cnt_concepts_exported = 0
         self.cnt_internal_mappings_exported = 0
@@ -167,14 +356,10 @@ class Command(BaseCommand):
         self.cnt_concept_sets_exported = 0
         self.cnt_set_members_exported = 0
         self.cnt_retired_concepts_exported = 0
-
-        # Process concepts, mappings, or retirement script
-        if self.do_export:
-            self.export()
-
-        # Display final counts
-        if self.verbosity:
-            self.print_debug_summary()
+        self.cnt_closure_concepts_added = 0
+        self.closure_ids = None
+        self.last_concept_id = None
+        self.output_offset = 0
 
     def validate_options(self):
         """
@@ -191,14 +376,61 @@ class Command(BaseCommand):
                  "source in OCL"))
         if self.ocl_api_env not in self.OCL_API_URL:
             raise CommandError('Invalid "env" option provided: %s' % self.ocl_api_env)
+        if self.engine not in (self.ENGINE_ORM, self.ENGINE_SQL):
+            raise CommandError('Invalid "engine" option provided: %s' % self.engine)
+        if self.pipeline_workers < 0:
+            raise CommandError('Invalid "pipeline_workers" option provided: %s' % self.pipeline_workers)
+        if self.pipeline_workers and self.engine != self.ENGINE_SQL:
+            raise CommandError("ERROR: 'pipeline_workers' requires the 'sql' engine")
+        if self.do_compare_engines and not (self.do_mapping or self.do_concept or self.do_retire):
+            raise CommandError(
+                "ERROR: 'compare_engines' requires at least one of 'concepts', 'mappings' or 'retired'")
+        if self.concept_ids is not None and (self.concept_id is not None or
+                                             self.concept_limit is not None):
+            raise CommandError(
+                "ERROR: 'concept_ids' cannot be combined with 'concept_id' or 'concept_limit'")
+        if self.since is not None and (self.concept_ids is not None or self.concept_id is not None):
+            raise CommandError("ERROR: 'since' cannot be combined with 'concept_id' or 'concept_ids'")
+        if self.resume_filename and not os.path.isfile(self.resume_filename):
+            raise CommandError('ERROR: State file to resume not found: %s' % self.resume_filename)
         return True
 
+    def parse_since(self, since_option):
+        """ Returns the datetime given by the 'since' option as a date or a date and time """
+        for date_format in self.SINCE_FORMATS:
+            try:
+                return datetime.datetime.strptime(since_option, date_format)
+            except ValueError:
+                pass
+        raise CommandError('Invalid date in "since" option: %s' % since_option)
+
+    def parse_concept_ids(self, concept_ids_option):
+        """
+        Returns the sorted, de-duplicated list of concept IDs given by the 'concept_ids' option,
+        which is either a comma-separated list of IDs or the name of a file of IDs separated by
+        commas, whitespace or newlines.
+        """
+        if os.path.isfile(concept_ids_option):
+            with open(concept_ids_option) as concept_ids_file:
+                concept_ids_text = concept_ids_file.read()
+        else:
+            concept_ids_text = concept_ids_option
+        try:
+            return sorted(set(int(concept_id) for concept_id in
+                              concept_ids_text.replace(',', ' ').split()))
+        except ValueError:
+            raise CommandError('Invalid concept ID in "concept_ids" option: %s' % concept_ids_option)
+
     def print_debug_summary(self):
         """ Outputs a summary of the results """
         print '------------------------------------------------------'
         print 'SUMMARY'
         print '------------------------------------------------------'
         print 'Total concepts processed: %d' % self.cnt_total_concepts_processed
+        if self.concept_ids is not None:
+            print 'Requested Concept IDs: %d' % len(self.concept_ids)
+        if self.closure:
+            print 'Referenced Concepts Added by Closure: %d' % self.cnt_closure_concepts_added
         if self.do_concept:
             print 'EXPORT COUNT: Concepts: %d' % self.cnt_concepts_exported
         if self.do_mapping:
@@ -223,6 +455,8 @@ class Command(BaseCommand):
 
     def check_sources(self):
         """ Validates that all reference sources in OpenMRS have been defined in OCL. """
+        # Imported here, as only this option needs it and it slows down the command startup
+        import requests
         url_base = self.OCL_API_URL[self.ocl_api_env]
         headers = {'Authorization': 'Token %s' % self.ocl_api_token}
         reference_sources = ConceptReferenceSource.objects.all()
@@ -268,36 +502,387 @@ class Command(BaseCommand):
         if self.raw:
             output_indent = None
 
-        # Create the concept enumerator, applying 'concept_id' and 'concept_limit' options
-        if self.concept_id is not None:
-            # If 'concept_id' option set, fetch a single concept and convert to enumerator
-            concept = Concept.objects.get(concept_id=self.concept_id)
-            concept_enumerator = enumerate([concept])
+        # Set up progress reporting and checkpoints
+        if self.progress.enabled:
+            self.progress.total = self.count_selected_concepts()
+        self.progress.start()
+        self.checkpoint = CheckpointWriter(self.state_filename, self.checkpoint_interval)
+        self.committed_counters = self.get_counters()
+
+        # Export, reconnecting and continuing after the last exported concept if the
+        # database connection fails
+        num_retries = 0
+        while True:
+            try:
+                self.export_remaining_concepts(output_indent)
+                break
+            except (OperationalError, InterfaceError) as e:
+                num_retries += 1
+                if num_retries > self.retries:
+                    self.checkpoint.write(self.get_checkpoint_state())
+                    raise
+                print >> sys.stderr, (
+                    'Database error after concept %s, reconnecting (retry %d of %d): %s' % (
+                        self.last_concept_id, num_retries, self.retries, e))
+                self.restore_counters(self.committed_counters)
+                connections[router.db_for_read(Concept)].close()
+                time.sleep(min(2 ** num_retries, 60))
+            except Exception:
+                self.checkpoint.write(self.get_checkpoint_state())
+                raise
+
+        self.progress.finish()
+        self.checkpoint.write(self.get_checkpoint_state(complete=True))
+
+    def export_remaining_concepts(self, output_indent):
+        """
+        Outputs the export records of the selected concepts after the last exported concept
+        (or of all selected concepts), writing a checkpoint whenever it is due.
+        """
+        if self.pipeline_workers:
+            self.export_remaining_concepts_pipelined(output_indent)
+            return
+        for concept_id, export_records in self.iterate_export_records():
+            serialization_start = time.time()
+            for export_data in export_records:
+                self.output.write(json.dumps(export_data, indent=output_indent) + '\n')
+            self.profiler.add_time('serialization', time.time() - serialization_start)
+            self.profiler.add_records(len(export_records))
+            self.concept_exported(concept_id)
+
+    def export_remaining_concepts_pipelined(self, output_indent):
+        """
+        Same as export_remaining_concepts(), with the rows fetched in a thread and the records
+        built and serialized by 'pipeline_workers' worker processes (see omrs/pipeline.py).
+        """
+        # The forked workers would otherwise write out a copy of any buffered output on exit
+        self.output.flush()
+        sys.stdout.flush()
+        exporter = SqlConceptExporter(self)
+        pipeline = ExportPipeline(exporter, self.pipeline_workers, output_indent=output_indent,
+                                  profiler=self.profiler)
+        for concept_id, lines, num_records, counts in pipeline.iterate_export_lines(
+                concept_ids=self.get_remaining_concept_ids(), concept_limit=self.concept_limit,
+                after_concept_id=self.last_concept_id):
+            self.output.write(lines)
+            exporter.add_counts(counts)
+            self.profiler.add_records(num_records)
+            self.concept_exported(concept_id)
+
+    def concept_exported(self, concept_id):
+        """ Records the position after an output concept and writes a checkpoint if it is due """
+        # The position after this concept is where a resumed export continues
+        self.last_concept_id = concept_id
+        self.committed_counters = self.get_counters()
+        if self.output is not sys.stdout:
+            self.output_offset = self.output.tell()
+        self.progress.update()
+        if self.checkpoint.is_due():
+            self.checkpoint.write(self.get_checkpoint_state())
+
+    def count_selected_concepts(self):
+        """
+        Returns the number of selected concepts still to be exported, used as the total for
+        progress reporting
+        """
+        concept_ids = self.get_remaining_concept_ids()
+        if concept_ids is not None:
+            return len(concept_ids)
+        concept_results = Concept.objects.all()
+        if self.concept_limit is not None:
+            concept_results = concept_results.filter(concept_id__lte=self.concept_limit)
+        if self.last_concept_id is not None:
+            concept_results = concept_results.filter(concept_id__gt=self.last_concept_id)
+        return concept_results.count()
+
+    def get_progress_counts(self):
+        """ Returns the cumulative counts whose rates are shown in the progress lines """
+        if self.do_mapping:
+            return {'mappings': (self.cnt_internal_mappings_exported +
+                                 self.cnt_external_mappings_exported +
+                                 self.cnt_answers_exported + self.cnt_set_members_exported)}
+        return {}
+
+    def get_counters(self):
+        """ Returns a dictionary of the values of all export counters """
+        return dict((name, value) for name, value in vars(self).items()
+                    if name.startswith('cnt_'))
+
+    def restore_counters(self, counters):
+        """ Sets the export counters to the values in a dictionary returned by get_counters() """
+        for name, value in counters.items():
+            setattr(self, name, value)
+
+    def get_export_selection(self):
+        """ Returns the options that determine the exported records, stored in checkpoints """
+        return {
+            'org_id': self.org_id,
+            'source_id': self.source_id,
+            'concepts': self.do_concept,
+            'mappings': self.do_mapping,
+            'retired': self.do_retire,
+            'raw': self.raw,
+            'concept_id': self.concept_id,
+            'concept_ids': self.concept_ids,
+            'concept_limit': self.concept_limit,
+            'closure': self.closure,
+            'since': self.since.isoformat() if self.since else None,
+        }
+
+    def get_checkpoint_state(self, complete=False):
+        """
+        Returns the state dictionary written to the state file: the last concept ID whose
+        records have been output, the output file and its size after that concept, and the
+        values of all export counters as of that concept. The output is flushed first so that
+        the checkpoint never runs ahead of the output file.
+        """
+        self.output.flush()
+        return {
+            'command': 'extract_db',
+            'complete': complete,
+            'selection': self.get_export_selection(),
+            'last_concept_id': self.last_concept_id,
+            'output_filename': self.output_filename,
+            'output_offset': self.output_offset,
+            'counters': self.committed_counters,
+        }
+
+    def restore_checkpoint(self):
+        """
+        Restores the position, output file and counters of a failed export from the state file
+        named by the 'resume' option. Raises a CommandError if the checkpoint cannot be resumed.
+        """
+        state = read_checkpoint(self.resume_filename)
+        if state.get('command') != 'extract_db':
+            raise CommandError('ERROR: %s is not an extract_db state file' % self.resume_filename)
+        if state['complete']:
+            raise CommandError('ERROR: The export in %s already completed' % self.resume_filename)
+        if state['selection'] != self.get_export_selection():
+            raise CommandError(
+                'ERROR: The export options do not match the checkpoint. Checkpoint options: %s'
+                % json.dumps(state['selection'], sort_keys=True))
+        if not state['output_filename']:
+            raise CommandError(
+                "ERROR: Only exports written with the 'output' option can be resumed")
+        if self.output_filename and (os.path.abspath(self.output_filename) !=
+                                     os.path.abspath(state['output_filename'])):
+            raise CommandError('ERROR: The checkpoint is for the output file %s'
+                               % state['output_filename'])
+
+        self.output_filename = state['output_filename']
+        self.output_offset = state['output_offset']
+        self.last_concept_id = state['last_concept_id']
+        self.restore_counters(state['counters'])
+        if self.verbosity >= 2:
+            print 'Resuming export after concept %s at byte %d of %s' % (
+                self.last_concept_id, self.output_offset, self.output_filename)
+
+    def open_output(self):
+        """
+        Opens the export output: stdout, the file named by the 'output' option, or, when
+        resuming, that file truncated to the checkpoint so that records written after the last
+        checkpoint (including any partial last line) are discarded before appending.
+        """
+        if not self.output_filename:
+            self.output = sys.stdout
+        elif self.resume_filename:
+            with open(self.output_filename, 'r+b') as output_file:
+                output_file.truncate(self.output_offset)
+            self.output = open(self.output_filename, 'ab')
         else:
-            # Fetch all concepts and filter with 'concept_limit' if set
-            # TODO: 'concept_limit' is based on numeric value of concept_id not on actual count
-            concept_results = Concept.objects.all()
-            if self.concept_limit is not None:
-                concept_results = concept_results.filter(concept_id__lte=self.concept_limit)
-            concept_enumerator = enumerate(concept_results)
+            self.output = open(self.output_filename, 'wb')
 
-        # Iterate concept enumerator and process the export
-        for num, concept in concept_enumerator:
+    def iterate_export_records(self):
+        """
+        Yields a (concept_id, export_records) tuple for each selected concept, where
+        export_records is the list of concept dictionaries, mapping dictionaries and retired
+        concept IDs to output for that concept. Uses the engine set by the 'engine' option.
+        """
+        if self.engine == self.ENGINE_SQL:
+            exporter = SqlConceptExporter(self)
+            return exporter.iterate_export_records(
+                concept_ids=self.get_remaining_concept_ids(), concept_limit=self.concept_limit,
+                after_concept_id=self.last_concept_id)
+        return self.iterate_orm_export_records()
+
+    def iterate_orm_export_records(self):
+        """ Yields (concept_id, export_records) tuples built from Django model instances """
+        for num, concept in self.get_concept_enumerator():
             self.cnt_total_concepts_processed += 1
-            export_data = ''
+            export_records = []
             if self.do_concept:
                 export_data = self.export_concept(concept)
                 if export_data:
-                    print json.dumps(export_data, indent=output_indent)
+                    export_records.append(export_data)
             if self.do_mapping:
                 export_data = self.export_all_mappings_for_concept(concept)
                 if export_data:
-                    for map_dict in export_data:
-                        print json.dumps(map_dict, indent=output_indent)
+                    export_records += export_data
             if self.do_retire:
                 export_data = self.export_concept_id_if_retired(concept)
                 if export_data:
-                    print json.dumps(export_data, indent=output_indent)
+                    export_records.append(export_data)
+            yield concept.concept_id, export_records
+
+    def compare_engines(self):
+        """
+        Exports the selected concepts with both the ORM and the raw SQL engine and compares the
+        records and counters of each concept. Raises a CommandError if there are differences.
+
+        Records are compared as serialized JSON rather than with ==, which would not catch
+        values that compare equal but are written differently (e.g. 1 and True).
+        """
+        exporter = SqlConceptExporter(self)
+        sql_export_records = exporter.iterate_export_records(
+            concept_ids=self.get_selected_concept_ids(), concept_limit=self.concept_limit,
+            apply_counts=False)
+        cnt_compared = 0
+        differences = []
+        for orm_result, sql_result in izip_longest(self.iterate_orm_export_records(),
+                                                   sql_export_records):
+            cnt_compared += 1
+            if json.dumps(orm_result, sort_keys=True) != json.dumps(sql_result, sort_keys=True):
+                differences.append((orm_result, sql_result))
+                if self.verbosity >= 2:
+                    print 'ENGINE DIFFERENCE:\n  ORM: %s\n  SQL: %s' % (orm_result, sql_result)
+        for name, value in sorted(exporter.counts.items()):
+            if getattr(self, name) != value:
+                differences.append((name, value))
+                if self.verbosity >= 2:
+                    print 'COUNTER DIFFERENCE: %s ORM %s != SQL %s' % (name, getattr(self, name), value)
+
+        print 'Engine comparison: %d concepts compared, %d differences' % (
+            cnt_compared, len(differences))
+        if differences:
+            raise CommandError('The ORM and SQL engines produced different exports')
+
+
+
+    ## CONCEPT SELECTION
+
+    def get_concept_enumerator(self):
+        """
+        Returns an enumerator of the Concept instances selected by the 'concept_id',
+        'concept_ids', 'concept_limit' and 'closure' options, in concept_id order and starting
+        after the last exported concept if the export is resumed or retried.
+        """
+        if self.closure:
+            # Expand the selection to its answer/set member closure and export it in one pass
+            return enumerate(self.iterate_concepts_by_id(self.get_remaining_concept_ids()))
+        elif self.concept_ids is not None or self.since is not None:
+            # If 'concept_ids' or 'since' option set, fetch the selected concepts in batches
+            return enumerate(self.iterate_concepts_by_id(self.get_remaining_concept_ids()))
+        elif self.concept_id is not None:
+            # If 'concept_id' option set, fetch a single concept and convert to enumerator
+            if self.last_concept_id is not None:
+                return enumerate([])
+            concept = Concept.objects.get(concept_id=self.concept_id)
+            return enumerate([concept])
+
+        # Fetch all concepts and filter with 'concept_limit' if set
+        # TODO: 'concept_limit' is based on numeric value of concept_id not on actual count
+        concept_results = Concept.objects.order_by('concept_id')
+        if self.concept_limit is not None:
+            concept_results = concept_results.filter(concept_id__lte=self.concept_limit)
+        if self.last_concept_id is not None:
+            concept_results = concept_results.filter(concept_id__gt=self.last_concept_id)
+        return enumerate(concept_results)
+
+    def get_selected_concept_ids(self):
+        """
+        Returns the sorted list of concept IDs selected by the 'concept_id', 'concept_ids',
+        'since' and 'closure' options, or None if all concepts (up to 'concept_limit') are selected.
+        """
+        if self.closure:
+            return self.get_concept_closure_ids()
+        elif self.concept_ids is not None:
+            return self.concept_ids
+        elif self.concept_id is not None:
+            return [int(self.concept_id)]
+        elif self.since is not None:
+            return self.get_changed_concept_ids()
+        return None
+
+    def get_remaining_concept_ids(self):
+        """
+        Returns the selected concept IDs after the last exported concept, or None if all
+        concepts (up to 'concept_limit') are selected.
+        """
+        concept_ids = self.get_selected_concept_ids()
+        if concept_ids is not None and self.last_concept_id is not None:
+            concept_ids = [concept_id for concept_id in concept_ids
+                           if concept_id > self.last_concept_id]
+        return concept_ids
+
+    def get_changed_concept_ids(self):
+        """
+        Returns the sorted list of IDs of the concepts created, changed or retired since the
+        'since' option, up to 'concept_limit'.
+        """
+        concept_results = Concept.objects.filter(
+            Q(date_created__gte=self.since) | Q(date_changed__gte=self.since) |
+            Q(date_retired__gte=self.since))
+        if self.concept_limit is not None:
+            concept_results = concept_results.filter(concept_id__lte=self.concept_limit)
+        return list(concept_results.order_by('concept_id').values_list('concept_id', flat=True))
+
+    def get_concept_closure_ids(self):
+        """
+        Returns the IDs of the selected concepts plus all concepts they reference as linked answers or
+        set members, followed transitively, so that an exported subset never refers to a
+        concept that is missing from the subset.
+
+        The answer and set member relationships are loaded into memory in bulk rather than
+        queried concept by concept.
+        """
+        if self.closure_ids is not None:
+            return self.closure_ids
+        if self.concept_ids is not None:
+            seed_ids = self.concept_ids
+        elif self.concept_id is not None:
+            seed_ids = [int(self.concept_id)]
+        elif self.since is not None:
+            seed_ids = self.get_changed_concept_ids()
+        else:
+            seed_results = Concept.objects.all()
+            if self.concept_limit is not None:
+                seed_results = seed_results.filter(concept_id__lte=self.concept_limit)
+            seed_ids = list(seed_results.values_list('concept_id', flat=True))
+
+        # Walk the reference graph from the seed concepts
+        references = self.build_concept_reference_index()
+        closure_ids = set(seed_ids)
+        pending = list(closure_ids)
+        while pending:
+            for referenced_id in references.get(pending.pop(), []):
+                if referenced_id not in closure_ids:
+                    closure_ids.add(referenced_id)
+                    pending.append(referenced_id)
+        self.cnt_closure_concepts_added = len(closure_ids) - len(set(seed_ids))
+
+        self.closure_ids = sorted(closure_ids)
+        return self.closure_ids
+
+    def build_concept_reference_index(self):
+        """
+        Returns a dictionary mapping each concept ID to the IDs of the concepts it references
+        as linked answers or set members. Uses one query per relationship table.
+        """
+        references = {}
+        for question_id, answer_id in ConceptAnswer.objects.values_list(
+                'question_concept', 'answer_concept'):
+            if answer_id is not None:
+                references.setdefault(question_id, []).append(answer_id)
+        for owner_id, member_id in ConceptSet.objects.values_list(
+                'concept_set_owner', 'concept'):
+            references.setdefault(owner_id, []).append(member_id)
+        return references
+
+    def iterate_concepts_by_id(self, concept_ids):
+        """ Yields the concepts with the specified IDs, fetched in batches of IN queries. """
+        for batch_ids in iterate_batches(concept_ids, self.CONCEPT_BATCH_SIZE):
+            for concept in Concept.objects.filter(concept_id__in=batch_ids).order_by('concept_id'):
+                yield concept
 
 
 
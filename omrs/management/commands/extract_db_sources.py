@@ -41,8 +41,8 @@ import json
 from django.core.management import BaseCommand, CommandError
 from omrs.models import Concept, ConceptReferenceSource ,ConceptClass
 from omrs.management.commands import OclOpenmrsHelper, UnrecognizedSourceException
-import requests
-
+from omrs.profiling import Profiler, PROFILE_OPTIONS
+from omrs.routers import route_reads_to_replica
 
 
 class Command(BaseCommand):
@@ -118,7 +118,7 @@ class Command(BaseCommand):
                     dest='token',
                     default=None,
                     help='OCL API token to validate OpenM...................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................................RS reference sources'),
-    )
+    ) + PROFILE_OPTIONS
 
     OCL_API_URL = {
         'dev': 'http://api.dev.openconceptlab.com/',
@@ -162,9 +162,25 @@ class Command(BaseCommand):
         # Validate the options
         self.validate_options()
 
+        # The export only reads, so it reads from the replica database if there is one
+        route_reads_to_replica()
+
+        # Start query and timing instrumentation if the 'profile' option is set
+        self.profiler = Profiler.from_options('extract_db_sources', options)
+        self.profiler.install()
+        try:
+            self.process(options)
+        finally:
+            self.profiler.uninstall()
+        self.profiler.emit_report()
+
+    def process(self, options):
+        """ Runs the source check and export requested by the command line options """
+
         # Validate all reference sources
         if options['check_sources']:
-            self.check_sources()
+            with self.profiler.phase('check_sources'):
+                self.check_sources()
 
         # Determine if an export request
         self.do_export = False
@@ -187,7 +203,8 @@ class Command(BaseCommand):
 
         # Process concepts, mappings, or retirement script
         if self.do_export:
-            self.export()
+            with self.profiler.phase('export'):
+                self.export()
 
         # Display final counts
         if self.verbosity:
@@ -244,6 +261,8 @@ class Command(BaseCommand):
 
     def check_sources(self):
         """ Validates that all reference sources in OpenMRS have been defined in OCL. """
+        # Imported here, as only this option needs it and it slows down the command startup
+        import requests
         url_base = self.OCL_API_URL[self.ocl_api_env]
         headers = {'Authorization': 'Token %s' % self.ocl_api_token}
         reference_sources = ConceptReferenceSource.objects.all()
@@ -307,6 +326,7 @@ class Command(BaseCommand):
             export_data1=''
             for num,src in sources_enum:
                 self.cnt_sources_exported+=1
+                self.profiler.add_records(1)
                 export_data1=self.export_source(src)
                 if export_data1:
                     print json.dumps(export_data1, indent=output_indent)
@@ -316,6 +336,7 @@ class Command(BaseCommand):
             export_data1 = ''
             for num, cls in classes_enum:
                  self.cnt_classes_exported += 1
+                 self.profiler.add_records(1)
                  export_data1 = self.export_class(cls)
                  if export_data1:
                      print json.dumps(export_data1, indent=output_indent)
@@ -323,6 +344,7 @@ class Command(BaseCommand):
         # Iterate concept enumerator and process the export
         for num, concept in concept_enumerator:
             self.cnt_total_concepts_processed += 1
+            self.profiler.add_records(1)
             export_data = ''
             if self.do_concept:
                 export_data = self.export_concept(concept)
@@ -0,0 +1,132 @@
+"""
+Command to run a long-lived export server that accepts export, validation and plan jobs over a
+local Unix socket and runs them in a pool of worker processes.
+
+Scripts that run many small exports pay the Django startup and the loading of the dictionary
+index for every command. The server pays them once per worker process instead:
+
+    manage.py serve_exports --socket=/var/run/omrs/exports.sock --workers=4
+
+A client sends one job as a line of JSON and receives one line of JSON when the job is done
+(see omrs/jobs.py for the job types), e.g. with socat:
+
+    echo '{"type": "export", "export": "concepts", "org": "CIEL", "source": "CIEL", "output": "/data/c.json"}' | socat - UNIX-CONNECT:/var/run/omrs/exports.sock
+    {"counts": {"records": 51234}, "seconds": 95.2, "status": "ok"}
+
+Jobs from concurrent clients wait in the queue of the worker pool until a worker is free. The
+output files are written by the server, so they must be paths the server can write to.
+
+NOTES:
+- Every worker process keeps its own copy of the dictionary index for plans in memory
+
+"""
+from optparse import make_option
+import json
+import multiprocessing
+import os
+import signal
+import SocketServer
+import sys
+from django.core.management import BaseCommand, CommandError
+from omrs.jobs import init_worker, run_job
+from omrs.management.commands import close_connections
+
+
+class Command(BaseCommand):
+    """
+    Serve export, validation and plan jobs over a Unix socket
+    """
+
+    # Command attributes
+    help = 'Serve export, validation and plan jobs over a Unix socket'
+    option_list = BaseCommand.option_list + (
+        make_option('--socket',
+                    action='store',
+                    dest='socket_filename',
+                    default='/tmp/omrs_exports.sock',
+                    help='Unix socket to accept jobs on.'),
+        make_option('--workers',
+                    action='store',
+                    dest='workers',
+                    default=2,
+                    help='Number of worker processes that run the jobs.'),
+    )
+
+
+
+    ## COMMAND LINE HANDLER
+
+    def handle(self, *args, **options):
+        """
+        This method is called first directly from the command line, starts the worker pool and
+        serves jobs until it is interrupted.
+        """
+        self.socket_filename = options['socket_filename']
+        self.workers = int(options['workers'])
+        self.verbosity = int(options['verbosity'])
+        if self.workers < 1:
+            raise CommandError('workers must be a positive number')
+        if os.path.exists(self.socket_filename):
+            # A socket left behind by a server that did not shut down cleanly
+            os.remove(self.socket_filename)
+
+        # The worker processes open their own database connections
+        close_connections()
+        self.pool = multiprocessing.Pool(self.workers, initializer=init_worker)
+        server = JobServer(self.socket_filename, JobRequestHandler)
+        server.command = self
+
+        # Stop cleanly when the server is stopped with SIGTERM as well as with SIGINT
+        signal.signal(signal.SIGTERM, stop_server)
+        if self.verbosity:
+            print 'Serving jobs on %s with %d workers' % (self.socket_filename, self.workers)
+            sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(self.socket_filename)
+            self.pool.terminate()
+            self.pool.join()
+
+    def run_job(self, job):
+        """ Runs a job in the worker pool, waiting for a free worker, and returns the response """
+        response = self.pool.apply_async(run_job, (job,)).get()
+        if self.verbosity:
+            print '%s %s -> %s in %.3fs%s' % (
+                job.get('type'), job.get('output'), response['status'], response['seconds'],
+                ': %s' % response['error'] if response['status'] == 'error' else '')
+            sys.stdout.flush()
+        return response
+
+
+
+def stop_server(signum, frame):
+    """Utility function: Signal handler that stops the server like an interrupt"""
+    raise KeyboardInterrupt
+
+
+
+class JobServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ Unix socket server that handles each client connection in a thread """
+    daemon_threads = True
+
+
+class JobRequestHandler(SocketServer.StreamRequestHandler):
+    """ Reads one JSON job from the client, runs it and writes the JSON response """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line.strip():
+            return
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError('A job must be a JSON object')
+        except ValueError as e:
+            response = {'status': 'error', 'error': 'Invalid job: %s' % e}
+        else:
+            response = self.server.command.run_job(job)
+        self.wfile.write(json.dumps(response, sort_keys=True) + '\n')
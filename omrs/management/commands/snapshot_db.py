@@ -0,0 +1,166 @@
+"""
+Command to copy the OpenMRS concept dictionary into a local SQLite snapshot, so that repeated
+exports, validations and sync plans run offline instead of against the OpenMRS database.
+
+Write the snapshot (by default to snapshot.sqlite3, or to the file set in OMRS_SNAPSHOT_DB):
+
+    manage.py snapshot_db
+
+Then run any command against the snapshot with the snapshot settings:
+
+    manage.py extract_db --settings=omrs.settings_snapshot --org_id=CIEL --source_id=CIEL --raw -v0 --concepts > c.json
+    manage.py validate_export --settings=omrs.settings_snapshot --export=export.json
+    manage.py sync_bahmni_db --settings=omrs.settings_snapshot --concept_file=c.json --mapping_file=m.json --plan=plan.json
+
+The snapshot contains the dictionary tables of omrs/models.py (concepts, names, descriptions,
+numeric ranges, reference terms and maps, answers, set members, classes, datatypes, map types
+and reference sources). Any existing snapshot tables are replaced. Each table is read in
+primary key order in batches of 'batch_size' rows and written with multi-row INSERTs in one
+transaction; the indexes (including the lookup indexes in omrs/schema.py) are created after
+the rows are loaded, and the snapshot is ANALYZEd for the SQLite query planner.
+
+"""
+from optparse import make_option
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, transaction
+from omrs.models import DICTIONARY_MODELS
+from omrs.profiling import Profiler, PROFILE_OPTIONS
+from omrs.schema import create_dictionary_indexes, create_dictionary_tables
+
+
+class Command(BaseCommand):
+    """
+    Copy the OpenMRS concept dictionary into a local SQLite snapshot
+    """
+
+    # Command attributes
+    help = 'Copy the OpenMRS concept dictionary into a local SQLite snapshot'
+    option_list = BaseCommand.option_list + (
+        make_option('--database',
+                    action='store',
+                    dest='database',
+                    default='snapshot',
+                    help='Database alias of the SQLite snapshot to write, "snapshot" by default.'),
+        make_option('--source_database',
+                    action='store',
+                    dest='source_database',
+                    default='default',
+                    help='Database alias of the OpenMRS database to copy, "default" by default.'),
+        make_option('--batch_size',
+                    action='store',
+                    dest='batch_size',
+                    default=5000,
+                    help='Number of rows read and written per batch.'),
+    ) + PROFILE_OPTIONS
+
+
+
+    ## COMMAND LINE HANDLER AND ARGUMENT VALIDATION
+
+    def handle(self, *args, **options):
+        """
+        This method is called first directly from the command line, handles options, and
+        copies the dictionary tables.
+        """
+
+        # Get command line arguments
+        self.database = options['database']
+        self.source_database = options['source_database']
+        self.batch_size = int(options['batch_size'])
+        self.verbosity = int(options['verbosity'])
+
+        # Option debug output
+        if self.verbosity >= 2:
+            print 'COMMAND LINE OPTIONS:', options
+
+        # Validate the options
+        self.validate_options()
+
+        # Start query and timing instrumentation if the 'profile' option is set
+        self.profiler = Profiler.from_options('snapshot_db', options)
+        self.profiler.install()
+        try:
+            self.snapshot()
+        finally:
+            self.profiler.uninstall()
+        self.profiler.emit_report()
+
+    def validate_options(self):
+        """ Raises a CommandError if the database aliases are invalid """
+        for alias in (self.database, self.source_database):
+            if alias not in connections.databases:
+                raise CommandError('Database alias "%s" is not configured in settings.DATABASES' % alias)
+        if self.database == self.source_database:
+            raise CommandError('The snapshot database must be different from the source database')
+        if connections[self.database].vendor != 'sqlite':
+            raise CommandError('The snapshot database "%s" must be a SQLite database' % self.database)
+        if self.batch_size < 1:
+            raise CommandError('batch_size must be a positive number')
+
+
+
+    ## SNAPSHOT
+
+    def snapshot(self):
+        """ Replaces the snapshot tables with copies of the dictionary tables """
+        connection = connections[self.database]
+        cursor = connection.cursor()
+
+        # The snapshot can be rebuilt from the source, so it is written without a journal
+        cursor.execute('PRAGMA journal_mode = OFF')
+        cursor.execute('PRAGMA synchronous = OFF')
+
+        with self.profiler.phase('create_tables'):
+            for model in reversed(DICTIONARY_MODELS):
+                cursor.execute('DROP TABLE IF EXISTS %s' % connection.ops.quote_name(model._meta.db_table))
+            create_dictionary_tables(connection)
+
+        counts = []
+        for model in DICTIONARY_MODELS:
+            with self.profiler.phase('copy_%s' % model._meta.db_table):
+                num_rows = self.copy_table(model)
+                self.profiler.add_records(num_rows)
+            counts.append((model._meta.db_table, num_rows))
+            if self.verbosity >= 2:
+                print 'Copied %d rows of %s' % (num_rows, model._meta.db_table)
+
+        with self.profiler.phase('create_indexes'):
+            create_dictionary_indexes(connection)
+            cursor.execute('ANALYZE')
+
+        if self.verbosity:
+            print 'SNAPSHOT WRITTEN TO %s:' % connection.settings_dict['NAME']
+            for table, num_rows in counts:
+                print '  %s: %d rows' % (table, num_rows)
+
+    def copy_table(self, model):
+        """
+        Copies the rows of a dictionary table from the source database to the snapshot in
+        primary key order, one batch per query. Returns the number of rows copied.
+        """
+        connection = connections[self.database]
+        quote_name = connection.ops.quote_name
+        fields = model._meta.fields
+        insert_sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            quote_name(model._meta.db_table),
+            ', '.join(quote_name(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields)))
+        pk_index = fields.index(model._meta.pk)
+
+        num_rows = 0
+        last_pk = None
+        with transaction.atomic(using=self.database):
+            cursor = connection.cursor()
+            while True:
+                queryset = model.objects.using(self.source_database).order_by('pk')
+                if last_pk is not None:
+                    queryset = queryset.filter(pk__gt=last_pk)
+                rows = list(queryset.values_list(*[field.name for field in fields])[:self.batch_size])
+                if not rows:
+                    break
+                cursor.executemany(insert_sql, rows)
+                num_rows += len(rows)
+                last_pk = rows[-1][pk_index]
+                if len(rows) < self.batch_size:
+                    break
+        return num_rows
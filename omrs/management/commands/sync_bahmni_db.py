@@ -9,6 +9,57 @@ Example usage:
 Set verbosity to 0 (e.g. '-v0') to suppress the results summary output. Set verbosity to 2
 to see all debug output.
 
+Add the "profile" option (or set the OMRS_PROFILE environment variable) to write a JSON report
+of the queries, DB time and records/sec of each phase to stderr.
+
+Concepts are synced in batches, each in one transaction with the names, descriptions and numeric
+ranges of its concepts, which are inserted in bulk (see omrs/sync_details.py).
+
+Add the "state_file" option to record the OCL -> OpenMRS concept ID translation and the synced
+mappings in a small SQLite file as the sync progresses. If the sync fails, re-run it with the
+"resume" option to skip the concepts and mappings that were already synced:
+
+        manage.py sync_bahmni_db --org_id=CIEL --source_id=CIEL --concept_file=c.json --mapping_file=m.json --state_file=sync.state
+        manage.py sync_bahmni_db --org_id=CIEL --source_id=CIEL --concept_file=c.json --mapping_file=m.json --resume=sync.state
+
+Add the "upsert" option to also update the class, datatype, retired status and is_set of
+concepts that already exist in OpenMRS. With a "state_file", a content hash of every synced
+concept is kept across syncs, so concepts that did not change since the previous sync are skipped
+with one query per batch; changed concepts are updated with one UPDATE per set of new values:
+
+        manage.py sync_bahmni_db --org_id=CIEL --source_id=CIEL --concept_file=c.json --mapping_file=m.json --state_file=ciel.state --upsert
+
+Add the "workers" option to sync with several processes. Concepts are partitioned by a hash of
+their fully specified name, so concepts that could match each other are always synced by the
+same process, and new concept IDs are allocated from a shared counter that starts above both the
+highest existing and the highest incoming concept ID. Mappings are synced in a second parallel
+phase once the OCL -> OpenMRS concept ID translation is complete, partitioned so that each
+reference term, answer and set member is only ever created by one process (SQLite databases
+lock the whole database for each write, so they only support one process):
+
+        manage.py sync_bahmni_db --org_id=CIEL --source_id=CIEL --concept_file=c.json --mapping_file=m.json --workers=4
+
+Add the "plan" option to compute the rows the sync would insert without writing anything. The
+current dictionary is loaded into memory with one query per table and the planned rows are
+written to the plan file as JSON lines (see omrs/sync_plan.py for the format):
+
+        manage.py sync_bahmni_db --org_id=CIEL --source_id=CIEL --source_file=s.json --class_file=cl.json --concept_file=c.json --mapping_file=m.json --plan=changes.json
+
+Add the "apply" option to insert the rows of a change set later, e.g. during a short write window
+on the production database. Rows are inserted in dependency order with multi-row INSERTs, one
+transaction per batch (see omrs/sync_apply.py). The apply stops with an error if a planned
+concept ID has been taken by another concept since the change set was planned:
+
+        manage.py sync_bahmni_db --org_id=CIEL --source_id=CIEL --apply=changes.json
+
+Add the "retired_file" option to retire the concepts listed in a file created by
+"extract_db --retired". The OCL concept IDs are translated with the concept IDs of the sync (or
+of the "resume" state file, or, with a "concept_file" but no "mapping_file", by matching the
+external IDs of the concept file with the concept uuids) and the concepts are retired in batches
+of UPDATE statements:
+
+        manage.py sync_bahmni_db --org_id=CIEL --source_id=CIEL --resume=sync.state --retired --retired_file=retired.json
+
 NOTES:
 - Does not handle the OpenMRS drug table -- it is ignored for now
 
@@ -17,11 +68,23 @@ BUGS:
 """
 
 from optparse import make_option
+import hashlib
 import json
+import multiprocessing
+import os
+import time
+import zlib
 from django.core.management import BaseCommand, CommandError
 from omrs.models import Concept, ConceptName, ConceptDatatype, ConceptClass, ConceptReferenceMap, ConceptAnswer, ConceptSet,  ConceptReferenceSource, ConceptReferenceTerm, ConceptMapType,ConceptDescription,ConceptNumeric
-from omrs.management.commands import OclOpenmrsHelper, UnrecognizedSourceException
-import requests,datetime
+from omrs.management.commands import (OclOpenmrsHelper, UnrecognizedSourceException, close_connections,
+                                      iterate_batches)
+from omrs.profiling import Profiler, PROFILE_OPTIONS
+from omrs.sync_plan import DictionaryIndex, SyncPlanner, get_normalizer
+from omrs.sync_apply import ChangeSetApplier, ChangeSetError
+from omrs.sync_details import ConceptDetailWriter
+from omrs.sync_state import SyncState
+import datetime
+from django.db import connection, transaction, OperationalError
 from django.db.models import Max
 
 
@@ -62,7 +125,12 @@ class Command(BaseCommand):
                     action='store_true',
                     dest='retire_sw',
                     default=False,
-                    help='If specify, output a list of retired concepts.'),
+                    help='If specify, retire the concepts listed in the retired_file.'),
+        make_option('--retired_file',
+                    action='store',
+                    dest='retired_filename',
+                    default=None,
+                    help='Retired concept IDs file created by "extract_db --retired", used with "retired".'),
         make_option('--org_id',
                     action='store',
                     dest='org_id',
@@ -88,7 +156,38 @@ class Command(BaseCommand):
                     dest='token',
                     default=None,
                     help='OCL API token to validate OpenMRS reference sources'),
-    )
+        make_option('--state_file',
+                    action='store',
+                    dest='state_filename',
+                    default=None,
+                    help='Record the synced concepts and mappings in this file so the sync can be resumed.'),
+        make_option('--resume',
+                    action='store',
+                    dest='resume_filename',
+                    default=None,
+                    help='Resume a failed sync, skipping the concepts and mappings in this state file.'),
+        make_option('--workers',
+                    action='store',
+                    dest='workers',
+                    default=1,
+                    help=('Number of processes to sync concepts and mappings with (default 1). '
+                          'SQLite databases only support 1.')),
+        make_option('--upsert',
+                    action='store_true',
+                    dest='upsert',
+                    default=False,
+                    help='Update the class, datatype, retired status and is_set of existing concepts that changed.'),
+        make_option('--plan',
+                    action='store',
+                    dest='plan_filename',
+                    default=None,
+                    help='Write the rows the sync would insert to this file as JSON lines, without syncing.'),
+        make_option('--apply',
+                    action='store',
+                    dest='apply_filename',
+                    default=None,
+                    help='Insert the rows of a change set written by the "plan" option, without syncing.'),
+    ) + PROFILE_OPTIONS
 
     OCL_API_URL = {
         'dev': 'http://api.dev.openconceptlab.com/',
@@ -96,6 +195,30 @@ class Command(BaseCommand):
         'production': 'http://api.openconceptlab.com/',
     }
 
+    # Number of concepts synced in one transaction, with their names, descriptions and numerics
+    CONCEPT_BATCH_SIZE = 200
+
+    # Number of from-concepts whose mappings are synced in one batch
+    MAPPING_BATCH_SIZE = 200
+
+    # Number of partitions per worker process; smaller partitions balance the load better
+    PARTITIONS_PER_WORKER = 16
+
+    # Status of a synced concept in the results of sync_concept_batch()
+    CONCEPT_CREATED = 'created'
+    CONCEPT_MATCHED = 'matched'
+    CONCEPT_UPDATED = 'updated'
+    CONCEPT_UNCHANGED = 'unchanged'
+
+    # Number of concepts retired with one UPDATE statement
+    RETIRE_BATCH_SIZE = 1000
+
+    # OpenMRS user recorded as the user who changed or retired synced concepts (the admin user)
+    SYNC_USER_ID = 1
+
+    # Number of times a concept or mapping batch is attempted if it fails with a lock error in parallel syncs
+    BATCH_ATTEMPTS = 5
+
 
 
     ## EXTRACT_DB COMMAND LINE HANDLER AND VALIDATION
@@ -107,6 +230,27 @@ class Command(BaseCommand):
         """
 
         # Handle command line arguments
+        self.configure(options)
+
+        # Option debug output
+        if self.verbosity >= 2:
+            print 'COMMAND LINE OPTIONS:', options
+
+        # Validate the options
+        #self.validate_options()
+
+        # Start query and timing instrumentation if the 'profile' option is set
+        self.profiler = Profiler.from_options('sync_bahmni_db', options)
+        self.profiler.install()
+        try:
+            self.process()
+        finally:
+            self.profiler.uninstall()
+        self.profiler.emit_report()
+
+    def configure(self, options):
+        """ Sets the command attributes from the command line options """
+        self.options = options
         self.org_id = options['org_id']
         self.source_id = options['source_id']
         self.concept_id = options['concept_id']
@@ -116,18 +260,50 @@ class Command(BaseCommand):
         self.class_filename = options['class_filename']
 
         self.do_retire = options['retire_sw']
+        self.retired_filename = options['retired_filename']
+        if self.do_retire and not self.retired_filename:
+            raise CommandError('ERROR: The "retired" option requires a "retired_file"')
+        if self.retired_filename and not self.do_retire:
+            raise CommandError('ERROR: A "retired_file" is only used with the "retired" option')
+        if self.do_retire and not (self.concept_filename or options['resume_filename']):
+            raise CommandError('ERROR: The "retired" option requires a "concept_file" or a "resume" '
+                               'state file to translate the OCL concept IDs')
+        if self.do_retire and (options['plan_filename'] or options['apply_filename']):
+            raise CommandError('ERROR: The "retired" option cannot be combined with "plan" or "apply", '
+                               'which do not retire concepts')
+        if options['plan_filename'] and self.mapping_filename and not (self.concept_filename or
+                                                                       options['resume_filename']):
+            raise CommandError('ERROR: Planning a "mapping_file" requires a "concept_file" or a "resume" '
+                               'state file to translate the OCL concept IDs')
+        self.state_filename = options['resume_filename'] or options['state_filename']
+        self.resume = bool(options['resume_filename'])
+        if self.resume and not os.path.isfile(self.state_filename):
+            raise CommandError('ERROR: State file to resume not found: %s' % self.state_filename)
+
+        self.workers = int(options['workers'])
+        if self.workers > 1 and connection.vendor == 'sqlite':
+            # SQLite locks the whole database for each write, so the workers fail with lock errors
+            raise CommandError('ERROR: "workers" must be 1 with a SQLite database')
+        self.upsert = options['upsert']
+        self.plan_filename = options['plan_filename']
+        self.apply_filename = options['apply_filename']
+        if self.apply_filename and not os.path.isfile(self.apply_filename):
+            raise CommandError('ERROR: Change set to apply not found: %s' % self.apply_filename)
+        self.concept_id_counter = None
+
+        # Dictionary index to plan against, if already loaded (e.g. by serve_exports)
+        self.dictionary_index = None
+
+        # Reference term codes are matched the way the database compares them, as in the plan
+        self.normalize = get_normalizer(connection)
 
         self.verbosity = int(options['verbosity'])
         self.ocl_api_token = options['token']
         if options['ocl_api_env']:
             self.ocl_api_env = options['ocl_api_env'].lower()
 
-        # Option debug output
-        if self.verbosity >= 2:
-            print 'COMMAND LINE OPTIONS:', options
-
-        # Validate the options
-        #self.validate_options()
+    def process(self):
+        """ Loads the input files and runs the syncs requested by the command line options """
 
         # Load the concepts and mapping file into memory
         # NOTE: This will only work if it can fit into memory -- explore streaming partial loads
@@ -137,20 +313,125 @@ class Command(BaseCommand):
         sources=[]
         classes=[]
         conv_ids = {}
-        if self.concept_filename:
-            for line in open(self.concept_filename, 'r'):
-                concepts.append(json.loads(line))
-        if self.mapping_filename:
-            for line in open(self.mapping_filename, 'r'):
-                mappings.append(json.loads(line))
+        with self.profiler.phase('load'):
+            if self.concept_filename:
+                for line in open(self.concept_filename, 'r'):
+                    concepts.append(json.loads(line))
+            if self.mapping_filename:
+                for line in open(self.mapping_filename, 'r'):
+                    mappings.append(json.loads(line))
+            if self.source_filename:
+                for line in open(self.source_filename, 'r'):
+                    sources.append(json.loads(line))
+            if self.class_filename:
+                for line in open(self.class_filename, 'r'):
+                    classes.append(json.loads(line))
+
+        # Initialize counters
+        self.init_counters()
+
+        # Only write the change set if the 'plan' option is set
+        if self.plan_filename:
+            self.write_plan(sources, classes, concepts, mappings)
+            return
+
+        # Only apply the change set if the 'apply' option is set
+        if self.apply_filename:
+            self.apply_plan()
+            return
+
+        # Load the concepts and mappings synced by a previous run if resuming
+        self.sync_state = None
+        self.synced_concept_ids = set()
+        self.synced_mapping_uuids = set()
+        self.concept_hashes = {}
+        if self.state_filename:
+            self.sync_state = SyncState(self.state_filename, resume=self.resume)
+            conv_ids.update(self.sync_state.load_conv_ids())
+            self.synced_concept_ids = set(conv_ids)
+            self.synced_mapping_uuids = self.sync_state.load_synced_mapping_uuids()
+            if self.upsert:
+                self.concept_hashes = self.sync_state.load_concept_hashes()
+
         if self.source_filename:
-            for line in open(self.source_filename, 'r'):
-                sources.append(json.loads(line))
+            with self.profiler.phase('sync_sources'):
+                self.sync_sources(sources)
+                self.profiler.add_records(len(sources))
         if self.class_filename:
-            for line in open(self.class_filename, 'r'):
-                classes.append(json.loads(line))
+            with self.profiler.phase('sync_classes'):
+                self.sync_classes(classes)
+                self.profiler.add_records(len(classes))
 
-        # Initialize counters
+        # Process concepts, mappings, or retirement script
+        try:
+            if self.concept_filename and self.mapping_filename:
+               self.sync_db(concepts, mappings,conv_ids)
+            if self.do_retire:
+                with self.profiler.phase('sync_retired'):
+                    if self.concept_filename and not self.mapping_filename:
+                        # Without a sync, the concepts are translated by their OCL external ID
+                        self.add_conv_ids_by_uuid(concepts, conv_ids)
+                    self.sync_retired(conv_ids)
+        finally:
+            if self.sync_state:
+                self.sync_state.close()
+        if self.resume and self.verbosity:
+            print 'Resumed sync: skipped %d concepts and %d mappings already synced' % (
+                self.cnt_concepts_skipped, self.cnt_mappings_skipped)
+        if self.upsert and self.verbosity:
+            print 'Upserted concepts: %d updated, %d unchanged' % (
+                self.cnt_concepts_updated, self.cnt_concepts_unchanged)
+        if self.do_retire and self.verbosity:
+            print 'Retired concepts: %d retired, %d already retired or missing, %d not synced' % (
+                self.cnt_concepts_retired, self.cnt_concepts_already_retired,
+                self.cnt_retired_not_synced)
+
+        # Display final counts
+        #if self.verbosity:
+         #  self.print_debug_summary()
+
+    def write_plan(self, sources, classes, concepts, mappings):
+        """ Writes the rows the sync would insert to the plan file, without writing to the database """
+        with self.profiler.phase('load_dictionary'):
+            index = self.dictionary_index or DictionaryIndex().load()
+        planner = SyncPlanner(index)
+        conv_ids = {}
+        if self.resume:
+            # The concepts synced by the failed sync translate the OCL IDs of its mappings
+            sync_state = SyncState(self.state_filename, resume=True)
+            conv_ids.update(sync_state.load_conv_ids())
+            sync_state.close()
+        with self.profiler.phase('plan'), open(self.plan_filename, 'w') as plan_file:
+            for changes in (planner.plan_sources(sources), planner.plan_classes(classes),
+                            planner.plan_concepts(concepts, conv_ids),
+                            planner.plan_mappings(mappings, conv_ids)):
+                for change in changes:
+                    plan_file.write(json.dumps(change) + '\n')
+            self.profiler.add_records(len(sources) + len(classes) + len(concepts) + len(mappings))
+        self.plan_counts = planner.counts
+        if self.verbosity:
+            print 'PLANNED CHANGES:'
+            for name, count in sorted(planner.counts.items()):
+                print '%s: %d' % (name, count)
+
+    def apply_plan(self):
+        """ Inserts the rows of the change set file in bulk, in dependency order """
+        applier = ChangeSetApplier()
+        with self.profiler.phase('load_changes'):
+            rows_by_table = applier.load(self.apply_filename)
+        with self.profiler.phase('apply'):
+            try:
+                applier.apply(rows_by_table)
+            except ChangeSetError as e:
+                raise CommandError('ERROR: %s' % e)
+            self.profiler.add_records(sum(len(rows) for rows in rows_by_table.values()))
+        if self.verbosity:
+            print 'APPLIED CHANGES:'
+            for name, count in sorted(applier.counts.items()):
+                print '%s: %d' % (name, count)
+
+    def init_counters(self):
+        """ Initializes the counters """
         self.cnt_total_concepts_processed = 0
         self.cnt_concepts_exported = 0
         self.cnt_internal_mappings_exported = 0
@@ -163,19 +444,14 @@ class Command(BaseCommand):
         self.cnt_retired_concepts_exported = 0
         self.cnt_total_sources_exported=0
         self.cnt_total_classes_exported = 0
-
-        if self.source_filename:
-            self.sync_sources(sources)
-        if self.class_filename:
-            self.sync_classes(classes)
-
-        # Process concepts, mappings, or retirement script
-        if self.concept_filename and self.mapping_filename:
-           self.sync_db(concepts, mappings,conv_ids)
-
-        # Display final counts
-        #if self.verbosity:
-         #  self.print_debug_summary()
+        self.cnt_concepts_created = 0
+        self.cnt_concepts_skipped = 0
+        self.cnt_mappings_skipped = 0
+        self.cnt_concepts_retired = 0
+        self.cnt_concepts_updated = 0
+        self.cnt_concepts_unchanged = 0
+        self.cnt_concepts_already_retired = 0
+        self.cnt_retired_not_synced = 0
 
     def validate_options(self):
         """
@@ -198,6 +474,8 @@ class Command(BaseCommand):
 
     def check_sources(self):
         """ Validates that all reference sources in OpenMRS have been defined in OCL. """
+        # Imported here, as only this option needs it and it slows down the command startup
+        import requests
         url_base = self.OCL_API_URL[self.ocl_api_env]
         headers = {'Authorization': 'Token %s' % self.ocl_api_token}
         reference_sources = ConceptReferenceSource.objects.all()
@@ -261,9 +539,14 @@ class Command(BaseCommand):
         Main loop to sync all concepts and/or their mappings.
 
         Loop thru all concepts and mappings and generates needed entries.
-        Note that the retired status of concepts is not handled here.
+        Note that the retired status of concepts is handled by sync_retired().
         """
 
+        # Sync with several processes if the 'workers' option is set
+        if self.workers > 1 and self.concept_id is None:
+            self.sync_db_parallel(concepts, mappings, conv_ids)
+            return
+
         # Create the concept enumerator, applying 'concept_id'
         if self.concept_id is not None:
             # If 'concept_id' option set, fetch a single concept and convert to enumerator
@@ -276,19 +559,234 @@ class Command(BaseCommand):
             concept_enumerator = enumerate(concepts)
 
         # Iterate concept enumerator and process the export
-        for num, concept in concept_enumerator:
-            self.cnt_total_concepts_processed += 1
-            self.sync_concept_mapping(concept,conv_ids)
-        self.sync_mappings(mappings,conv_ids)
+        with self.profiler.phase('sync_concepts'):
+            pending_concepts = []
+            for num, concept in concept_enumerator:
+                self.cnt_total_concepts_processed += 1
+                if concept['id'] in self.synced_concept_ids:
+                    self.cnt_concepts_skipped += 1
+                else:
+                    pending_concepts.append(concept)
+            for results in self.sync_concept_batches(pending_concepts, conv_ids):
+                if self.sync_state:
+                    # Concepts are recorded once their batch, names included, is committed
+                    for ocl_id, omrs_id, status, content_hash in results:
+                        self.sync_state.concept_synced(ocl_id, omrs_id, content_hash=content_hash)
+                    self.sync_state.commit()
+                self.count_concept_results(results)
+                self.profiler.add_records(len(results))
+        with self.profiler.phase('sync_mappings'):
+            self.sync_mappings(mappings,conv_ids)
+            self.profiler.add_records(len(mappings))
         #print len(conv_ids)
         #self.fn(mappings)
 
+    def sync_db_parallel(self, concepts, mappings, conv_ids):
+        """
+        Sync all concepts and then all mappings with a pool of worker processes.
+
+        Concepts are partitioned by a hash of their fully specified name and mappings by the
+        reference term or from-concept they create rows for, so that processes never create
+        conflicting duplicates. The sync state is recorded by this process as partitions complete.
+        """
+
+        # New concept IDs are allocated above all existing and incoming concept IDs
+        max_concept_id = max(Concept.objects.aggregate(Max('concept_id'))['concept_id__max'] or 0,
+                             max([concept['id'] for concept in concepts] or [0]))
+        concept_id_counter = multiprocessing.Value('l', max_concept_id)
+
+        with self.profiler.phase('sync_concepts'):
+            pending_concepts = []
+            for concept in concepts:
+                self.cnt_total_concepts_processed += 1
+                if concept['id'] in self.synced_concept_ids:
+                    self.cnt_concepts_skipped += 1
+                else:
+                    pending_concepts.append(concept)
+            partitions = partition(pending_concepts, get_fully_specified_name,
+                                   self.workers * self.PARTITIONS_PER_WORKER)
+            for results in self.run_workers(sync_concept_partition, partitions, {}, concept_id_counter):
+                for ocl_id, omrs_id, status, content_hash in results:
+                    conv_ids[ocl_id] = omrs_id
+                    self.cnt_concepts_exported += 1
+                    self.cnt_concepts_created += int(status == self.CONCEPT_CREATED)
+                    if self.sync_state:
+                        self.sync_state.concept_synced(ocl_id, omrs_id, commit=status == self.CONCEPT_CREATED,
+                                                       content_hash=content_hash)
+                self.count_concept_results(results)
+                self.profiler.add_records(len(results))
+
+        with self.profiler.phase('sync_mappings'):
+            partitions = partition(self.get_pending_mappings(mappings, conv_ids), get_mapping_partition_key,
+                                   self.workers * self.PARTITIONS_PER_WORKER)
+            for synced_uuids in self.run_workers(sync_mapping_partition, partitions, conv_ids, concept_id_counter):
+                if self.sync_state:
+                    for uuid in synced_uuids:
+                        self.sync_state.mapping_synced(uuid)
+            self.profiler.add_records(len(mappings))
+
+    def count_concept_results(self, results):
+        """ Counts the concepts updated or skipped as unchanged in a list of concept results """
+        for ocl_id, omrs_id, status, content_hash in results:
+            if status == self.CONCEPT_UPDATED:
+                self.cnt_concepts_updated += 1
+            elif status == self.CONCEPT_UNCHANGED:
+                self.cnt_concepts_unchanged += 1
+
+    def run_workers(self, function, partitions, conv_ids, concept_id_counter):
+        """
+        Runs a worker function on each partition in a pool of worker processes and yields the
+        results as partitions complete. The database connections are closed first, so that each
+        process opens its own.
+        """
+        close_connections()
+        pool = multiprocessing.Pool(self.workers, initializer=init_worker,
+                                    initargs=(self.options, conv_ids, concept_id_counter,
+                                              self.concept_hashes))
+        try:
+            for result in pool.imap_unordered(function, partitions):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def allocate_concept_id(self):
+        """ Returns a new concept ID that is not used in OpenMRS """
+        if self.concept_id_counter is not None:
+            # Parallel sync: IDs are allocated from the counter shared by all processes
+            with self.concept_id_counter.get_lock():
+                self.concept_id_counter.value += 1
+                return self.concept_id_counter.value
+        cconc=Concept.objects.aggregate(Max('concept_id'))
+        return cconc['concept_id__max']+1
+
 
 
 
 
     ## CONCEPT and MAPPINGS sync to DB
 
+    def sync_concept_batches(self, concepts, conv_ids):
+        """
+        Sync concepts in batches, each in one transaction with the names, descriptions and
+        numeric ranges of its concepts. Yields the list of (OCL concept ID, OpenMRS concept ID,
+        status, content hash) tuples of each batch once it is committed (see sync_concept_batch).
+        """
+        self.concept_details = ConceptDetailWriter()
+        for batch in iterate_batches(concepts, self.CONCEPT_BATCH_SIZE):
+            counters = (self.cnt_concepts_exported, self.cnt_concepts_created)
+            for attempt in range(self.BATCH_ATTEMPTS):
+                try:
+                    with transaction.atomic():
+                        results = self.sync_concept_batch(batch, conv_ids)
+                    break
+                except OperationalError:
+                    # The batch was rolled back, so it is safe to run it again
+                    self.cnt_concepts_exported, self.cnt_concepts_created = counters
+                    self.concept_details.clear()
+                    if self.workers <= 1 or attempt == self.BATCH_ATTEMPTS - 1:
+                        raise
+                    time.sleep(0.1 * (attempt + 1))
+            yield results
+
+    def sync_concept_batch(self, concepts, conv_ids):
+        """
+        Create a batch of concepts and then insert their missing names, descriptions and numeric
+        ranges in bulk. If the 'upsert' option is set, concepts whose content hash matches the
+        sync state are skipped and the other existing concepts are updated where they changed.
+
+        :returns: List of (OCL concept ID, OpenMRS concept ID, status, content hash) tuples, where
+            status is one of the CONCEPT_* statuses and the content hash is only set if the
+            OpenMRS concept matches the OCL content.
+        """
+        results = []
+        content_hashes = dict((concept['id'], get_content_hash(concept)) for concept in concepts)
+        unchanged_ids = self.get_unchanged_concept_ids(content_hashes) if self.upsert else {}
+        matched_concepts = []
+        for concept in concepts:
+            content_hash = content_hashes[concept['id']]
+            if concept['id'] in unchanged_ids:
+                conv_ids[concept['id']] = unchanged_ids[concept['id']]
+                results.append((concept['id'], conv_ids[concept['id']], self.CONCEPT_UNCHANGED, content_hash))
+                continue
+            cnt_concepts_created = self.cnt_concepts_created
+            self.sync_concept_mapping(concept, conv_ids)
+            if concept['id'] not in conv_ids:
+                continue
+            if self.cnt_concepts_created != cnt_concepts_created:
+                results.append((concept['id'], conv_ids[concept['id']], self.CONCEPT_CREATED, content_hash))
+            elif self.upsert:
+                matched_concepts.append((concept, conv_ids[concept['id']]))
+            else:
+                results.append((concept['id'], conv_ids[concept['id']], self.CONCEPT_MATCHED, None))
+        self.concept_details.flush()
+        if matched_concepts:
+            updated_ids = self.update_concepts(matched_concepts)
+            for concept, omrs_id in matched_concepts:
+                status = self.CONCEPT_UPDATED if omrs_id in updated_ids else self.CONCEPT_UNCHANGED
+                results.append((concept['id'], omrs_id, status, content_hashes[concept['id']]))
+        return results
+
+    def get_unchanged_concept_ids(self, content_hashes):
+        """
+        Returns a dictionary of OCL concept IDs to OpenMRS concept IDs for the concepts whose
+        content hash matches the one recorded by a previous sync and whose OpenMRS concept still
+        exists, checked with one query.
+        """
+        candidates = {}
+        for ocl_id, content_hash in content_hashes.items():
+            if ocl_id in self.concept_hashes and self.concept_hashes[ocl_id][1] == content_hash:
+                candidates[ocl_id] = self.concept_hashes[ocl_id][0]
+        if not candidates:
+            return {}
+        existing_ids = set(Concept.objects.filter(concept_id__in=set(candidates.values())).values_list(
+            'concept_id', flat=True))
+        return dict((ocl_id, omrs_id) for ocl_id, omrs_id in candidates.items() if omrs_id in existing_ids)
+
+    def update_concepts(self, matched_concepts):
+        """
+        Update the class, datatype, retired status and is_set of existing concepts where they
+        differ from OCL. The existing rows are loaded with one query and the changed concepts are
+        updated with one UPDATE statement per distinct set of new values.
+
+        :param matched_concepts: List of (OCL-formatted concept, OpenMRS concept ID) tuples.
+        :returns: Set of the OpenMRS concept IDs that were updated.
+        """
+        if not hasattr(self, 'class_ids'):
+            self.class_ids = dict((name.lower(), class_id) for class_id, name in
+                                  ConceptClass.objects.values_list('concept_class_id', 'name'))
+            self.datatype_ids = dict((name.lower(), datatype_id) for datatype_id, name in
+                                     ConceptDatatype.objects.values_list('concept_datatype_id', 'name'))
+        existing_concepts = Concept.objects.in_bulk(set(omrs_id for concept, omrs_id in matched_concepts))
+
+        # Group the changed concepts by their new values
+        updates = {}
+        for concept, omrs_id in matched_concepts:
+            existing = existing_concepts[omrs_id]
+            values = (self.class_ids[concept['concept_class'].lower()],
+                      self.datatype_ids[concept['datatype'].lower()],
+                      bool(concept['retired']),
+                      int(concept['extras'].get('is_set', 0) if concept.get('extras') else 0))
+            if values != (existing.concept_class_id, existing.datatype_id, bool(existing.retired),
+                          existing.is_set):
+                retired_changed = values[2] != bool(existing.retired)
+                updates.setdefault(values + (retired_changed,), set()).add(omrs_id)
+
+        now = datetime.datetime.now()
+        for (class_id, datatype_id, retired, is_set, retired_changed), omrs_ids in updates.items():
+            fields = dict(concept_class=class_id, datatype=datatype_id, retired=retired, is_set=is_set,
+                          changed_by=self.SYNC_USER_ID, date_changed=now)
+            if retired_changed and retired:
+                fields.update(retired_by=self.SYNC_USER_ID, date_retired=now,
+                              retire_reason='Retired in OCL')
+            elif retired_changed:
+                fields.update(retired_by=None, date_retired=None, retire_reason=None)
+            Concept.objects.filter(concept_id__in=omrs_ids).update(**fields)
+        return set(omrs_id for omrs_ids in updates.values() for omrs_id in omrs_ids)
+
     def sync_concept_mapping(self, concept,conv_ids):
         """
         Create one concept and its mappings.
@@ -334,7 +832,8 @@ class Command(BaseCommand):
 
 
             for cname in cnames:
-                    concept_name = ConceptName.objects.filter(name=cname['name'],concept_name_type=cname['name_type'],locale=cname['locale'],locale_preferred=cname['locale_preferred'])
+                    concept_name = list(ConceptName.objects.filter(name=cname['name'],concept_name_type=cname['name_type'],locale=cname['locale'],locale_preferred=cname['locale_preferred']))
+                    concept_name += self.concept_details.get_pending_names(cname)
                     if len(concept_name) != 0:
                         at_lst_one=1 #at least one concept present
                         if len(concept_name)>1:
@@ -364,167 +863,372 @@ class Command(BaseCommand):
                 conc = Concept.objects.filter(concept_id=id)
                 if len(conc)!=0:# that id exists
                     #generate new id that is not in openmrs
-                    cconc=Concept.objects.aggregate(Max('concept_id'))
-                    id=cconc['concept_id__max']+1
+                    id=self.allocate_concept_id()
 
                 conc = Concept(concept_id=id, retired=concept['retired'], datatype=concept_datatype,
                                concept_class=conc_class, uuid=concept['external_id'],is_set=concept['is_set'])
                 conc.save()
+                self.cnt_concepts_created += 1
                 conv_ids[concept['id']] = id
-            #print id
-            '''for cname in cnames:
-                concept_name = ConceptName.objects.filter(name=cname['name'],concept_name_type=cname['name_type'],locale=cname['locale'],locale_preferred=cname['locale_preferred'])
-                if len(concept_name)==0:#if concept name not there
-
-                    conc = Concept.objects.get(concept_id=id)
-                    concept_name = ConceptName(concept=conc,name=cname['name'], uuid=cname['external_id'], concept_name_type=cname['name_type'], locale=cname['locale'],locale_preferred=cname['locale_preferred'])
-                    concept_name.save()
-            conc = Concept.objects.get(concept_id=id)
-            # Concept Descriptions
-
-            for cdescription in concept['descriptions']:
-                concept_description = ConceptDescription.objects.filter(concept=conc,
-                                                                                description=cdescription['description'],
-                                                                                uuid=cdescription['external_id'])
-                if len(concept_description)==0:
-                    concept_description = ConceptDescription(concept=conc,
-                                                                     description=cdescription['description'],
-                                                                     uuid=cdescription['external_id'],
-                                                                     locale=cdescription['locale'], creator=1,
-                                                                     date_created=datetime.datetime.now())
-                    concept_description.save()
-
-            extra = None
-            if concept['datatype'] == "Numeric":
-                 extra = concept['extras']
-            # If the concept is of numeric type, map concept's numeric type data as extras
-            if extra is not None:
-
-                numeric = ConceptNumeric.objects.filter(concept=id)
-                if len(numeric)==0:
-                    h_c = None
-                    l_c = None
-                    h_n = None
-                    l_n = None
-                    if 'hi_critical' in extra:
-                        h_c = extra['hi_critical']
-                    if 'low_critical' in extra:
-                        l_c = extra['low_critical']
-                    if 'hi_normal' in extra:
-                        h_n = extra['hi_normal']
-                    if 'low_normal' in extra:
-                        l_n = extra['low_normal']
-                    numeric = ConceptNumeric(concept=conc,
-                                                     hi_absolute=extra['hi_absolute'],
-                                                     hi_critical=h_c, hi_normal=h_n,low_critical=l_c,
-                                                     low_absolute=extra['low_absolute'], low_normal=l_n,
-                                                     units=extra['units'], precise=extra['precise'])
-
-
-                    numeric.save()'''
+
+            # Names, descriptions and numeric ranges are inserted in bulk when the batch is flushed
+            self.concept_details.add(concept, id)
 
 
 
 
     def sync_mappings(self,mappings,conv_ids):
+        """
+        Sync all mappings, in batches of mappings grouped by their OpenMRS from-concept.
 
-        for m in mappings:
-            s = m['from_concept_url'].split('/')
+        Each batch resolves its from and to concepts with one in_bulk query, checks for existing
+        reference terms, reference maps, answers and set members with one query per table, and
+        inserts only the missing rows with bulk_create in a single transaction.
+        """
 
-            s=int(s[6])
+        self.sync_mapping_batches(self.get_pending_mappings(mappings, conv_ids), conv_ids)
+
+    def get_pending_mappings(self, mappings, conv_ids):
+        """
+        Returns a list of (OpenMRS from-concept ID, mapping) tuples for the mappings that have not
+        been synced yet.
+        """
+        pending_mappings = []
+        for m in mappings:
+            if m['external_id'] in self.synced_mapping_uuids:
+                self.cnt_mappings_skipped += 1
+                continue
+            s = int(m['from_concept_url'].split('/')[6])
             if s:
-                id=conv_ids[s]
-                print(s)
-                self.export_concept_mappings(id, m, conv_ids)
+                pending_mappings.append((conv_ids[s], m))
+        return pending_mappings
 
+    def sync_mapping_batches(self, pending_mappings, conv_ids):
+        """
+        Sync a list of (from-concept ID, mapping) tuples in batches of from-concepts, in concept
+        order and keeping the order of the mappings of each concept.
+        """
 
-    def export_concept_mappings(self,id1,m,conv_ids):
+        # Load the map types and reference sources once
+        if not hasattr(self, 'map_types'):
+            self.map_types = dict((map_type.name, map_type) for map_type in ConceptMapType.objects.all())
+            self.reference_sources = dict((source.name, source) for source in ConceptReferenceSource.objects.all())
+
+        # Group the mappings by from-concept
+        mappings_by_concept = {}
+        for from_id, m in pending_mappings:
+            mappings_by_concept.setdefault(from_id, []).append(m)
+
+        # Sync the batches in concept order
+        for batch_ids in iterate_batches(sorted(mappings_by_concept), self.MAPPING_BATCH_SIZE):
+            batch = [(from_id, m) for from_id in batch_ids for m in mappings_by_concept[from_id]]
+            for attempt in range(self.BATCH_ATTEMPTS):
+                try:
+                    with transaction.atomic():
+                        self.sync_mapping_batch(batch, conv_ids)
+                    break
+                except OperationalError:
+                    # Parallel workers can deadlock on the same tables; the batch is atomic, so
+                    # it is safe to run it again
+                    if self.workers <= 1 or attempt == self.BATCH_ATTEMPTS - 1:
+                        raise
+                    time.sleep(0.1 * (attempt + 1))
+            if self.sync_state:
+                for from_id, m in batch:
+                    self.sync_state.mapping_synced(m['external_id'])
+
+    def sync_mapping_batch(self, batch, conv_ids):
         """
-        Generate OCL-formatted mappings for the concept, excluding set members and Q/A.
+        Create the missing reference terms, reference maps, answers and set members for a batch
+        of mappings.
 
-        Creates both internal and external mappings, based on the mapping definition.
-        :param concept: Concept with the mappings to export from OpenMRS database.
-        :returns: List of OCL-formatted mapping dictionaries for the concept.
+        :param batch: List of (OpenMRS from-concept ID, OCL-formatted mapping) tuples.
+        :param conv_ids: Dictionary of OCL concept IDs to OpenMRS concept IDs.
+        :returns: None.
         """
 
-        fromconc = Concept.objects.get(concept_id=id1)
-        #print len(conv_ids)
-        if 'to_source_url' in m:#external mapping
-            #All external mappings are OpenMRS mappings
-            map_type_id = ConceptMapType.objects.get(name=m['map_type'])
-            src=m['to_source_url'].split('/')
-            src_name=src[4]
-            #print src_name
-            src_name=OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(src_name)
-            source = ConceptReferenceSource.objects.get(name=src_name)
-            #print source.name
-            code=m['to_concept_code']
-
-            uuid_ref_term=m['ref_term']
-            uuid_ref_map = m['external_id']  # uuid of ref_map
-            # update concept_reference_term if not present
-            conc_ref_term=ConceptReferenceTerm.objects.filter(code=code,concept_source=source)
-            if len(conc_ref_term)==0:
-                conc_ref_term = ConceptReferenceTerm(concept_source=source,code=code,retired=m['retired'],uuid=uuid_ref_term)
-                conc_ref_term.save()
-                #print conc_ref_term
-            conc_ref_term = ConceptReferenceTerm.objects.get(code=code,concept_source=source)
-                #update concept_reference_map
-            conc_ref_map = ConceptReferenceMap.objects.filter(concept_reference_term=conc_ref_term,map_type=map_type_id,concept=fromconc)
-            if len(conc_ref_map)==0:
-                conc_ref_map=ConceptReferenceMap(concept=fromconc,uuid=uuid_ref_map,concept_reference_term=conc_ref_term,map_type=map_type_id)
-                conc_ref_map.save()
-                #print conc_ref_map
-        else:#internal mapping
-            s = m['to_concept_url'].split('/')
-            code = (int)(s[6])
-            if code in conv_ids:
-                toconc = Concept.objects.get(concept_id=conv_ids[code])
-                #print toconc
-
-            uuid = m['external_id']  # uuid of concept_answer
-            #Q-AND-A and set members are always internal mappings
-            if(m['map_type']=='Q-AND-A'):
-                srt_wt = (float)(m['sort_weight'])
-                ans=ConceptAnswer.objects.filter(question_concept=fromconc,answer_concept=toconc)
-                if len(ans)==0:
-                    ans=ConceptAnswer(question_concept=fromconc,answer_concept=toconc,uuid=uuid,sort_weight=srt_wt)
-                    ans.save()
-                    #print ans
-            elif m['map_type']=='CONCEPT-SET':
-                srt_wt = (float)(m['sort_weight'])
-                conc_set = ConceptSet.objects.filter(concept_set_owner=fromconc,concept=toconc)
-                if len(conc_set) == 0:
-                    conc_set = ConceptSet(concept_set_owner=fromconc, concept=toconc, uuid=uuid,sort_weight=srt_wt)
-                    conc_set.save()
-                    #print conc_set
+        # Resolve the from and to concepts of the batch in one query
+        from_ids = set(from_id for from_id, m in batch)
+        to_ids = {}
+        for from_id, m in batch:
+            if 'to_source_url' not in m:
+                code = int(m['to_concept_url'].split('/')[6])
+                if code in conv_ids:
+                    to_ids[code] = conv_ids[code]
+        concepts = Concept.objects.in_bulk(list(from_ids | set(to_ids.values())))
+        for from_id in from_ids:
+            if from_id not in concepts:
+                raise Concept.DoesNotExist('Concept %s does not exist in OpenMRS' % from_id)
+
+        # Fetch the existing rows that the mappings of the batch could match
+        existing_maps = set(ConceptReferenceMap.objects.filter(concept__in=from_ids).values_list(
+            'concept', 'concept_reference_term', 'map_type'))
+        existing_answers = set(ConceptAnswer.objects.filter(question_concept__in=from_ids).values_list(
+            'question_concept', 'answer_concept'))
+        existing_set_members = set(ConceptSet.objects.filter(concept_set_owner__in=from_ids).values_list(
+            'concept_set_owner', 'concept'))
+
+        # Sort the mappings of the batch by the kind of rows they need
+        external_mappings = []
+        internal_ref_mappings = []
+        new_answers = []
+        new_set_members = []
+        for from_id, m in batch:
+            if 'to_source_url' in m:
+                # External mapping: reference term in an external source and a reference map
+                src_name = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(m['to_source_url'].split('/')[4])
+                external_mappings.append((from_id, m, self.get_reference_source(src_name)))
+                continue
+            code = int(m['to_concept_url'].split('/')[6])
+            if m['map_type'] in (OclOpenmrsHelper.MAP_TYPE_Q_AND_A, OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET):
+                # Q-AND-A and set members are always internal mappings
+                if code not in to_ids or to_ids[code] not in concepts:
+                    if self.verbosity >= 1:
+                        print 'Skipping mapping to concept %s missing in OpenMRS: %s' % (code, m['external_id'])
+                    continue
+                key = (from_id, to_ids[code])
+                srt_wt = float(m['sort_weight'])
+                if m['map_type'] == OclOpenmrsHelper.MAP_TYPE_Q_AND_A and key not in existing_answers:
+                    existing_answers.add(key)
+                    new_answers.append(ConceptAnswer(question_concept_id=from_id, answer_concept_id=key[1],
+                                                     uuid=m['external_id'], sort_weight=srt_wt))
+                elif m['map_type'] == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET and key not in existing_set_members:
+                    existing_set_members.add(key)
+                    new_set_members.append(ConceptSet(concept_set_owner_id=from_id, concept_id=key[1],
+                                                      uuid=m['external_id'], sort_weight=srt_wt))
             else:
-                map_type_id = ConceptMapType.objects.get(name=m['map_type'])
-                src = m['to_concept_url'].split('/')
-                src_name = src[4]
-                #print src_name
-                src_name = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(src_name)
-                source = ConceptReferenceSource.objects.get(name=src_name)
-                #print source.name
-                code = (str)(code)
-
-                uuid_ref_map = m['ref_m']
-                uuid_ref_term = m['external_id']  # uuid of ref_map
-                # update concept_reference_term if not present
-                conc_ref_term = ConceptReferenceTerm.objects.filter(uuid=uuid_ref_term)
-                if len(conc_ref_term) == 0:
-                    conc_ref_term = ConceptReferenceTerm(concept_source=source, code=code, retired=m['retired'],
-                                                         uuid=uuid_ref_term)
-                    conc_ref_term.save()
-                    #print conc_ref_term
-                    conc_ref_term = ConceptReferenceTerm.objects.get(uuid=uuid_ref_term)
-                    # update concept_reference_map
-                    conc_ref_map = ConceptReferenceMap(concept=fromconc, uuid=uuid_ref_map,
-                                                       concept_reference_term=conc_ref_term, map_type=map_type_id)
-                    conc_ref_map.save()
-                    #print conc_ref_map
+                # Internal reference map: the term is identified by the mapping's external_id
+                src_name = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(m['to_concept_url'].split('/')[4])
+                internal_ref_mappings.append((from_id, m, self.get_reference_source(src_name), str(code)))
+
+        # Create the missing reference terms, then look up the IDs of all terms of the batch
+        terms = self.sync_external_terms(external_mappings)
+        new_internal_terms = self.sync_internal_terms(internal_ref_mappings)
+
+        # Create the missing reference maps
+        new_maps = []
+        for from_id, m, source in external_mappings:
+            map_type = self.get_map_type(m['map_type'])
+            term_id = terms[(source.concept_source_id, self.normalize(m['to_concept_code']))]
+            key = (from_id, term_id, map_type.concept_map_type_id)
+            if key not in existing_maps:
+                existing_maps.add(key)
+                new_maps.append(ConceptReferenceMap(concept_id=from_id, uuid=m['external_id'],
+                                                    concept_reference_term_id=key[1], map_type=map_type))
+        for from_id, m, source, code in internal_ref_mappings:
+            # Internal reference maps are only created along with a new reference term
+            if m['external_id'] in new_internal_terms:
+                new_maps.append(ConceptReferenceMap(
+                    concept_id=from_id, uuid=m['ref_m'], map_type=self.get_map_type(m['map_type']),
+                    concept_reference_term_id=new_internal_terms[m['external_id']]))
+
+        for model, instances in ((ConceptReferenceMap, new_maps), (ConceptAnswer, new_answers),
+                                 (ConceptSet, new_set_members)):
+            if instances:
+                model.objects.bulk_create(instances)
+
+    def sync_external_terms(self, external_mappings):
+        """
+        Create the missing reference terms of a batch of external mappings.
 
+        :param external_mappings: List of (from-concept ID, mapping, reference source) tuples.
+        :returns: Dictionary of (source ID, normalized code) to reference term ID for all terms
+            of the batch.
+        """
+        if not external_mappings:
+            return {}
+        source_ids = set(source.concept_source_id for from_id, m, source in external_mappings)
+        codes = set(m['to_concept_code'] for from_id, m, source in external_mappings)
+
+        def fetch_terms():
+            terms = {}
+            for term_id, source_id, code in ConceptReferenceTerm.objects.filter(
+                    concept_source__in=source_ids, code__in=codes).order_by(
+                    'concept_reference_term_id').values_list('concept_reference_term_id', 'concept_source', 'code'):
+                terms.setdefault((source_id, self.normalize(code)), term_id)
+            return terms
+
+        terms = fetch_terms()
+        new_terms = {}
+        for from_id, m, source in external_mappings:
+            key = (source.concept_source_id, self.normalize(m['to_concept_code']))
+            if key not in terms and key not in new_terms:
+                new_terms[key] = ConceptReferenceTerm(concept_source=source, code=m['to_concept_code'],
+                                                      retired=m['retired'], uuid=m['ref_term'])
+        if new_terms:
+            # Reference term IDs are assigned by the database, so fetch them again after inserting
+            ConceptReferenceTerm.objects.bulk_create(new_terms.values())
+            terms = fetch_terms()
+        return terms
+
+    def sync_internal_terms(self, internal_ref_mappings):
+        """
+        Create the missing reference terms of a batch of internal reference mappings, which are
+        identified by the mapping's external_id.
 
+        :param internal_ref_mappings: List of (from-concept ID, mapping, reference source, code) tuples.
+        :returns: Dictionary of uuid to reference term ID for the terms created.
+        """
+        if not internal_ref_mappings:
+            return {}
+        uuids = set(m['external_id'] for from_id, m, source, code in internal_ref_mappings)
+        existing_uuids = set(ConceptReferenceTerm.objects.filter(uuid__in=uuids).values_list('uuid', flat=True))
+        new_terms = {}
+        for from_id, m, source, code in internal_ref_mappings:
+            if m['external_id'] not in existing_uuids and m['external_id'] not in new_terms:
+                new_terms[m['external_id']] = ConceptReferenceTerm(concept_source=source, code=code,
+                                                                   retired=m['retired'], uuid=m['external_id'])
+        if not new_terms:
+            return {}
+        ConceptReferenceTerm.objects.bulk_create(new_terms.values())
+        return dict(ConceptReferenceTerm.objects.filter(uuid__in=new_terms.keys()).values_list(
+            'uuid', 'concept_reference_term_id'))
+
+    def add_conv_ids_by_uuid(self, concepts, conv_ids):
+        """
+        Adds the OpenMRS concept IDs of the concepts whose uuid is the external ID of an OCL
+        concept to conv_ids, for the concepts not translated yet (e.g. by a resumed sync).
 
+        :param concepts: List of OCL concepts loaded from the concept file.
+        :param conv_ids: Dictionary of OCL concept IDs to OpenMRS concept IDs.
+        :returns: None.
+        """
+        ocl_ids = dict((concept['external_id'], concept['id']) for concept in concepts
+                       if concept['id'] not in conv_ids and concept.get('external_id'))
+        for batch in iterate_batches(ocl_ids.keys(), self.RETIRE_BATCH_SIZE):
+            for uuid, omrs_id in Concept.objects.filter(uuid__in=batch).values_list('uuid', 'concept_id'):
+                conv_ids[ocl_ids[uuid]] = omrs_id
 
+    def sync_retired(self, conv_ids):
+        """
+        Retire the concepts listed in the retired concept IDs file. The file is streamed, the OCL
+        concept IDs are translated with conv_ids and the concepts are retired with one UPDATE
+        statement per batch. Concepts that are already retired keep their retirement details.
 
+        :param conv_ids: Dictionary of OCL concept IDs to OpenMRS concept IDs.
+        :returns: None.
+        """
+        def iterate_retired_ids():
+            with open(self.retired_filename, 'r') as retired_file:
+                for line in retired_file:
+                    if not line.strip():
+                        continue
+                    ocl_id = int(json.loads(line))
+                    if ocl_id not in conv_ids:
+                        if self.verbosity >= 2:
+                            print 'Skipping retired concept %s that has not been synced' % ocl_id
+                        self.cnt_retired_not_synced += 1
+                        continue
+                    yield conv_ids[ocl_id]
+
+        date_retired = datetime.datetime.now()
+        for batch in iterate_batches(iterate_retired_ids(), self.RETIRE_BATCH_SIZE):
+            batch = set(batch)
+            with transaction.atomic():
+                num_retired = Concept.objects.filter(concept_id__in=batch, retired=False).update(
+                    retired=True, retired_by=self.SYNC_USER_ID, date_retired=date_retired,
+                    retire_reason='Retired in OCL')
+            self.cnt_concepts_retired += num_retired
+            self.cnt_concepts_already_retired += len(batch) - num_retired
+            self.profiler.add_records(len(batch))
+        if self.cnt_retired_not_synced and not (self.cnt_concepts_retired or
+                                                self.cnt_concepts_already_retired):
+            raise CommandError('ERROR: None of the %d concepts in %s could be translated to OpenMRS '
+                               'concept IDs' % (self.cnt_retired_not_synced, self.retired_filename))
+
+    def get_map_type(self, name):
+        """ Returns the cached map type with the specified name """
+        if name not in self.map_types:
+            raise ConceptMapType.DoesNotExist('Map type "%s" does not exist in OpenMRS' % name)
+        return self.map_types[name]
+
+    def get_reference_source(self, name):
+        """ Returns the cached reference source with the specified name """
+        if name not in self.reference_sources:
+            raise ConceptReferenceSource.DoesNotExist('Reference source "%s" does not exist in OpenMRS' % name)
+        return self.reference_sources[name]
+
+
+
+
+## PARALLEL SYNC WORKERS
+
+# Command instance of a worker process, created by init_worker()
+worker_command = None
+worker_conv_ids = None
+
+
+def init_worker(options, conv_ids, concept_id_counter, concept_hashes):
+    """Utility function: Sets up the command instance of a worker process"""
+    global worker_command, worker_conv_ids
+    worker_command = Command()
+    worker_command.configure(options)
+    worker_command.init_counters()
+    worker_command.profiler = Profiler('sync_bahmni_db', enabled=False)
+    worker_command.sync_state = None
+    worker_command.synced_concept_ids = set()
+    worker_command.synced_mapping_uuids = set()
+    worker_command.concept_id_counter = concept_id_counter
+    worker_command.concept_hashes = concept_hashes
+    worker_conv_ids = conv_ids
+
+
+def sync_concept_partition(concepts):
+    """
+    Utility function: Syncs a partition of concepts in a worker process. Returns a list of
+    (OCL concept ID, OpenMRS concept ID, status, content hash) tuples.
+    """
+    results = []
+    for batch_results in worker_command.sync_concept_batches(concepts, {}):
+        results += batch_results
+    return results
+
+
+def sync_mapping_partition(pending_mappings):
+    """
+    Utility function: Syncs a partition of (from-concept ID, mapping) tuples in a worker process.
+    Returns the external IDs of the synced mappings.
+    """
+    worker_command.sync_mapping_batches(pending_mappings, worker_conv_ids)
+    return [m['external_id'] for from_id, m in pending_mappings]
+
+
+def get_content_hash(concept):
+    """Utility function: Returns the SHA-1 hash of the canonical JSON of an OCL-formatted concept"""
+    return hashlib.sha1(json.dumps(concept, sort_keys=True)).hexdigest()
+
+
+def partition(items, get_key, num_partitions):
+    """Utility function: Splits items into non-empty partitions by a CRC32 hash of their key"""
+    partitions = [[] for num in range(num_partitions)]
+    for item in items:
+        key = get_key(item)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        partitions[(zlib.crc32(key) & 0xffffffff) % num_partitions].append(item)
+    return [items for items in partitions if items]
+
+
+def get_fully_specified_name(concept):
+    """
+    Utility function: Returns the partition key of a concept, its lower case fully specified
+    name, so that concepts that could match the same OpenMRS concept are synced by one process
+    """
+    for cname in concept['names']:
+        if cname['name_type'] == 'FULLY_SPECIFIED':
+            return cname['name'].lower()
+    if concept['names']:
+        return concept['names'][0]['name'].lower()
+    return str(concept['id'])
+
+
+def get_mapping_partition_key(pending_mapping):
+    """
+    Utility function: Returns the partition key of a (from-concept ID, mapping) tuple. External
+    mappings are partitioned by their reference term so each term is only created once; all
+    other mappings by their from-concept.
+    """
+    from_id, m = pending_mapping
+    if 'to_source_url' in m:
+        return u'%s:%s' % (m['to_source_url'], m['to_concept_code'])
+    return str(from_id)
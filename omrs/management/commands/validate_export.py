@@ -1,6 +1,10 @@
 """
 Command to validate an OCL source version export against an OpenMRS dictionary stored in Mysql.
 
+Add the "profile" option (or set the OMRS_PROFILE environment variable) to write a JSON report
+of the queries, DB time and records/sec of each phase to stderr. Add the "progress" option to
+report the validation rate and ETA on stderr.
+
 TODO: Implement "deep" comparison for both concepts and mappings -- start with checking only active status
 
 """
@@ -9,6 +13,9 @@ from django.core.management import BaseCommand
 from optparse import make_option
 from omrs.models import (Concept, ConceptReferenceMap, ConceptAnswer, ConceptSet)
 from omrs.management.commands import OclOpenmrsHelper
+from omrs.profiling import Profiler, PROFILE_OPTIONS
+from omrs.routers import route_reads_to_replica
+from omrs.progress import ProgressReporter, PROGRESS_OPTIONS
 
 
 class Command(BaseCommand):
@@ -33,7 +40,7 @@ class Command(BaseCommand):
                     dest='ignore_retired_mappings',
                     default=False,
                     help='Retired mappings in OCL are not included in the comparison if set to True'),
-    )
+    ) + PROFILE_OPTIONS + PROGRESS_OPTIONS
 
 
     ## COMMAND LINE HANDLER AND ARGUMENT VALIDATION
@@ -48,27 +55,43 @@ class Command(BaseCommand):
         self.ocl_export_filename = options['ocl_export_filename']
         self.ignore_retired_mappings = options['ignore_retired_mappings']
         self.verbosity = int(options['verbosity'])
+        self.options = options
 
         # Option debug output
         if self.verbosity >= 2:
             print 'COMMAND LINE OPTIONS:\n', options
 
-        # Load the OCL export file into memory
-        # NOTE: This will only work if it can fit into memory -- explore streaming partial loads
-        export_text = open(self.ocl_export_filename).read()
-        loaded_json = json.loads(export_text)
-        export_text = None
-        if 'concepts' not in loaded_json:
-            loaded_json['concepts'] = []
-        if 'mappings' not in loaded_json:
-            loaded_json['mappings'] = []
+        # The validation only reads, so it reads from the replica database if there is one
+        route_reads_to_replica()
 
-        # Validate the concepts and mappings in the file
-        self.validate_export(loaded_json)
+        # Start query and timing instrumentation if the 'profile' option is set
+        self.profiler = Profiler.from_options('validate_export', options)
+        self.profiler.install()
+        try:
+            # Load the OCL export file into memory
+            # NOTE: This will only work if it can fit into memory -- explore streaming partial loads
+            with self.profiler.phase('load'):
+                export_text = open(self.ocl_export_filename).read()
+                loaded_json = json.loads(export_text)
+                export_text = None
+                if 'concepts' not in loaded_json:
+                    loaded_json['concepts'] = []
+                if 'mappings' not in loaded_json:
+                    loaded_json['mappings'] = []
+
+            # Validate the concepts and mappings in the file
+            self.validate_export(loaded_json)
+        finally:
+            self.profiler.uninstall()
+        self.profiler.emit_report()
 
     def validate_export(self, data):
-        self.validate_concepts(data)
-        self.validate_mappings(data)
+        with self.profiler.phase('validate_concepts'):
+            self.validate_concepts(data)
+            self.profiler.add_records(len(data['concepts']))
+        with self.profiler.phase('validate_mappings'):
+            self.validate_mappings(data)
+            self.profiler.add_records(len(data['mappings']))
 
     def validate_concepts(self, data):
 
@@ -91,6 +114,8 @@ class Command(BaseCommand):
 
         # Perform an ID comparison
         print '\nVALIDATING CONCEPTS:'
+        progress = ProgressReporter.from_options(
+            'validate_export', self.options, total=count_ocl, item_name='concepts')
         cnt = 0
         for c_ocl in data['concepts']:
             # Display progress bar
@@ -98,6 +123,8 @@ class Command(BaseCommand):
             if (cnt % 1000) == 1:
                 print 'Validating %s to %s of %s concepts...' % (cnt, cnt - 1 + 1000, count_ocl)
 
+            progress.update()
+
             # Do the comparison
             if c_ocl['id'] in id_comparison[self.MISSING_IN_OCL]:
                 del id_comparison[self.MISSING_IN_OCL][c_ocl['id']]
@@ -105,6 +132,8 @@ class Command(BaseCommand):
                 id_comparison[self.MISSING_IN_MYSQL][c_ocl['id']] = 0
                 if self.verbosity >= 2: print 'Concept %s exists in OCL but is missing in Mysql: %s' % (c_ocl['id'], c_ocl)
 
+        progress.finish()
+
         # Output summary of results
         print '\n\nCONCEPT VALIDATION SUMMARY:'
         print '\n%s concept IDs missing in OCL:\n' % len(id_comparison[self.MISSING_IN_OCL])
@@ -211,6 +240,8 @@ class Command(BaseCommand):
 
         # Iterate through OCL data and directly compare
         print '\nVALIDATING MAPPINGS:'
+        progress = ProgressReporter.from_options(
+            'validate_export', self.options, total=cnt_ocl_total, item_name='mappings')
         cnt = 0
         for m_ocl in data['mappings']:
 
@@ -221,6 +252,7 @@ class Command(BaseCommand):
             # Display progress info
             cnt += 1
             if (cnt % 1000) == 1: print 'Validating %s to %s of %s mappings...' % (cnt, cnt - 1 + 1000, cnt_ocl_total)
+            progress.update()
 
             # Determine the type of comparison to perform, compare, and handle results
             ocl_map_type = str(m_ocl['map_type'])
@@ -246,6 +278,8 @@ class Command(BaseCommand):
                     self.refmap_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
                     if self.verbosity >= 2: print 'Missing reference map in MySQL: %s\n' % m_ocl
 
+        progress.finish()
+
         # Display results of comparison
         print '\n\nMAPPING VALIDATION SUMMARY:'
         print '%s Q/A mapping(s) missing in OCL Export:\n' % len(self.qanda_comparison[self.MISSING_IN_OCL])
@@ -9,9 +9,48 @@
 # into your database.
 from __future__ import unicode_literals
 
+from django.conf import settings
 from django.db import models
 
 
+# Locales tried in order when choosing the display name of a concept
+DISPLAY_LOCALES = getattr(settings, 'OMRS_DISPLAY_LOCALES', ('en',))
+
+# Number of concept IDs per query when loading display names
+DISPLAY_NAME_BATCH_SIZE = 1000
+
+
+class ConceptQuerySet(models.query.QuerySet):
+    """ Concept queryset that can load the display names of its concepts in bulk """
+
+    def __init__(self, *args, **kwargs):
+        super(ConceptQuerySet, self).__init__(*args, **kwargs)
+        self._with_display_names = False
+        self._display_names_done = False
+
+    def with_display_names(self):
+        """ Returns a queryset that loads the display names of its concepts when evaluated """
+        return self._clone(_with_display_names=True)
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_with_display_names', self._with_display_names)
+        return super(ConceptQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def _fetch_all(self):
+        super(ConceptQuerySet, self)._fetch_all()
+        if self._with_display_names and not self._display_names_done:
+            load_display_names(self._result_cache)
+            self._display_names_done = True
+
+
+class ConceptManager(models.Manager):
+    def get_queryset(self):
+        return ConceptQuerySet(self.model, using=self._db)
+
+    def with_display_names(self):
+        return self.get_queryset().with_display_names()
+
+
 class Concept(models.Model):
     concept_id = models.IntegerField(primary_key=True)
     retired = models.BooleanField()
@@ -33,9 +72,20 @@ class Concept(models.Model):
     retire_reason = models.CharField(max_length=255, blank=True,null=True)
     uuid = models.CharField(unique=True, max_length=38)
 
+    objects = ConceptManager()
+
     def __unicode__(self):
-        rs = self.conceptname_set.filter(locale_preferred=True)
-        return rs[0].name
+        return self.display_name or 'Concept %s' % self.concept_id
+
+    @property
+    def display_name(self):
+        """
+        The name to display for the concept (see choose_display_name), or None if it has no
+        names. Loaded with one query unless already loaded by with_display_names().
+        """
+        if not hasattr(self, '_display_name'):
+            load_display_names([self])
+        return self._display_name
 
     class Meta:
         managed = False
@@ -390,3 +440,61 @@ class ConceptWord(models.Model):
     class Meta:
         managed = False
         db_table = 'concept_word'
+
+
+def load_display_names(concepts):
+    """
+    Sets the display name of each concept in a list, loading the names of all concepts with
+    one query per DISPLAY_NAME_BATCH_SIZE concepts.
+    """
+    concepts = [concept for concept in concepts if isinstance(concept, Concept)]
+    concept_ids = [concept.concept_id for concept in concepts]
+    names = {}
+    for start in range(0, len(concept_ids), DISPLAY_NAME_BATCH_SIZE):
+        for concept_id, name, locale, locale_preferred, name_type in ConceptName.objects.filter(
+                concept__in=concept_ids[start:start + DISPLAY_NAME_BATCH_SIZE], voided=False).order_by(
+                'concept_name_id').values_list('concept', 'name', 'locale', 'locale_preferred',
+                                               'concept_name_type'):
+            names.setdefault(concept_id, []).append((name, locale, locale_preferred, name_type))
+    for concept in concepts:
+        concept._display_name = choose_display_name(names.get(concept.concept_id, []))
+
+
+def choose_display_name(names):
+    """
+    Returns the display name from a list of (name, locale, locale_preferred, name type) tuples.
+    For each of the DISPLAY_LOCALES in order, the preferred name and then the fully specified
+    name in that locale is used; otherwise the first preferred name, fully specified name or
+    other name in any locale. Returns None if the list is empty.
+    """
+    for locale in DISPLAY_LOCALES:
+        for name, name_locale, locale_preferred, name_type in names:
+            if name_locale == locale and locale_preferred:
+                return name
+        for name, name_locale, locale_preferred, name_type in names:
+            if name_locale == locale and name_type == 'FULLY_SPECIFIED':
+                return name
+    for name, name_locale, locale_preferred, name_type in names:
+        if locale_preferred:
+            return name
+    for name, name_locale, locale_preferred, name_type in names:
+        if name_type == 'FULLY_SPECIFIED':
+            return name
+    return names[0][0] if names else None
+
+
+# Concept dictionary models in foreign key dependency order (referenced tables first)
+DICTIONARY_MODELS = (
+    ConceptClass,
+    ConceptDatatype,
+    ConceptReferenceSource,
+    ConceptMapType,
+    Concept,
+    ConceptName,
+    ConceptDescription,
+    ConceptNumeric,
+    ConceptReferenceTerm,
+    ConceptReferenceMap,
+    ConceptAnswer,
+    ConceptSet,
+)
@@ -0,0 +1,166 @@
+"""
+Pipelined raw SQL export for extract_db, used with the 'pipeline_workers' option.
+
+The serial export fetches a chunk of concepts and their child rows, builds the records, then
+serializes and writes them, so the database waits while the records are built and the CPU
+waits while the next chunk is fetched. The pipeline overlaps the three stages:
+
+- a fetch thread runs the queries of the next chunks and puts them in a bounded queue,
+- a pool of worker processes builds the records of each chunk and serializes them to JSON,
+- the command writes the serialized lines in concept_id order as the chunks complete, and
+  applies the counters and checkpoints as it does for the serial export.
+
+At most PREFETCH_CHUNKS fetched chunks wait in the queue and PENDING_CHUNKS_PER_WORKER chunks
+per worker are being built or waiting to be written, so memory stays bounded when the writer
+or the workers are slower than the database.
+"""
+from collections import deque
+import json
+import multiprocessing
+import Queue
+import signal
+import sys
+import threading
+import time
+from omrs.management.commands import close_connections
+
+
+class ExportPipeline(object):
+    """
+    Yields the serialized export lines of a SqlConceptExporter's concepts, with the rows
+    fetched in a thread and the records built in worker processes.
+    """
+
+    # Number of fetched chunks that may wait for a free worker
+    PREFETCH_CHUNKS = 2
+
+    # Number of chunks per worker that may be built or waiting to be written at the same time
+    PENDING_CHUNKS_PER_WORKER = 2
+
+    # Timeout of the blocking waits, which keeps them interruptible with Ctrl-C in Python 2
+    WAIT_SECONDS = 24 * 60 * 60
+
+    def __init__(self, exporter, workers, output_indent=None, profiler=None):
+        self.exporter = exporter
+        self.workers = workers
+        self.output_indent = output_indent
+        self.profiler = profiler
+        self.fetch_queue = Queue.Queue(self.PREFETCH_CHUNKS)
+        self.stopped = threading.Event()
+
+    def iterate_export_lines(self, concept_ids=None, concept_limit=None, after_concept_id=None):
+        """
+        Yields a (concept_id, lines, num_records, counts) tuple for each selected concept in
+        concept_id order, where lines are the JSON lines of its export records and counts the
+        counter increments of the concept (see SqlConceptExporter.build_chunk). Errors of the
+        fetch thread, e.g. a lost database connection, are raised here once the chunks fetched
+        before the error have been yielded.
+        """
+        # The workers are forked before the fetch thread starts and do not use the database
+        close_connections()
+        pool = multiprocessing.Pool(self.workers, initializer=init_worker,
+                                    initargs=(self.exporter, self.output_indent))
+        fetch_thread = threading.Thread(target=self.fetch_chunks,
+                                        args=(concept_ids, concept_limit, after_concept_id))
+        fetch_thread.daemon = True
+        fetch_thread.start()
+        try:
+            pending = deque()
+            while True:
+                chunk = self.fetch_queue.get(timeout=self.WAIT_SECONDS)
+                if chunk is None or isinstance(chunk, tuple):
+                    break
+                pending.append(pool.apply_async(build_chunk_lines, (chunk,)))
+                # Write completed chunks as soon as they are ready, and wait for the oldest
+                # chunk once the workers are PENDING_CHUNKS_PER_WORKER chunks ahead
+                while pending and (pending[0].ready() or
+                                   len(pending) >= self.workers * self.PENDING_CHUNKS_PER_WORKER):
+                    for result in self.get_built_chunk(pending.popleft()):
+                        yield result
+            while pending:
+                for result in self.get_built_chunk(pending.popleft()):
+                    yield result
+            if chunk is not None:
+                # The exception info of the fetch thread
+                raise chunk[0], chunk[1], chunk[2]
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            self.stopped.set()
+            pool.join()
+            fetch_thread.join()
+
+    ## FETCH THREAD
+
+    def fetch_chunks(self, concept_ids, concept_limit, after_concept_id):
+        """
+        Runs in the fetch thread: puts the fetched chunks in the fetch queue followed by None,
+        or the exception info if fetching fails.
+        """
+        if self.profiler:
+            # The thread has its own database connection, which the command's profiler
+            # restores when it is uninstalled
+            self.profiler.install()
+        try:
+            for concept_rows in self.exporter.iterate_concept_rows(
+                    concept_ids, concept_limit, after_concept_id):
+                if not self.put_fetched(self.exporter.fetch_chunk(concept_rows)):
+                    return
+            self.put_fetched(None)
+        except Exception:
+            self.put_fetched(sys.exc_info())
+        finally:
+            close_connections()
+
+    def put_fetched(self, item):
+        """ Puts an item in the fetch queue, waiting for space. Returns False if the export stopped """
+        while not self.stopped.is_set():
+            try:
+                self.fetch_queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    ## WRITER
+
+    def get_built_chunk(self, async_result):
+        """ Waits for a chunk to be built and returns its results """
+        results, seconds = async_result.get(self.WAIT_SECONDS)
+        if self.profiler:
+            self.profiler.add_time('serialization', seconds)
+        return results
+
+
+
+## WORKER PROCESSES
+
+# Exporter and JSON indent of a worker process, set by init_worker()
+worker_exporter = None
+worker_output_indent = None
+
+
+def init_worker(exporter, output_indent):
+    """Utility function: Sets up a worker process with the exporter that builds the records"""
+    global worker_exporter, worker_output_indent
+    # Interrupting the export stops the workers, which do not handle the interrupt themselves
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_exporter = exporter
+    worker_output_indent = output_indent
+
+
+def build_chunk_lines(chunk):
+    """
+    Utility function: Builds and serializes the export records of a fetched chunk in a worker
+    process. Returns a list of (concept_id, lines, num_records, counts) tuples and the seconds
+    it took.
+    """
+    start_time = time.time()
+    results = []
+    for concept_id, export_records, counts in worker_exporter.build_chunk(chunk):
+        lines = ''.join(json.dumps(export_data, indent=worker_output_indent) + '\n'
+                        for export_data in export_records)
+        results.append((concept_id, lines, len(export_records), counts))
+    return results, time.time() - start_time
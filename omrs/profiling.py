@@ -0,0 +1,234 @@
+"""
+Query count and timing instrumentation for the management commands.
+
+Enable it with the '--profile' option of extract_db, extract_db_sources, validate_export,
+sync_bahmni_db and snapshot_db, or for every command run by setting the OMRS_PROFILE
+environment variable:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concepts --profile > c.json
+    OMRS_PROFILE=1 manage.py validate_export --export=export.json
+
+At the end of the run a JSON report is written to stderr (or to the file named by the
+'--profile_file' option or the OMRS_PROFILE_FILE environment variable) with the queries, DB
+time, records and records/sec of each phase, the total serialization time, the slowest
+queries and the startup time of the command (from the start of manage.py to the start of the
+command).
+
+Queries are timed by a cursor wrapper installed on the database connections, which (unlike
+Django's debug cursor) does not keep every executed query in memory.
+"""
+from contextlib import contextmanager
+from optparse import make_option
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+from django.db import connections
+from django.db.backends.util import CursorWrapper
+from omrs.startup import pop_startup_seconds
+
+
+PROFILE_OPTIONS = (
+    make_option('--profile',
+                action='store_true',
+                dest='profile',
+                default=False,
+                help='Report queries, DB time and throughput per phase as JSON on stderr.'),
+    make_option('--profile_file',
+                action='store',
+                dest='profile_filename',
+                default=None,
+                help='Write the profile report to this file instead of stderr.'),
+)
+
+
+class Profiler(object):
+    """
+    Collects per-phase wall time, query counts, DB time and record counts for a command run.
+
+    A disabled profiler accepts all calls but records nothing, so commands can call it
+    unconditionally from their main loops.
+    """
+
+    # Number of slowest queries kept for the report, and the maximum length of their SQL
+    NUM_SLOWEST_QUERIES = 10
+    MAX_SQL_LENGTH = 500
+
+    def __init__(self, command_name, enabled=True, report_filename=None):
+        self.command_name = command_name
+        self.enabled = enabled
+        self.report_filename = report_filename
+        self.phases = []
+        self.phase_stats = {}
+        self.current_phase = None
+        self.timers = {}
+        self.slowest_queries = []
+        self.installed_connections = []
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.startup_seconds = pop_startup_seconds()
+
+    @classmethod
+    def from_options(cls, command_name, options):
+        """ Returns a profiler that is enabled by the command options or the environment """
+        enabled = bool(options.get('profile') or os.environ.get('OMRS_PROFILE'))
+        report_filename = options.get('profile_filename') or os.environ.get('OMRS_PROFILE_FILE')
+        return cls(command_name, enabled=enabled or bool(options.get('profile_filename')),
+                   report_filename=report_filename)
+
+    ## QUERY INSTRUMENTATION
+
+    def install(self, connection=None):
+        """
+        Starts timing the queries of the specified connection, or of all connections of the
+        current thread if none is specified.
+        """
+        if not self.enabled:
+            return
+        for conn in ([connection] if connection is not None else connections.all()):
+            # Keep any cursor factory installed by an outer profiler, e.g. the benchmark command
+            previous = (conn.use_debug_cursor, conn.__dict__.get('make_debug_cursor'))
+            conn.use_debug_cursor = True
+            conn.make_debug_cursor = self.make_cursor_factory(conn)
+            self.installed_connections.append((conn, previous))
+
+    def uninstall(self):
+        """ Restores the regular cursors of all instrumented connections """
+        for conn, (use_debug_cursor, make_debug_cursor) in reversed(self.installed_connections):
+            conn.use_debug_cursor = use_debug_cursor
+            if make_debug_cursor is None:
+                del conn.make_debug_cursor
+            else:
+                conn.make_debug_cursor = make_debug_cursor
+        self.installed_connections = []
+
+    def make_cursor_factory(self, conn):
+        """ Returns a make_debug_cursor replacement that wraps cursors in a ProfilingCursor """
+        def make_debug_cursor(cursor):
+            return ProfilingCursor(cursor, conn, self)
+        return make_debug_cursor
+
+    def record_query(self, sql, duration, num_executions=1):
+        """ Adds an executed query to the current phase and the slowest query list """
+        with self.lock:
+            stats = self.get_phase_stats()
+            stats['queries'] += num_executions
+            stats['db_seconds'] += duration
+            entry = (duration, sql[:self.MAX_SQL_LENGTH], self.current_phase)
+            if len(self.slowest_queries) < self.NUM_SLOWEST_QUERIES:
+                heapq.heappush(self.slowest_queries, entry)
+            elif duration > self.slowest_queries[0][0]:
+                heapq.heapreplace(self.slowest_queries, entry)
+
+    ## PHASES, TIMERS AND RECORDS
+
+    @contextmanager
+    def phase(self, name):
+        """ Context manager that attributes the enclosed queries and records to a named phase """
+        previous_phase = self.current_phase
+        self.current_phase = name
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.get_phase_stats()['seconds'] += time.time() - start_time
+            self.current_phase = previous_phase
+
+    def get_phase_stats(self):
+        """ Returns the statistics of the current phase, creating them if necessary """
+        name = self.current_phase or 'other'
+        if name not in self.phase_stats:
+            self.phases.append(name)
+            self.phase_stats[name] = {'seconds': 0.0, 'queries': 0, 'db_seconds': 0.0,
+                                      'records': 0}
+        return self.phase_stats[name]
+
+    def add_records(self, num_records):
+        """ Adds records processed in the current phase, used for records/sec """
+        if self.enabled:
+            self.get_phase_stats()['records'] += num_records
+
+    def add_time(self, timer_name, seconds):
+        """ Adds elapsed time to a named timer, e.g. 'serialization' """
+        if self.enabled:
+            self.timers[timer_name] = self.timers.get(timer_name, 0.0) + seconds
+
+    ## REPORT
+
+    def get_report(self):
+        """ Returns the profile of the run as a dictionary """
+        total_seconds = time.time() - self.start_time
+        phases = []
+        for name in self.phases:
+            stats = self.phase_stats[name]
+            phases.append({
+                'phase': name,
+                'seconds': round(stats['seconds'], 3),
+                'queries': stats['queries'],
+                'db_seconds': round(stats['db_seconds'], 3),
+                'records': stats['records'],
+                'records_per_second': rate(stats['records'], stats['seconds']),
+            })
+        total_records = sum(stats['records'] for stats in self.phase_stats.values())
+        return {
+            'command': self.command_name,
+            'seconds': round(total_seconds, 3),
+            'startup_seconds': round(self.startup_seconds, 3) if self.startup_seconds is not None else None,
+            'queries': sum(stats['queries'] for stats in self.phase_stats.values()),
+            'db_seconds': round(sum(stats['db_seconds'] for stats in self.phase_stats.values()), 3),
+            'serialization_seconds': round(self.timers.get('serialization', 0.0), 3),
+            'timers': dict((name, round(seconds, 3)) for name, seconds in self.timers.items()),
+            'records': total_records,
+            'records_per_second': rate(total_records, total_seconds),
+            'phases': phases,
+            'slowest_queries': [
+                {'seconds': round(duration, 4), 'phase': phase, 'sql': sql}
+                for duration, sql, phase in sorted(self.slowest_queries, reverse=True)],
+        }
+
+    def emit_report(self):
+        """ Writes the JSON report to the report file or stderr, if profiling is enabled """
+        if not self.enabled:
+            return
+        report = json.dumps(self.get_report(), indent=4, sort_keys=True)
+        if self.report_filename:
+            with open(self.report_filename, 'w') as report_file:
+                report_file.write(report + '\n')
+        else:
+            sys.stderr.write(report + '\n')
+
+
+
+class ProfilingCursor(CursorWrapper):
+    """ Cursor wrapper that reports the duration of every query to a Profiler """
+
+    def __init__(self, cursor, db, profiler):
+        super(ProfilingCursor, self).__init__(cursor, db)
+        self.profiler = profiler
+
+    def execute(self, sql, params=None):
+        start_time = time.time()
+        try:
+            return super(ProfilingCursor, self).execute(sql, params)
+        finally:
+            self.profiler.record_query(sql, time.time() - start_time)
+
+    def executemany(self, sql, param_list):
+        start_time = time.time()
+        try:
+            return super(ProfilingCursor, self).executemany(sql, param_list)
+        finally:
+            self.profiler.record_query(sql, time.time() - start_time, len(param_list or []))
+
+
+
+## HELPER METHODS
+
+def rate(count, seconds):
+    """Utility function: Returns count per second rounded for display, or None if no time"""
+    if not seconds:
+        return None
+    return round(count / seconds, 1)
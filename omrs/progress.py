@@ -0,0 +1,157 @@
+"""
+Progress reporting and checkpoint state files for long-running management commands.
+
+ProgressReporter periodically writes a single status line to stderr with the number of items
+processed, the throughput of named counts (e.g. concepts/sec and mappings/sec) and an ETA
+based on the expected total, so that operators can tell a stuck run from a slow one:
+
+    [extract_db] 12000 of 55000 concepts (21.8%) | 215.3 concepts/s, 640.2 mappings/s | elapsed 0:00:55 | ETA 0:03:20
+
+CheckpointWriter periodically writes the state of a run (e.g. the last concept ID emitted and
+the export counters) to a JSON state file. The file is replaced atomically, so it always holds
+a complete checkpoint even if the process is killed while writing it.
+"""
+from optparse import make_option
+import datetime
+import json
+import os
+import sys
+import time
+
+
+PROGRESS_OPTIONS = (
+    make_option('--progress',
+                action='store_true',
+                dest='progress',
+                default=False,
+                help='Report progress, throughput and ETA on stderr.'),
+    make_option('--progress_interval',
+                action='store',
+                dest='progress_interval',
+                default=10,
+                help='Number of seconds between progress lines (default 10).'),
+)
+
+
+class ProgressReporter(object):
+    """ Writes the progress, throughput and ETA of a command to stderr at a fixed interval """
+
+    def __init__(self, label, total=None, item_name='items', get_counts=None, interval=10.0,
+                 enabled=True, stream=None):
+        """
+        :param label: Name shown at the start of each progress line, e.g. the command name.
+        :param total: Expected number of items, used for the percentage and ETA if known.
+        :param item_name: Plural name of the items passed to update(), e.g. 'concepts'.
+        :param get_counts: Optional callable returning a dictionary of cumulative named counts
+            (e.g. {'mappings': 1234}) whose rates are also reported.
+        :param interval: Minimum number of seconds between progress lines.
+        """
+        self.label = label
+        self.total = total
+        self.item_name = item_name
+        self.get_counts = get_counts
+        self.interval = interval
+        self.enabled = enabled
+        self.stream = stream or sys.stderr
+        self.num_items = 0
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+        self.initial_counts = {}
+
+    @classmethod
+    def from_options(cls, label, options, **kwargs):
+        """ Returns a progress reporter that is enabled by the 'progress' command option """
+        return cls(label, enabled=bool(options.get('progress')),
+                   interval=float(options.get('progress_interval') or 10), **kwargs)
+
+    def start(self):
+        """
+        Restarts the clock and the item count. Rates of named counts are reported relative to
+        their values at this point, e.g. excluding the counts restored from a checkpoint.
+        """
+        self.num_items = 0
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+        self.initial_counts = self.get_counts() if self.get_counts else {}
+
+    def update(self, num_items=1):
+        """ Adds processed items and writes a progress line if the interval has elapsed """
+        self.num_items += num_items
+        if self.enabled:
+            now = time.time()
+            if now - self.last_report_time >= self.interval:
+                self.report(now)
+
+    def report(self, now=None, finished=False):
+        """ Writes a progress line to the stream """
+        now = now or time.time()
+        self.last_report_time = now
+        elapsed = now - self.start_time
+        if self.total:
+            position = '%d of %d %s (%.1f%%)' % (
+                self.num_items, self.total, self.item_name,
+                100.0 * self.num_items / self.total)
+        else:
+            position = '%d %s' % (self.num_items, self.item_name)
+        rates = [(self.item_name, self.num_items)]
+        if self.get_counts:
+            rates += sorted((name, count - self.initial_counts.get(name, 0))
+                            for name, count in self.get_counts().items())
+        parts = [
+            position,
+            ', '.join('%.1f %s/s' % (count / elapsed if elapsed else 0.0, name)
+                      for name, count in rates),
+            'elapsed %s' % format_duration(elapsed),
+        ]
+        if finished:
+            parts.append('done')
+        elif self.total and self.num_items:
+            remaining = max(self.total - self.num_items, 0)
+            parts.append('ETA %s' % format_duration(remaining * elapsed / self.num_items))
+        self.stream.write('[%s] %s\n' % (self.label, ' | '.join(parts)))
+        self.stream.flush()
+
+    def finish(self):
+        """ Writes a final progress line """
+        if self.enabled:
+            self.report(finished=True)
+
+
+class CheckpointWriter(object):
+    """ Writes the state of a run to a JSON state file at a fixed interval """
+
+    def __init__(self, filename, interval=30.0):
+        self.filename = filename
+        self.interval = interval
+        self.last_write_time = time.time()
+
+    def is_due(self):
+        """ Returns True if the checkpoint interval has elapsed since the last write """
+        return bool(self.filename) and time.time() - self.last_write_time >= self.interval
+
+    def write(self, state):
+        """
+        Writes the state dictionary to the state file, replacing it atomically. A timestamp
+        is added as 'updated'.
+        """
+        if not self.filename:
+            return
+        state = dict(state, updated=datetime.datetime.now().isoformat())
+        temp_filename = '%s.tmp' % self.filename
+        with open(temp_filename, 'w') as state_file:
+            json.dump(state, state_file, indent=4, sort_keys=True)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.rename(temp_filename, self.filename)
+        self.last_write_time = time.time()
+
+
+def read_checkpoint(filename):
+    """ Returns the state dictionary stored in a checkpoint state file """
+    with open(filename) as state_file:
+        return json.load(state_file)
+
+
+def format_duration(seconds):
+    """Utility function: Formats a number of seconds as H:MM:SS"""
+    return str(datetime.timedelta(seconds=int(seconds)))
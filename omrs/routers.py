@@ -0,0 +1,52 @@
+"""
+Database router that sends the reads of the export and validation commands to a read replica.
+
+extract_db, extract_db_sources and validate_export only read the concept dictionary, so they
+call route_reads_to_replica() when they start. From then on every query of the process without
+an explicit database alias reads from the "replica" alias, if it is configured (see
+OMRS_REPLICA_DB_HOST in omrs/settings.py), and heavy exports do not compete with clinical
+traffic on the primary. Writes, and all queries of commands that write (e.g. sync_bahmni_db),
+use the "default" alias.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+REPLICA_DATABASE = 'replica'
+
+
+class ReplicaRouter(object):
+    """ Routes reads to the read database chosen by route_reads_to_replica(), if any """
+
+    # Alias that reads are routed to, or None to use the default alias
+    read_database = None
+
+    def db_for_read(self, model, **hints):
+        return self.read_database
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica has the same rows as the primary
+        return True
+
+    def allow_syncdb(self, db, model):
+        if db == REPLICA_DATABASE:
+            return False
+        return None
+
+
+def route_reads_to_replica():
+    """
+    Utility function: Sends all reads of this process to the replica database alias, if it is
+    configured. Returns the alias that reads are routed to.
+    """
+    if REPLICA_DATABASE in settings.DATABASES:
+        ReplicaRouter.read_database = REPLICA_DATABASE
+    return ReplicaRouter.read_database or DEFAULT_DB_ALIAS
+
+
+def route_reads_to_primary():
+    """Utility function: Sends all reads of this process to the default database alias again"""
+    ReplicaRouter.read_database = None
@@ -0,0 +1,126 @@
+"""
+DDL for the concept dictionary tables, used to create local copies of the dictionary (the
+synthetic benchmark dictionary and the snapshot_db snapshot).
+
+The models are unmanaged, so Django only generates their tables and the indexes of their
+foreign keys and unique columns. LOOKUP_INDEXES adds the composite indexes that the export,
+validation and sync lookups filter on.
+
+get_index_columns() and get_table_row_estimate() introspect a database's existing indexes and
+table sizes for the ensure_indexes command and the admin.
+"""
+from collections import namedtuple
+from django.core.management.color import no_style
+from omrs.models import DICTIONARY_MODELS
+
+
+LookupIndex = namedtuple('LookupIndex', ['name', 'table', 'columns', 'used_by'])
+
+# Composite indexes for the name, code, answer and set member lookups
+LOOKUP_INDEXES = (
+    LookupIndex('omrs_concept_name_lookup', 'concept_name', ('name', 'locale', 'concept_name_type'),
+                'sync_bahmni_db name matching'),
+    LookupIndex('omrs_concept_reference_term_lookup', 'concept_reference_term', ('code', 'concept_source_id'),
+                'sync_bahmni_db reference term matching'),
+    LookupIndex('omrs_concept_answer_lookup', 'concept_answer', ('concept_id', 'answer_concept'),
+                'validate_export and sync_bahmni_db answer lookups'),
+    LookupIndex('omrs_concept_set_lookup', 'concept_set', ('concept_set', 'concept_id'),
+                'validate_export and sync_bahmni_db set member lookups'),
+)
+
+
+def create_dictionary_tables(connection, models=DICTIONARY_MODELS):
+    """Utility function: Creates the tables of the dictionary models, without their indexes"""
+    style = no_style()
+    cursor = connection.cursor()
+    seen_models = set()
+    for model in models:
+        # The models are unmanaged, so Django only generates their DDL when told otherwise
+        model._meta.managed = True
+        try:
+            statements, pending_references = connection.creation.sql_create_model(
+                model, style, seen_models)
+        finally:
+            model._meta.managed = False
+        seen_models.add(model)
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def create_dictionary_indexes(connection, models=DICTIONARY_MODELS, lookup_indexes=LOOKUP_INDEXES):
+    """
+    Utility function: Creates the foreign key and unique column indexes of the dictionary
+    models and the lookup indexes, e.g. after the tables were loaded in bulk
+    """
+    style = no_style()
+    cursor = connection.cursor()
+    for model in models:
+        model._meta.managed = True
+        try:
+            statements = connection.creation.sql_indexes_for_model(model, style)
+        finally:
+            model._meta.managed = False
+        for statement in statements:
+            cursor.execute(statement)
+    tables = set(model._meta.db_table for model in models)
+    for index in lookup_indexes:
+        if index.table in tables:
+            cursor.execute(get_create_index_sql(connection, index))
+
+
+def get_create_index_sql(connection, index):
+    """Utility function: Returns the CREATE INDEX statement of a lookup index"""
+    quote_name = connection.ops.quote_name
+    return 'CREATE INDEX %s ON %s (%s)' % (
+        quote_name(index.name), quote_name(index.table),
+        ', '.join(quote_name(column) for column in index.columns))
+
+
+def get_index_columns(connection, table):
+    """
+    Utility function: Returns the column tuples of the existing indexes of a table (MySQL and
+    SQLite), including the primary key and unique indexes
+    """
+    cursor = connection.cursor()
+    if connection.vendor == 'mysql':
+        cursor.execute(
+            'SELECT index_name, column_name FROM information_schema.statistics '
+            'WHERE table_schema = DATABASE() AND table_name = %s ORDER BY index_name, seq_in_index',
+            [table])
+        indexes = {}
+        for index_name, column_name in cursor.fetchall():
+            indexes.setdefault(index_name, []).append(column_name)
+        return [tuple(columns) for columns in indexes.values()]
+    elif connection.vendor == 'sqlite':
+        quote_name = connection.ops.quote_name
+        cursor.execute('PRAGMA index_list(%s)' % quote_name(table))
+        index_names = [row[1] for row in cursor.fetchall()]
+        index_columns = []
+        for index_name in index_names:
+            cursor.execute('PRAGMA index_info(%s)' % quote_name(index_name))
+            index_columns.append(tuple(row[2] for row in sorted(cursor.fetchall())))
+        # A single-column integer primary key is the rowid, which is not listed as an index
+        cursor.execute('PRAGMA table_info(%s)' % quote_name(table))
+        for cid, name, column_type, notnull, default, pk in cursor.fetchall():
+            if pk:
+                index_columns.append((name,))
+        return index_columns
+    raise NotImplementedError('Index introspection is not supported for %s' % connection.vendor)
+
+
+def get_table_row_estimate(connection, table):
+    """
+    Utility function: Returns the row count estimate of a table from the database statistics
+    (MySQL and PostgreSQL), or None if the database does not keep one.
+    """
+    if connection.vendor == 'mysql':
+        sql = ('SELECT table_rows FROM information_schema.tables '
+               'WHERE table_schema = DATABASE() AND table_name = %s')
+    elif connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE relname = %s'
+    else:
+        return None
+    cursor = connection.cursor()
+    cursor.execute(sql, [table])
+    row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
@@ -40,17 +40,50 @@ ROOT_URLCONF = 'omrs.urls'
 
 WSGI_APPLICATION = 'omrs.wsgi.application'
 
-DATABASES = {
-    'default': {
+# The database settings can be set with environment variables (OMRS_DB_NAME, OMRS_DB_USER,
+# OMRS_DB_PASSWORD, OMRS_DB_HOST and OMRS_DB_PORT). Set OMRS_REPLICA_DB_HOST (and optionally
+# the other OMRS_REPLICA_DB_* variables, which default to the primary's) to add a "replica"
+# alias that the export and validation commands read from (see omrs/routers.py).
+def get_mysql_database(prefix, defaults):
+    """ Returns the settings of a MySQL database alias from environment variables """
+    database = dict((key, os.environ.get('%s_%s' % (prefix, key), value))
+                    for key, value in defaults.items())
+    net_timeout = int(os.environ.get('OMRS_DB_NET_TIMEOUT', 3600))
+    database.update({
         'ENGINE': 'django.db.backends.mysql',
+        # Keep connections open between the requests of the HTTP views
+        'CONN_MAX_AGE': int(os.environ.get('OMRS_DB_CONN_MAX_AGE', 300)),
+        'OPTIONS': {
+            # Compress the large result sets of the exports
+            'compress': os.environ.get('OMRS_DB_COMPRESS', '1') == '1',
+            'connect_timeout': 10,
+            # Full dictionary exports read slowly from long-running queries
+            'init_command': 'SET SESSION net_read_timeout = %d, net_write_timeout = %d' % (
+                net_timeout, net_timeout),
+        },
+    })
+    return database
+
+DATABASES = {
+    'default': get_mysql_database('OMRS_DB', {
         #'NAME': 'openmrs_20150824',
         'NAME': 'openmrs',
         'USER': 'admin',
         'PASSWORD': 'admin',
         'HOST': '192.168.33.10',
         'PORT': '3306',
-    }
+    }),
+    # Local SQLite copy of the concept dictionary, written by the snapshot_db command
+    'snapshot': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('OMRS_SNAPSHOT_DB', os.path.join(BASE_DIR, 'snapshot.sqlite3')),
+    },
 }
+if os.environ.get('OMRS_REPLICA_DB_HOST'):
+    DATABASES['replica'] = get_mysql_database('OMRS_REPLICA_DB', dict(
+        (key, DATABASES['default'][key]) for key in ('NAME', 'USER', 'PASSWORD', 'HOST', 'PORT')))
+
+DATABASE_ROUTERS = ['omrs.routers.ReplicaRouter']
 
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'UTC'
@@ -0,0 +1,16 @@
+"""
+Django settings for running the benchmark command against a local SQLite database.
+
+    manage.py benchmark --settings=omrs.settings_benchmark --create_schema --generate
+
+Set OMRS_BENCHMARK_DB to choose the SQLite file. To benchmark against a local MySQL
+instead, point the regular settings at an empty local database.
+"""
+from omrs.settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('OMRS_BENCHMARK_DB', os.path.join(BASE_DIR, 'benchmark.sqlite3')),
+    }
+}
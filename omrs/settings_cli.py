@@ -0,0 +1,16 @@
+"""
+Minimal Django settings for the management commands of this project, which manage.py uses
+for them by default (see CLI_COMMANDS in manage.py).
+
+The commands only use the omrs models, so the admin, auth, sessions, messages and staticfiles
+apps and their middleware are not loaded, which makes every command start faster. Use
+"--settings=omrs.settings" to run a command with the full settings.
+"""
+from omrs.settings import *
+
+INSTALLED_APPS = (
+    'django.contrib.contenttypes',
+    'omrs',
+)
+
+MIDDLEWARE_CLASSES = ()
@@ -0,0 +1,15 @@
+"""
+Django settings for running the commands against a local snapshot of the concept dictionary
+written by the snapshot_db command, instead of the OpenMRS database:
+
+    manage.py snapshot_db
+    manage.py extract_db --settings=omrs.settings_snapshot --org_id=CIEL --source_id=CIEL --raw --concepts
+
+Set OMRS_SNAPSHOT_DB to choose the SQLite file.
+"""
+from omrs.settings import *
+
+DATABASES = dict(DATABASES, default=DATABASES['snapshot'])
+
+# Reads must not be routed to the replica of the OpenMRS database
+DATABASES.pop('replica', None)
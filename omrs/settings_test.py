@@ -0,0 +1,17 @@
+"""
+Django settings for running the tests against a SQLite database:
+
+    manage.py test omrs --settings=omrs.settings_test --noinput
+
+The test database is a file rather than in memory, so that the fetch thread of the pipelined
+export reads the same dictionary as the test.
+"""
+from omrs.settings_cli import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'test.sqlite3'),
+        'TEST_NAME': os.path.join(BASE_DIR, 'test.sqlite3'),
+    }
+}
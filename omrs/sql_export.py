@@ -0,0 +1,293 @@
+"""
+Raw SQL engine for the extract_db concept, mapping and retired concept ID export.
+
+The ORM export builds full Concept, ConceptName, etc. model instances for every row, which
+costs a lot of CPU for the full dictionary. This engine runs a handful of hand-written queries
+per chunk of concepts and assembles the OCL-formatted dictionaries directly from the returned
+tuples. Its records are equivalent to those of the ORM export: the same keys and values, which
+may be serialized in a different key order. This can be verified with:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --concepts --mappings --compare_engines
+
+"""
+from collections import namedtuple
+from django.db import connections, router
+from omrs.management.commands import OclOpenmrsHelper, increment, iterate_batches
+from omrs.models import Concept
+
+
+# Stand-in for a Concept model instance; the mapping generators only need concept_id
+ConceptRow = namedtuple('ConceptRow', 'concept_id concept_class datatype uuid retired is_set')
+
+
+class SqlConceptExporter(object):
+    """
+    Builds extract_db export records from raw SQL rows, one chunk of concepts at a time.
+
+    The owning extract_db command supplies the export options (org_id, source_id, do_concept,
+    do_mapping, do_retire) and the mapping dictionary generators, so both engines share them.
+    """
+
+    SQL_CONCEPTS = (
+        'SELECT c.concept_id, cc.name, cd.name, c.uuid, c.retired, c.is_set '
+        'FROM concept c '
+        'INNER JOIN concept_class cc ON cc.concept_class_id = c.class_id '
+        'INNER JOIN concept_datatype cd ON cd.concept_datatype_id = c.datatype_id ')
+    SQL_NAMES = (
+        'SELECT concept_id, name, concept_name_type, locale, locale_preferred, uuid '
+        'FROM concept_name '
+        'WHERE voided = 0 AND concept_id IN (%s) '
+        'ORDER BY concept_id, concept_name_id')
+    SQL_DESCRIPTIONS = (
+        'SELECT concept_id, description, locale, uuid '
+        'FROM concept_description '
+        'WHERE concept_id IN (%s) '
+        'ORDER BY concept_id, concept_description_id')
+    SQL_NUMERICS = (
+        'SELECT concept_id, hi_absolute, hi_critical, hi_normal, low_absolute, low_critical, '
+        'low_normal, units, precise, display_precision '
+        'FROM concept_numeric '
+        'WHERE concept_id IN (%s)')
+    SQL_REFERENCE_MAPS = (
+        'SELECT m.concept_id, m.uuid, mt.name, t.code, t.name, t.uuid, s.name '
+        'FROM concept_reference_map m '
+        'INNER JOIN concept_reference_term t '
+        'ON t.concept_reference_term_id = m.concept_reference_term_id '
+        'INNER JOIN concept_reference_source s ON s.concept_source_id = t.concept_source_id '
+        'INNER JOIN concept_map_type mt ON mt.concept_map_type_id = m.concept_map_type_id '
+        'WHERE m.concept_id IN (%s) '
+        'ORDER BY m.concept_id, m.concept_map_id')
+    SQL_ANSWERS = (
+        'SELECT concept_id, answer_concept, uuid '
+        'FROM concept_answer '
+        'WHERE concept_id IN (%s) '
+        'ORDER BY concept_id, concept_answer_id')
+    SQL_SET_MEMBERS = (
+        'SELECT concept_set, concept_id, uuid '
+        'FROM concept_set '
+        'WHERE concept_set IN (%s) '
+        'ORDER BY concept_set, concept_set_id')
+
+    def __init__(self, command, chunk_size=1000):
+        self.command = command
+        self.chunk_size = chunk_size
+        self.counts = {}
+
+    ## ROW FETCHING
+
+    def iterate_concept_rows(self, concept_ids=None, concept_limit=None, after_concept_id=None):
+        """
+        Yields lists of ConceptRow tuples in concept_id order, either for the specified list of
+        concept IDs or for all concepts up to the optional concept_limit, starting after
+        after_concept_id if specified.
+        """
+        cursor = get_read_connection().cursor()
+        if concept_ids is not None:
+            for batch_ids in iterate_batches(concept_ids, self.chunk_size):
+                cursor.execute(self.SQL_CONCEPTS + 'WHERE c.concept_id IN (%s) ORDER BY c.concept_id'
+                               % placeholders(batch_ids), batch_ids)
+                yield [ConceptRow(*row) for row in cursor.fetchall()]
+        else:
+            # One query per chunk, continuing after the last concept ID of the previous chunk:
+            # MySQLdb's default cursor reads the whole result set into memory, even with fetchmany()
+            while True:
+                conditions = []
+                params = []
+                if concept_limit is not None:
+                    conditions.append('c.concept_id <= %s')
+                    params.append(concept_limit)
+                if after_concept_id is not None:
+                    conditions.append('c.concept_id > %s')
+                    params.append(after_concept_id)
+                where = 'WHERE %s ' % ' AND '.join(conditions) if conditions else ''
+                cursor.execute(self.SQL_CONCEPTS + where + 'ORDER BY c.concept_id LIMIT %s',
+                               params + [self.chunk_size])
+                rows = cursor.fetchall()
+                if rows:
+                    yield [ConceptRow(*row) for row in rows]
+                if len(rows) < self.chunk_size:
+                    break
+                after_concept_id = rows[-1][0]
+
+    def fetch_chunk(self, concept_rows):
+        """
+        Fetches all child rows needed to export a chunk of concepts with one query per table.
+        Returns a dictionary of the concept rows and the child rows grouped by concept ID.
+        """
+        concept_ids = [concept_row.concept_id for concept_row in concept_rows]
+        chunk = {'concepts': concept_rows}
+        if self.command.do_concept:
+            chunk['names'] = self.fetch_grouped(self.SQL_NAMES, concept_ids)
+            chunk['descriptions'] = self.fetch_grouped(self.SQL_DESCRIPTIONS, concept_ids)
+            chunk['numerics'] = self.fetch_grouped(self.SQL_NUMERICS, concept_ids)
+        if self.command.do_mapping:
+            chunk['reference_maps'] = self.fetch_grouped(self.SQL_REFERENCE_MAPS, concept_ids)
+            chunk['answers'] = self.fetch_grouped(self.SQL_ANSWERS, concept_ids)
+            chunk['set_members'] = self.fetch_grouped(self.SQL_SET_MEMBERS, concept_ids)
+        return chunk
+
+    def fetch_grouped(self, sql, concept_ids):
+        """ Runs an IN query and groups the returned rows by their first column (concept ID) """
+        cursor = get_read_connection().cursor()
+        cursor.execute(sql % placeholders(concept_ids), concept_ids)
+        grouped = {}
+        for row in cursor.fetchall():
+            grouped.setdefault(row[0], []).append(row)
+        return grouped
+
+    ## RECORD BUILDING
+
+    def iterate_export_records(self, concept_ids=None, concept_limit=None, after_concept_id=None,
+                               apply_counts=True):
+        """
+        Yields a (concept_id, export_records) tuple for each selected concept, where
+        export_records is the list of dictionaries (and retired IDs) to output for the concept,
+        in the same order as the ORM export. Export counters are accumulated in self.counts and
+        also added to the command's counters if apply_counts is set.
+        """
+        for concept_rows in self.iterate_concept_rows(concept_ids, concept_limit, after_concept_id):
+            chunk = self.fetch_chunk(concept_rows)
+            for concept_id, export_records, counts in self.build_chunk(chunk):
+                self.add_counts(counts, apply_counts)
+                yield concept_id, export_records
+
+    def add_counts(self, counts, apply_counts=True):
+        """ Accumulates a dictionary of counter increments, optionally into the command too """
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+            if apply_counts:
+                setattr(self.command, name, getattr(self.command, name) + value)
+
+    def build_chunk(self, chunk):
+        """
+        Builds the export records for a fetched chunk without touching the database.
+        Returns a list of (concept_id, export_records, counts) tuples.
+        """
+        results = []
+        for concept_row in chunk['concepts']:
+            counts = {'cnt_total_concepts_processed': 1}
+            export_records = []
+            if self.command.do_concept:
+                export_records.append(self.build_concept(concept_row, chunk, counts))
+            if self.command.do_mapping:
+                export_records += self.build_mappings(concept_row, chunk, counts)
+            if self.command.do_retire and concept_row.retired:
+                increment(counts, 'cnt_retired_concepts_exported')
+                export_records.append(concept_row.concept_id)
+            results.append((concept_row.concept_id, export_records, counts))
+        return results
+
+    def build_concept(self, concept_row, chunk, counts):
+        """ Builds the OCL-formatted dictionary for one concept, matching export_concept() """
+        increment(counts, 'cnt_concepts_exported')
+        concept_id = concept_row.concept_id
+
+        extras = {}
+        data = {}
+        data['id'] = concept_id
+        data['concept_class'] = concept_row.concept_class
+        data['datatype'] = concept_row.datatype
+        data['external_id'] = concept_row.uuid
+        data['retired'] = bool(concept_row.retired)
+        if concept_row.is_set:
+            extras['is_set'] = concept_row.is_set
+
+        data['names'] = [{
+            'name': name,
+            'name_type': name_type,
+            'locale': locale,
+            'locale_preferred': bool(locale_preferred),
+            'external_id': uuid,
+        } for _, name, name_type, locale, locale_preferred, uuid in chunk['names'].get(concept_id, [])]
+
+        data['descriptions'] = [{
+            'description': description,
+            'locale': locale,
+            'external_id': uuid,
+        } for _, description, locale, uuid in chunk['descriptions'].get(concept_id, [])]
+
+        for numeric_row in chunk['numerics'].get(concept_id, []):
+            for key, value in zip(self.NUMERIC_EXTRAS, numeric_row[1:]):
+                if value is not None:
+                    extras[key] = value
+
+        data['extras'] = extras
+        return data
+
+    NUMERIC_EXTRAS = ('hi_absolute', 'hi_critical', 'hi_normal', 'low_absolute', 'low_critical',
+                      'low_normal', 'units', 'precise', 'display_precision')
+
+    def build_mappings(self, concept_row, chunk, counts):
+        """
+        Builds the OCL-formatted mappings for one concept, matching
+        export_all_mappings_for_concept(): reference maps, then linked answers, then set members.
+        """
+        command = self.command
+        concept_id = concept_row.concept_id
+        maps = []
+
+        # Reference maps
+        for (_, map_uuid, map_type, code, term_name, term_uuid,
+             source_name) in chunk['reference_maps'].get(concept_id, []):
+            if source_name == command.org_id:
+                if str(concept_id) == code:
+                    # mapping to self, so ignore
+                    increment(counts, 'cnt_ignored_self_mappings')
+                    continue
+                maps.append(command.generate_internal_mapping(
+                    map_type=map_type,
+                    from_concept=concept_row,
+                    to_concept_code=code,
+                    external_id=term_uuid))
+                increment(counts, 'cnt_internal_mappings_exported')
+            else:
+                to_source_id = OclOpenmrsHelper.get_ocl_source_id_from_omrs_id(source_name)
+                to_org_id = OclOpenmrsHelper.get_source_owner_id(ocl_source_id=to_source_id)
+                maps.append(command.generate_external_mapping(
+                    map_type=map_type,
+                    from_concept=concept_row,
+                    to_org_id=to_org_id,
+                    to_source_id=to_source_id,
+                    to_concept_code=code,
+                    to_concept_name=term_name,
+                    external_id=map_uuid))
+                increment(counts, 'cnt_external_mappings_exported')
+
+        # Linked answers
+        answer_rows = chunk['answers'].get(concept_id, [])
+        if answer_rows:
+            increment(counts, 'cnt_questions_exported')
+        for _, answer_concept_id, uuid in answer_rows:
+            maps.append(command.generate_internal_mapping(
+                map_type=OclOpenmrsHelper.MAP_TYPE_Q_AND_A,
+                from_concept=concept_row,
+                to_concept_code=answer_concept_id,
+                external_id=uuid))
+            increment(counts, 'cnt_answers_exported')
+
+        # Set members
+        member_rows = chunk['set_members'].get(concept_id, [])
+        if member_rows:
+            increment(counts, 'cnt_concept_sets_exported')
+        for _, member_concept_id, uuid in member_rows:
+            maps.append(command.generate_internal_mapping(
+                map_type=OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET,
+                from_concept=concept_row,
+                to_concept_code=member_concept_id,
+                external_id=uuid))
+            increment(counts, 'cnt_set_members_exported')
+
+        return maps
+
+
+
+## HELPER METHODS
+
+def placeholders(values):
+    """Utility function: Returns a comma-separated '%s' placeholder for each value"""
+    return ', '.join(['%s'] * len(values))
+
+
+def get_read_connection():
+    """Utility function: Returns the connection that the database router sends concept reads to"""
+    return connections[router.db_for_read(Concept)]
@@ -0,0 +1,29 @@
+"""
+Start time of the process, recorded by manage.py before Django is loaded so that the profiler
+can report how long a command took to start. This module must not import Django.
+"""
+import time
+
+
+# Time at which manage.py started, or None if it was not recorded
+start_time = None
+
+
+def mark_start():
+    """Utility function: Records the start time of the process"""
+    global start_time
+    start_time = time.time()
+
+
+def pop_startup_seconds():
+    """
+    Utility function: Returns the number of seconds since the start of the process, or None if
+    it was not recorded. The start time is then forgotten, so that only the first command run
+    by a process (e.g. not the commands run by the benchmark command) reports a startup time.
+    """
+    global start_time
+    if start_time is None:
+        return None
+    startup_seconds = time.time() - start_time
+    start_time = None
+    return startup_seconds
@@ -0,0 +1,143 @@
+"""
+Applies a change set written by "sync_bahmni_db --plan" to the OpenMRS database.
+
+The change records are grouped by table and inserted in dependency order (sources, classes,
+concepts, names, descriptions, numerics, reference terms, reference maps, answers and set
+members), with multi-row INSERTs in one transaction per batch. Because every table is applied
+after the tables it references, the database's foreign key checks stay enabled.
+
+References by uuid (e.g. "concept_reference_term_uuid") are resolved to IDs with one query per
+batch once the referenced rows exist. Rows whose uuid (or, for tables without one, primary key)
+already exists are skipped, so a change set that was partially applied can be applied again.
+"""
+import datetime
+import json
+from django.db import transaction
+from omrs.management.commands import increment, iterate_batches
+from omrs.models import (DICTIONARY_MODELS, Concept, ConceptClass, ConceptReferenceSource,
+                         ConceptReferenceTerm)
+
+
+class ChangeSetError(Exception):
+    """ Raised if a change set cannot be applied to the current database """
+    pass
+
+
+class ChangeSetApplier(object):
+    """ Inserts the rows of a change set in bulk, table by table in dependency order """
+
+    # Tables in the order they are applied; each only references tables before it
+    TABLE_ORDER = (
+        'concept_reference_source',
+        'concept_class',
+        'concept',
+        'concept_name',
+        'concept_description',
+        'concept_numeric',
+        'concept_reference_term',
+        'concept_reference_map',
+        'concept_answer',
+        'concept_set',
+    )
+
+    # Row fields that reference another row by uuid, and the ID field they are resolved to
+    UUID_REFERENCES = {
+        'concept_class_uuid': (ConceptClass, 'concept_class_id'),
+        'concept_source_uuid': (ConceptReferenceSource, 'concept_source_id'),
+        'concept_reference_term_uuid': (ConceptReferenceTerm, 'concept_reference_term_id'),
+    }
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.models = dict((model._meta.db_table, model) for model in DICTIONARY_MODELS)
+        self.counts = {}
+
+    def load(self, filename):
+        """ Returns the rows of a change set file grouped by table """
+        rows_by_table = {}
+        with open(filename) as changes_file:
+            for line in changes_file:
+                if not line.strip():
+                    continue
+                change = json.loads(line)
+                if change['table'] not in self.TABLE_ORDER:
+                    raise ChangeSetError('Unsupported table in change set: %s' % change['table'])
+                rows_by_table.setdefault(change['table'], []).append(change['row'])
+        return rows_by_table
+
+    def apply(self, rows_by_table):
+        """ Checks the change set against the database and inserts its rows """
+        self.check_concept_ids(rows_by_table.get('concept', []))
+        for table in self.TABLE_ORDER:
+            model = self.models[table]
+            for batch in iterate_batches(rows_by_table.get(table, []), self.batch_size):
+                with transaction.atomic():
+                    self.apply_batch(model, batch)
+
+    def check_concept_ids(self, concept_rows):
+        """
+        Raises a ChangeSetError if a planned concept ID is already used by a different concept,
+        which means the database changed since the change set was planned.
+        """
+        for batch in iterate_batches(concept_rows, self.batch_size):
+            planned_uuids = dict((row['concept_id'], row['uuid']) for row in batch)
+            for concept_id, uuid in Concept.objects.filter(
+                    concept_id__in=planned_uuids.keys()).values_list('concept_id', 'uuid'):
+                if uuid != planned_uuids[concept_id]:
+                    raise ChangeSetError(
+                        'Concept ID %s is already used by concept %s. The change set is out of '
+                        'date, plan it again.' % (concept_id, uuid))
+
+    def apply_batch(self, model, rows):
+        """ Inserts the rows of one batch that do not exist yet with a multi-row INSERT """
+        table = model._meta.db_table
+        rows = self.resolve_references(rows)
+
+        # Skip rows that exist already, e.g. from an earlier partial apply
+        if 'uuid' in [field.name for field in model._meta.fields]:
+            key_field = 'uuid'
+        else:
+            key_field = model._meta.pk.attname
+        existing_keys = set(model.objects.filter(**{
+            '%s__in' % key_field: [row[key_field] for row in rows]}).values_list(key_field, flat=True))
+        new_rows = [row for row in rows if row[key_field] not in existing_keys]
+
+        # Change sets leave out date_created, which is set when the rows are inserted unless the
+        # model has a default for it
+        if [field for field in model._meta.fields if field.name == 'date_created' and not field.has_default()]:
+            now = datetime.datetime.now()
+            for row in new_rows:
+                row.setdefault('date_created', now)
+
+        if new_rows:
+            model.objects.bulk_create([model(**row) for row in new_rows])
+        increment(self.counts, '%s inserted' % table, len(new_rows))
+        increment(self.counts, '%s already present' % table, len(rows) - len(new_rows))
+
+    def resolve_references(self, rows):
+        """ Returns copies of the rows with their uuid references replaced by IDs """
+        uuids_by_reference = {}
+        for row in rows:
+            for name in self.UUID_REFERENCES:
+                if name in row:
+                    uuids_by_reference.setdefault(name, set()).add(row[name])
+        ids_by_reference = {}
+        for name, uuids in uuids_by_reference.items():
+            model, id_field = self.UUID_REFERENCES[name]
+            ids_by_reference[name] = dict(model.objects.filter(uuid__in=uuids).values_list(
+                'uuid', model._meta.pk.attname))
+            missing_uuids = uuids - set(ids_by_reference[name])
+            if missing_uuids:
+                raise ChangeSetError('%s rows referenced by the change set do not exist: %s' % (
+                    model.__name__, ', '.join(sorted(missing_uuids))))
+
+        resolved_rows = []
+        for row in rows:
+            row = dict(row)
+            for name, ids in ids_by_reference.items():
+                if name in row:
+                    row[self.UUID_REFERENCES[name][1]] = ids[row.pop(name)]
+            resolved_rows.append(row)
+        return resolved_rows
@@ -0,0 +1,142 @@
+"""
+Batched writer for the names, descriptions and numeric ranges of synced concepts.
+
+sync_bahmni_db adds each synced concept to a ConceptDetailWriter, which collects the rows in
+memory. When the batch is flushed, the existing names, descriptions and numeric ranges of all
+concepts in the batch are looked up with one query per table and only the missing rows are
+inserted with bulk_create.
+
+The rows are built by the row functions below from an OCL-formatted concept, so that the
+"plan" option (see omrs/sync_plan.py) plans exactly the rows the writer inserts.
+"""
+import datetime
+from django.db.models import Q
+from omrs.models import ConceptName, ConceptDescription, ConceptNumeric
+
+
+# Numeric extras copied to the concept_numeric row of a Numeric concept
+NUMERIC_FIELDS = ('hi_absolute', 'hi_critical', 'hi_normal', 'low_absolute', 'low_critical',
+                  'low_normal', 'units', 'display_precision')
+
+
+class ConceptDetailWriter(object):
+    """ Collects the names, descriptions and numeric ranges of a batch of concepts and inserts them in bulk """
+
+    def __init__(self):
+        self.counts = {}
+        self.clear()
+
+    def clear(self):
+        """ Discards the pending rows, e.g. if the batch transaction was rolled back """
+        self.names = []
+        self.descriptions = []
+        self.numerics = []
+        self.pending_names = {}
+
+    def add(self, concept, concept_id):
+        """ Adds the names, descriptions and numeric range of an OCL concept synced to concept_id """
+        for row in get_name_rows(concept, concept_id):
+            name = ConceptName(**row)
+            self.names.append((get_name_key(row), name))
+            self.pending_names.setdefault(get_name_key(row), []).append(name)
+        self.descriptions += [ConceptDescription(date_created=datetime.datetime.now(), **row)
+                              for row in get_description_rows(concept, concept_id)]
+        self.numerics += [ConceptNumeric(**row) for row in get_numeric_rows(concept, concept_id)]
+
+    def get_pending_names(self, cname):
+        """
+        Returns the pending ConceptName rows that match an OCL concept name, so that concepts
+        synced later in the same batch can match the names of earlier ones.
+        """
+        return self.pending_names.get(get_name_key({
+            'name': cname['name'], 'concept_name_type': cname['name_type'],
+            'locale': cname['locale'], 'locale_preferred': cname['locale_preferred']}), [])
+
+    def flush(self):
+        """ Inserts the pending rows that do not exist yet, with one query per table to check """
+        if self.names:
+            concept_ids = set(name.concept_id for key, name in self.names)
+            uuids = set(name.uuid for key, name in self.names)
+            existing_keys = set()
+            existing_uuids = set()
+            for row in ConceptName.objects.filter(Q(concept__in=concept_ids) | Q(uuid__in=uuids)).values(
+                    'concept_id', 'name', 'concept_name_type', 'locale', 'locale_preferred', 'uuid'):
+                existing_keys.add((row['concept_id'],) + get_name_key(row))
+                existing_uuids.add(row['uuid'])
+            new_names = []
+            for key, name in self.names:
+                key = (name.concept_id,) + key
+                if key not in existing_keys and name.uuid not in existing_uuids:
+                    existing_keys.add(key)
+                    existing_uuids.add(name.uuid)
+                    new_names.append(name)
+            self.insert(ConceptName, new_names)
+
+        if self.descriptions:
+            existing_uuids = set(ConceptDescription.objects.filter(
+                uuid__in=[description.uuid for description in self.descriptions]).values_list('uuid', flat=True))
+            new_descriptions = []
+            for description in self.descriptions:
+                if description.uuid not in existing_uuids:
+                    existing_uuids.add(description.uuid)
+                    new_descriptions.append(description)
+            self.insert(ConceptDescription, new_descriptions)
+
+        if self.numerics:
+            existing_ids = set(ConceptNumeric.objects.filter(
+                concept__in=[numeric.concept_id for numeric in self.numerics]).values_list('concept', flat=True))
+            new_numerics = []
+            for numeric in self.numerics:
+                if numeric.concept_id not in existing_ids:
+                    existing_ids.add(numeric.concept_id)
+                    new_numerics.append(numeric)
+            self.insert(ConceptNumeric, new_numerics)
+
+        self.clear()
+
+    def insert(self, model, instances):
+        """ Inserts a list of model instances with one multi-row INSERT and counts them """
+        if instances:
+            model.objects.bulk_create(instances)
+        self.counts[model._meta.db_table] = self.counts.get(model._meta.db_table, 0) + len(instances)
+
+
+
+## ROW FUNCTIONS
+
+def get_name_rows(concept, concept_id):
+    """Utility function: Returns the concept_name rows of an OCL concept, as dictionaries of field values"""
+    return [{
+        'concept_id': concept_id,
+        'name': cname['name'],
+        'uuid': cname['external_id'],
+        'concept_name_type': cname['name_type'],
+        'locale': cname['locale'],
+        'locale_preferred': cname['locale_preferred'],
+    } for cname in concept['names']]
+
+
+def get_description_rows(concept, concept_id):
+    """Utility function: Returns the concept_description rows of an OCL concept, without date_created"""
+    return [{
+        'concept_id': concept_id,
+        'description': cdescription['description'],
+        'uuid': cdescription['external_id'],
+        'locale': cdescription['locale'],
+        'creator': 1,
+    } for cdescription in concept.get('descriptions') or []]
+
+
+def get_numeric_rows(concept, concept_id):
+    """Utility function: Returns the concept_numeric row of a Numeric OCL concept in a list, if any"""
+    if concept['datatype'] != 'Numeric' or concept.get('extras') is None:
+        return []
+    extra = concept['extras']
+    row = dict((field, extra.get(field)) for field in NUMERIC_FIELDS)
+    row.update(concept_id=concept_id, precise=extra.get('precise', 0))
+    return [row]
+
+
+def get_name_key(row):
+    """Utility function: Returns the key names are matched on: (name, type, locale, locale_preferred)"""
+    return (row['name'], row['concept_name_type'], row['locale'], bool(row['locale_preferred']))
@@ -0,0 +1,305 @@
+"""
+Dry-run planner for sync_bahmni_db.
+
+DictionaryIndex loads the current OpenMRS concepts, names, descriptions, numeric ranges,
+reference terms, maps, answers and set members in bulk (one query per table) into in-memory indexes. SyncPlanner then replays the
+matching rules of sync_bahmni_db against those indexes and yields exactly the rows the sync
+would insert, without writing to the database and without any per-record queries.
+
+Each planned row is a change record of the form:
+
+    {"table": "concept_reference_map", "row": {"concept_id": 5839, "map_type_id": 1, ...}}
+
+Rows use the model field names. Concepts are referenced by their (planned) concept ID, while
+reference sources, classes and reference terms are referenced by uuid (e.g.
+"concept_reference_term_uuid"), since the IDs of new rows are assigned by the database.
+"""
+from django.db import connection
+from omrs.management.commands import OclOpenmrsHelper, increment
+from omrs.models import (Concept, ConceptName, ConceptDescription, ConceptNumeric, ConceptClass,
+                         ConceptDatatype, ConceptMapType, ConceptReferenceSource,
+                         ConceptReferenceTerm, ConceptReferenceMap, ConceptAnswer, ConceptSet)
+from omrs.sync_details import (get_name_rows, get_description_rows, get_numeric_rows,
+                               get_name_key)
+
+
+def get_normalizer(connection):
+    """
+    Utility function: Returns a function that normalizes strings the way the database compares
+    them. MySQL compares strings case-insensitively and ignores trailing spaces, so in-memory
+    lookups do the same to match what the sync's queries would find.
+    """
+    if connection.vendor == 'mysql':
+        return lambda value: value.rstrip().lower() if value else value
+    return lambda value: value
+
+
+class DictionaryIndex(object):
+    """ In-memory indexes of the OpenMRS concept dictionary, loaded with one query per table """
+
+    def __init__(self):
+        self.normalize = get_normalizer(connection)
+
+    def load(self):
+        """ Loads all indexes. Returns self. """
+        normalize = self.normalize
+
+        self.concept_ids = set(Concept.objects.values_list('concept_id', flat=True))
+        self.max_concept_id = max(self.concept_ids) if self.concept_ids else 0
+
+        # Concept names by (name, type, locale, locale_preferred), in concept_name_id order, and
+        # the exact names of each concept as the name writer checks them
+        self.names = {}
+        self.concept_name_keys = set()
+        self.name_uuids = set()
+        for concept_id, name, name_type, locale, locale_preferred, uuid in ConceptName.objects.order_by(
+                'concept_name_id').values_list('concept', 'name', 'concept_name_type', 'locale',
+                                               'locale_preferred', 'uuid'):
+            key = (normalize(name), normalize(name_type), normalize(locale), bool(locale_preferred))
+            self.names.setdefault(key, []).append((concept_id, name_type))
+            self.concept_name_keys.add((concept_id, name, name_type, locale, bool(locale_preferred)))
+            self.name_uuids.add(uuid)
+        self.description_uuids = set(ConceptDescription.objects.values_list('uuid', flat=True))
+        self.numeric_concept_ids = set(ConceptNumeric.objects.values_list('concept', flat=True))
+
+        # Metadata by name, with the uuid used to reference it in change records
+        self.datatypes = dict((normalize(name), datatype_id) for datatype_id, name in
+                              ConceptDatatype.objects.values_list('concept_datatype_id', 'name'))
+        self.classes = dict((normalize(name), uuid) for name, uuid in
+                            ConceptClass.objects.values_list('name', 'uuid'))
+        self.map_types = dict((normalize(name), map_type_id) for map_type_id, name in
+                              ConceptMapType.objects.values_list('concept_map_type_id', 'name'))
+        self.sources = {}
+        self.source_uuids = {}
+        for source_id, name, uuid in ConceptReferenceSource.objects.values_list(
+                'concept_source_id', 'name', 'uuid'):
+            self.sources[normalize(name)] = uuid
+            self.source_uuids[source_id] = uuid
+
+        # Reference terms by (source uuid, code) and by uuid
+        self.terms = {}
+        self.term_uuids = {}
+        for term_id, source_id, code, uuid in ConceptReferenceTerm.objects.order_by(
+                'concept_reference_term_id').values_list(
+                'concept_reference_term_id', 'concept_source', 'code', 'uuid'):
+            self.terms.setdefault((self.source_uuids.get(source_id), normalize(code)), uuid)
+            self.term_uuids[term_id] = uuid
+        self.existing_term_uuids = set(self.term_uuids.values())
+
+        # Reference maps, answers and set members by the keys the sync matches them on
+        self.maps = set((concept_id, self.term_uuids.get(term_id), map_type_id)
+                        for concept_id, term_id, map_type_id in
+                        ConceptReferenceMap.objects.values_list(
+                            'concept', 'concept_reference_term', 'map_type'))
+        self.answers = set(ConceptAnswer.objects.values_list('question_concept', 'answer_concept'))
+        self.set_members = set(ConceptSet.objects.values_list('concept_set_owner', 'concept'))
+        return self
+
+
+class SyncPlanner(object):
+    """
+    Computes the rows sync_bahmni_db would insert for a set of sources, classes, concepts and
+    mappings. The index is updated with every planned row, so later records see earlier ones
+    exactly as they would in a real sync.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.counts = {}
+
+    def plan_sources(self, sources):
+        """ Yields the change records for the reference sources that do not exist yet """
+        for src in sources:
+            src_name = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(src['name'])
+            if self.index.normalize(src_name) in self.index.sources:
+                continue
+            row = {'name': src_name, 'description': src['description'], 'creator': src['creator'],
+                   'retired': src['retired'], 'retired_by': src['retired_by'], 'uuid': src['uuid']}
+            if 'hl7' in src:
+                row['hl7_code'] = src['hl7']
+            self.index.sources[self.index.normalize(src_name)] = src['uuid']
+            yield self.change('concept_reference_source', row)
+
+    def plan_classes(self, classes):
+        """ Yields the change records for the concept classes that do not exist yet """
+        for cls in classes:
+            if self.index.normalize(cls['name']) in self.index.classes:
+                continue
+            self.index.classes[self.index.normalize(cls['name'])] = cls['uuid']
+            yield self.change('concept_class', {
+                'name': cls['name'], 'description': cls['description'], 'creator': cls['creator'],
+                'retired': cls['retired'], 'retired_by': cls['retired_by'], 'uuid': cls['uuid']})
+
+    def plan_concepts(self, concepts, conv_ids):
+        """
+        Yields the change records for the concepts that do not match any existing concept
+        name, following the matching rules of sync_concept_mapping(), and fills in conv_ids.
+        """
+        index = self.index
+        normalize = index.normalize
+        for concept in concepts:
+            increment(self.counts, 'concepts_processed')
+            if not concept['id']:
+                continue
+            if normalize(concept['concept_class']) not in index.classes:
+                raise ConceptClass.DoesNotExist('Concept class "%s" does not exist in OpenMRS'
+                                                % concept['concept_class'])
+            if normalize(concept['datatype']) not in index.datatypes:
+                raise ConceptDatatype.DoesNotExist('Concept datatype "%s" does not exist in OpenMRS'
+                                                   % concept['datatype'])
+
+            # Match the concept names against existing names, as sync_concept_mapping() does
+            concept_id = concept['id']
+            f_sp = 0
+            at_lst_one = 0
+            for cname in concept['names']:
+                matches = index.names.get((normalize(cname['name']), normalize(cname['name_type']),
+                                           normalize(cname['locale']), bool(cname['locale_preferred'])))
+                if not matches:
+                    continue
+                at_lst_one = 1
+                if len(matches) > 1:
+                    for match_id, match_type in matches:
+                        if match_type == 'FULLY_SPECIFIED':
+                            f_sp = 1
+                            concept_id = match_id
+                    if not f_sp:
+                        concept_id = matches[0][0]
+                elif not f_sp:
+                    if matches[0][1] == 'FULLY_SPECIFIED':
+                        f_sp = 1
+                    concept_id = matches[0][0]
+                conv_ids[concept['id']] = concept_id
+
+            if not at_lst_one:
+                # No name matched, so a new concept is created, with a new ID if its ID is taken
+                if concept_id in index.concept_ids:
+                    concept_id = index.max_concept_id + 1
+                index.concept_ids.add(concept_id)
+                index.max_concept_id = max(index.max_concept_id, concept_id)
+                conv_ids[concept['id']] = concept_id
+                yield self.change('concept', {
+                    'concept_id': concept_id,
+                    'retired': concept['retired'],
+                    'datatype_id': index.datatypes[normalize(concept['datatype'])],
+                    'concept_class_uuid': index.classes[normalize(concept['concept_class'])],
+                    'uuid': concept['external_id'],
+                    'is_set': concept['extras'].get('is_set', 0) if concept.get('extras') else 0,
+                }, ocl_id=concept['id'])
+
+            for change in self.plan_concept_details(concept, concept_id):
+                yield change
+
+    def plan_concept_details(self, concept, concept_id):
+        """
+        Yields the change records for the names, descriptions and numeric range of a synced
+        concept that the concept detail writer would insert.
+        """
+        index = self.index
+        for row in get_name_rows(concept, concept_id):
+            key = (concept_id,) + get_name_key(row)
+            if key in index.concept_name_keys or row['uuid'] in index.name_uuids:
+                continue
+            index.concept_name_keys.add(key)
+            index.name_uuids.add(row['uuid'])
+            index.names.setdefault(
+                (index.normalize(row['name']), index.normalize(row['concept_name_type']),
+                 index.normalize(row['locale']), bool(row['locale_preferred'])), []).append(
+                (concept_id, row['concept_name_type']))
+            yield self.change('concept_name', row)
+        for row in get_description_rows(concept, concept_id):
+            if row['uuid'] not in index.description_uuids:
+                index.description_uuids.add(row['uuid'])
+                yield self.change('concept_description', row)
+        for row in get_numeric_rows(concept, concept_id):
+            if concept_id not in index.numeric_concept_ids:
+                index.numeric_concept_ids.add(concept_id)
+                yield self.change('concept_numeric', row)
+
+    def plan_mappings(self, mappings, conv_ids):
+        """
+        Yields the change records for the reference terms, reference maps, answers and set
+        members that the mapping sync would create.
+        """
+        index = self.index
+        normalize = index.normalize
+        for m in mappings:
+            increment(self.counts, 'mappings_processed')
+            from_ocl_id = int(m['from_concept_url'].split('/')[6])
+            if not from_ocl_id:
+                continue
+            if from_ocl_id not in conv_ids:
+                raise Concept.DoesNotExist(
+                    'Concept %s of mapping %s is not in the concept file or the synced concepts'
+                    % (from_ocl_id, m.get('external_id')))
+            from_id = conv_ids[from_ocl_id]
+            if from_id not in index.concept_ids:
+                raise Concept.DoesNotExist('Concept %s does not exist in OpenMRS' % from_id)
+
+            if 'to_source_url' in m:
+                # External mapping: reference term in an external source and a reference map
+                source_uuid = self.get_source_uuid(m['to_source_url'].split('/')[4])
+                map_type_id = self.get_map_type_id(m['map_type'])
+                term_key = (source_uuid, normalize(m['to_concept_code']))
+                if term_key not in index.terms:
+                    index.terms[term_key] = m['ref_term']
+                    yield self.change('concept_reference_term', {
+                        'concept_source_uuid': source_uuid, 'code': m['to_concept_code'],
+                        'retired': m['retired'], 'uuid': m['ref_term']})
+                map_key = (from_id, index.terms[term_key], map_type_id)
+                if map_key not in index.maps:
+                    index.maps.add(map_key)
+                    yield self.change('concept_reference_map', {
+                        'concept_id': from_id, 'uuid': m['external_id'], 'map_type_id': map_type_id,
+                        'concept_reference_term_uuid': index.terms[term_key]})
+                continue
+
+            code = int(m['to_concept_url'].split('/')[6])
+            if m['map_type'] in (OclOpenmrsHelper.MAP_TYPE_Q_AND_A, OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET):
+                # Q-AND-A and set members are always internal mappings
+                if code not in conv_ids or conv_ids[code] not in index.concept_ids:
+                    increment(self.counts, 'mappings_missing_to_concept')
+                    continue
+                key = (from_id, conv_ids[code])
+                if m['map_type'] == OclOpenmrsHelper.MAP_TYPE_Q_AND_A and key not in index.answers:
+                    index.answers.add(key)
+                    yield self.change('concept_answer', {
+                        'question_concept_id': from_id, 'answer_concept_id': key[1],
+                        'uuid': m['external_id'], 'sort_weight': float(m['sort_weight'])})
+                elif m['map_type'] == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET and key not in index.set_members:
+                    index.set_members.add(key)
+                    yield self.change('concept_set', {
+                        'concept_set_owner_id': from_id, 'concept_id': key[1],
+                        'uuid': m['external_id'], 'sort_weight': float(m['sort_weight'])})
+            elif m['external_id'] not in index.existing_term_uuids:
+                # Internal reference map: term and map are only created if the term is new
+                source_uuid = self.get_source_uuid(m['to_concept_url'].split('/')[4])
+                map_type_id = self.get_map_type_id(m['map_type'])
+                index.existing_term_uuids.add(m['external_id'])
+                yield self.change('concept_reference_term', {
+                    'concept_source_uuid': source_uuid, 'code': str(code),
+                    'retired': m['retired'], 'uuid': m['external_id']})
+                yield self.change('concept_reference_map', {
+                    'concept_id': from_id, 'uuid': m['ref_m'], 'map_type_id': map_type_id,
+                    'concept_reference_term_uuid': m['external_id']})
+
+    def get_source_uuid(self, ocl_source_id):
+        """ Returns the uuid of the existing or planned reference source for an OCL source ID """
+        src_name = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(ocl_source_id)
+        if self.index.normalize(src_name) not in self.index.sources:
+            raise ConceptReferenceSource.DoesNotExist(
+                'Reference source "%s" does not exist in OpenMRS' % src_name)
+        return self.index.sources[self.index.normalize(src_name)]
+
+    def get_map_type_id(self, name):
+        """ Returns the ID of the map type with the specified name """
+        if self.index.normalize(name) not in self.index.map_types:
+            raise ConceptMapType.DoesNotExist('Map type "%s" does not exist in OpenMRS' % name)
+        return self.index.map_types[self.index.normalize(name)]
+
+    def change(self, table, row, **extra):
+        """ Returns a change record for a planned row and counts it """
+        increment(self.counts, table)
+        change = {'table': table, 'row': row}
+        change.update(extra)
+        return change
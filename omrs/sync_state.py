@@ -0,0 +1,92 @@
+"""
+Persistent state of a sync_bahmni_db run, used to resume a failed sync.
+
+The state is a small SQLite file (using the standard library sqlite3 module, so it needs no
+changes to the OpenMRS database) with three tables:
+
+- conv_ids: the OCL concept ID -> OpenMRS concept ID translation of every synced concept
+- synced_mappings: the external_id (uuid) of every synced mapping
+- concept_hashes: the OpenMRS concept ID and content hash of every concept whose OpenMRS row
+  is known to match its OCL content, used by the "upsert" option to skip unchanged concepts
+
+conv_ids and synced_mappings record the progress of one sync and are cleared when a new sync is
+started. concept_hashes is kept across syncs, so that e.g. a monthly update only touches the
+concepts that changed since the previous one.
+
+Writes are committed in batches. Rows created in OpenMRS are only recorded once they have been
+written, so a sync that dies between the two simply re-checks the last batch, which the sync
+handles idempotently.
+"""
+import sqlite3
+
+
+class SyncState(object):
+    """ On-disk record of the concepts and mappings synced by sync_bahmni_db """
+
+    # Number of writes between commits of the state file
+    COMMIT_EVERY = 500
+
+    def __init__(self, filename, resume=False):
+        """
+        :param filename: Name of the SQLite state file.
+        :param resume: If set, the existing progress is kept, otherwise it is cleared.
+        """
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS conv_ids '
+                        '(ocl_id INTEGER PRIMARY KEY, omrs_id INTEGER NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS synced_mappings (uuid TEXT PRIMARY KEY)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS concept_hashes '
+                        '(ocl_id INTEGER PRIMARY KEY, omrs_id INTEGER NOT NULL, hash TEXT NOT NULL)')
+        if not resume:
+            self.db.execute('DELETE FROM conv_ids')
+            self.db.execute('DELETE FROM synced_mappings')
+        self.db.commit()
+        self.num_pending_writes = 0
+
+    def load_conv_ids(self):
+        """ Returns the dictionary of OCL concept IDs to OpenMRS concept IDs synced so far """
+        return dict(self.db.execute('SELECT ocl_id, omrs_id FROM conv_ids'))
+
+    def load_synced_mapping_uuids(self):
+        """ Returns the set of external IDs of the mappings synced so far """
+        return set(uuid for (uuid,) in self.db.execute('SELECT uuid FROM synced_mappings'))
+
+    def load_concept_hashes(self):
+        """ Returns the dictionary of OCL concept IDs to (OpenMRS concept ID, content hash) tuples """
+        return dict((ocl_id, (omrs_id, content_hash)) for ocl_id, omrs_id, content_hash in
+                    self.db.execute('SELECT ocl_id, omrs_id, hash FROM concept_hashes'))
+
+    def concept_synced(self, ocl_id, omrs_id, commit=False, content_hash=None):
+        """
+        Records the OpenMRS concept ID of a synced concept. Set commit if the sync created the
+        concept, so that a resumed sync never creates it again. Set content_hash if the OpenMRS
+        concept matches the OCL content with this hash.
+        """
+        self.db.execute('INSERT OR REPLACE INTO conv_ids (ocl_id, omrs_id) VALUES (?, ?)',
+                        (ocl_id, omrs_id))
+        if content_hash:
+            self.db.execute('INSERT OR REPLACE INTO concept_hashes (ocl_id, omrs_id, hash) VALUES (?, ?, ?)',
+                            (ocl_id, omrs_id, content_hash))
+        self.written(commit)
+
+    def mapping_synced(self, uuid):
+        """ Records the external ID of a synced mapping """
+        self.db.execute('INSERT OR IGNORE INTO synced_mappings (uuid) VALUES (?)', (uuid,))
+        self.written()
+
+    def written(self, commit=False):
+        """ Counts a write and commits the state if requested or if a batch is complete """
+        self.num_pending_writes += 1
+        if commit or self.num_pending_writes >= self.COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        """ Commits all pending writes to the state file """
+        self.db.commit()
+        self.num_pending_writes = 0
+
+    def close(self):
+        """ Commits all pending writes and closes the state file """
+        self.commit()
+        self.db.close()
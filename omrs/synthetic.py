@@ -0,0 +1,213 @@
+"""
+Generator for synthetic OpenMRS concept dictionaries, used by the benchmark command.
+
+The generated dictionary is deterministic for a given seed and mimics the shape of CIEL:
+every concept has a fully specified English name plus alternate names, a self-mapping to the
+org's own source plus external reference maps, and a share of the concepts are numeric,
+coded questions with linked answers, or concept sets with members.
+"""
+import datetime
+import random
+import uuid
+from django.db import connection, transaction
+from omrs.models import (Concept, ConceptName, ConceptDescription,
+                         ConceptNumeric, ConceptClass, ConceptDatatype, ConceptMapType,
+                         ConceptReferenceSource, ConceptReferenceTerm, ConceptReferenceMap,
+                         ConceptAnswer, ConceptSet)
+from omrs.schema import create_dictionary_indexes, create_dictionary_tables
+
+
+class SyntheticDictionaryGenerator(object):
+    """ Writes a synthetic concept dictionary of configurable size to the default database """
+
+    DATATYPES = ((1, 'Numeric', 'NM'), (2, 'Coded', 'CWE'), (3, 'Text', 'ST'), (4, 'N/A', 'ZZ'))
+    DATATYPE_NUMERIC = 1
+    DATATYPE_CODED = 2
+    CLASSES = ('Diagnosis', 'Finding', 'Test', 'Question', 'Misc', 'ConvSet', 'Procedure')
+    CLASS_CONVSET = 6
+    MAP_TYPES = ('SAME-AS', 'NARROWER-THAN', 'BROADER-THAN')
+    EXTERNAL_SOURCES = ('SNOMED CT', 'ICD-10-WHO', 'LOINC', 'RxNORM')
+
+    # Alternate names cycled through after the fully specified English name
+    NAME_VARIANTS = (
+        ('SHORT', 'en', False),
+        ('FULLY_SPECIFIED', 'fr', True),
+        ('SYNONYM', 'en', False),
+        ('FULLY_SPECIFIED', 'es', True),
+        ('SYNONYM', 'fr', False),
+    )
+
+    # One in every N concepts is a coded question, a concept set or numeric
+    QUESTION_EVERY = 10
+    SET_EVERY = 20
+    NUMERIC_EVERY = 8
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, num_concepts=1000, names_per_concept=3, mappings_per_concept=2,
+                 answers_per_question=4, members_per_set=5, org_source_name='CIEL', seed=0):
+        self.num_concepts = num_concepts
+        self.names_per_concept = names_per_concept
+        self.mappings_per_concept = mappings_per_concept
+        self.answers_per_question = answers_per_question
+        self.members_per_set = members_per_set
+        self.org_source_name = org_source_name
+        self.random = random.Random(seed)
+        self.date_created = datetime.datetime(2016, 1, 1)
+        self.counts = {}
+
+    def create_schema(self):
+        """ Creates the dictionary tables and their indexes in an empty database """
+        create_dictionary_tables(connection)
+        create_dictionary_indexes(connection)
+
+    def generate(self):
+        """ Generates the metadata and all concepts. Returns a dictionary of row counts. """
+        with transaction.atomic():
+            self.generate_metadata()
+        for first_id in range(1, self.num_concepts + 1, self.BATCH_SIZE):
+            last_id = min(first_id + self.BATCH_SIZE - 1, self.num_concepts)
+            with transaction.atomic():
+                self.generate_concepts(first_id, last_id)
+        return self.counts
+
+    def generate_metadata(self):
+        """ Creates the datatypes, classes, map types and reference sources """
+        self.bulk_create(ConceptDatatype, [
+            ConceptDatatype(concept_datatype_id=datatype_id, name=name, hl7_abbreviation=hl7,
+                            description=name, creator=1, date_created=self.date_created,
+                            retired=0, uuid=self.uuid())
+            for datatype_id, name, hl7 in self.DATATYPES])
+        self.bulk_create(ConceptClass, [
+            ConceptClass(concept_class_id=class_id, name=name, description=name, creator=1,
+                         date_created=self.date_created, retired=0, uuid=self.uuid())
+            for class_id, name in enumerate(self.CLASSES, 1)])
+        self.bulk_create(ConceptMapType, [
+            ConceptMapType(concept_map_type_id=map_type_id, name=name, creator=1,
+                           date_created=self.date_created, retired=0, uuid=self.uuid())
+            for map_type_id, name in enumerate(self.MAP_TYPES, 1)])
+        self.bulk_create(ConceptReferenceSource, [
+            ConceptReferenceSource(concept_source_id=source_id, name=name, description=name,
+                                   creator=1, date_created=self.date_created, retired=0,
+                                   uuid=self.uuid())
+            for source_id, name in enumerate((self.org_source_name,) + self.EXTERNAL_SOURCES, 1)])
+
+    def generate_concepts(self, first_id, last_id):
+        """ Creates concepts first_id to last_id with their names, maps, answers and sets """
+        concepts = []
+        names = []
+        descriptions = []
+        numerics = []
+        terms = []
+        reference_maps = []
+        answers = []
+        set_members = []
+
+        for concept_id in range(first_id, last_id + 1):
+            is_question = concept_id % self.QUESTION_EVERY == 0
+            is_set = concept_id % self.SET_EVERY == 5
+            is_numeric = concept_id % self.NUMERIC_EVERY == 3 and not (is_question or is_set)
+            if is_numeric:
+                datatype_id = self.DATATYPE_NUMERIC
+            elif is_question:
+                datatype_id = self.DATATYPE_CODED
+            else:
+                datatype_id = len(self.DATATYPES)
+            class_id = self.CLASS_CONVSET if is_set else 1 + concept_id % len(self.CLASSES)
+            concepts.append(Concept(
+                concept_id=concept_id, retired=concept_id % 97 == 0, datatype_id=datatype_id,
+                concept_class_id=class_id, is_set=int(is_set), date_created=self.date_created,
+                date_changed=self.date_created, uuid=self.uuid()))
+
+            # Names: a preferred fully specified English name followed by the variants
+            name_specs = [('FULLY_SPECIFIED', 'en', True)]
+            for num in range(self.names_per_concept - 1):
+                name_specs.append(self.NAME_VARIANTS[num % len(self.NAME_VARIANTS)])
+            for num, (name_type, locale, locale_preferred) in enumerate(name_specs):
+                names.append(ConceptName(
+                    concept_id=concept_id, concept_name_id=self.next_id('name'),
+                    name='Synthetic concept %d %s %s %d' % (concept_id, locale, name_type, num),
+                    locale=locale, concept_name_type=name_type, locale_preferred=locale_preferred,
+                    date_created=self.date_created, voided=False, uuid=self.uuid()))
+
+            if concept_id % 3 == 0:
+                descriptions.append(ConceptDescription(
+                    concept_description_id=self.next_id('description'), concept_id=concept_id,
+                    description='Synthetic description of concept %d' % concept_id, locale='en',
+                    creator=1, date_created=self.date_created, uuid=self.uuid()))
+            if is_numeric:
+                numerics.append(ConceptNumeric(
+                    concept_id=concept_id, hi_absolute=1000.0, hi_critical=500.0,
+                    low_normal=1.0, units='mg/dL', precise=1, display_precision=1))
+
+            # Reference maps: a self-mapping to the org source, then external maps
+            for num in range(self.mappings_per_concept):
+                if num == 0:
+                    source_id, code, map_type_id = 1, str(concept_id), 1
+                else:
+                    source_id = 2 + (concept_id + num) % len(self.EXTERNAL_SOURCES)
+                    code = 'S%d-%d' % (concept_id, num)
+                    map_type_id = 1 + num % len(self.MAP_TYPES)
+                term_id = self.next_id('term')
+                terms.append(ConceptReferenceTerm(
+                    concept_reference_term_id=term_id, concept_source_id=source_id, code=code,
+                    name='Term %s' % code, retired=0, date_created=self.date_created,
+                    uuid=self.uuid()))
+                reference_maps.append(ConceptReferenceMap(
+                    concept_map_id=self.next_id('map'), concept_id=concept_id,
+                    concept_reference_term_id=term_id, map_type_id=map_type_id,
+                    date_created=self.date_created, uuid=self.uuid()))
+
+            # Linked answers and set members point at other (possibly later) concepts
+            if is_question:
+                for num, answer_id in enumerate(self.sample_concept_ids(
+                        concept_id, self.answers_per_question)):
+                    answers.append(ConceptAnswer(
+                        concept_answer_id=self.next_id('answer'), question_concept_id=concept_id,
+                        answer_concept_id=answer_id, sort_weight=float(num + 1),
+                        date_created=self.date_created, uuid=self.uuid()))
+            if is_set:
+                for num, member_id in enumerate(self.sample_concept_ids(
+                        concept_id, self.members_per_set)):
+                    set_members.append(ConceptSet(
+                        concept_set_id=self.next_id('set_member'), concept_set_owner_id=concept_id,
+                        concept_id=member_id, sort_weight=float(num + 1),
+                        date_created=self.date_created, uuid=self.uuid()))
+
+        # Concepts must exist before the rows referencing them in databases that check keys
+        self.bulk_create(Concept, concepts)
+        self.bulk_create(ConceptName, names)
+        self.bulk_create(ConceptDescription, descriptions)
+        self.bulk_create(ConceptNumeric, numerics)
+        self.bulk_create(ConceptReferenceTerm, terms)
+        self.bulk_create(ConceptReferenceMap, reference_maps)
+        self.bulk_create(ConceptAnswer, answers)
+        self.bulk_create(ConceptSet, set_members)
+
+    def sample_concept_ids(self, concept_id, count):
+        """ Returns up to count distinct concept IDs other than concept_id """
+        candidates = set()
+        count = min(count, self.num_concepts - 1)
+        while len(candidates) < count:
+            candidate_id = self.random.randint(1, self.num_concepts)
+            if candidate_id != concept_id:
+                candidates.add(candidate_id)
+        return sorted(candidates)
+
+    def bulk_create(self, model, instances):
+        """ Inserts the instances with multi-row INSERTs and counts them """
+        if instances:
+            model.objects.bulk_create(instances)
+            table = model._meta.db_table
+            self.counts[table] = self.counts.get(table, 0) + len(instances)
+
+    def next_id(self, sequence):
+        """ Returns the next primary key value of a named sequence """
+        key = 'next_%s_id' % sequence
+        value = getattr(self, key, 1)
+        setattr(self, key, value + 1)
+        return value
+
+    def uuid(self):
+        """ Returns a reproducible UUID string """
+        return str(uuid.UUID(int=self.random.getrandbits(128)))
@@ -0,0 +1,39 @@
+"""
+Tests of the export and sync commands, run against a small synthetic concept dictionary:
+
+    manage.py test omrs --settings=omrs.settings_test --noinput
+
+The dictionary models are unmanaged, so the test database has no dictionary tables until
+create_test_dictionary() creates and fills them.
+"""
+import sys
+from django.core.management import call_command
+from django.db import connection
+from omrs.models import DICTIONARY_MODELS
+from omrs.synthetic import SyntheticDictionaryGenerator
+
+
+def create_test_dictionary(num_concepts):
+    """Utility function: Replaces the dictionary tables with a new synthetic dictionary"""
+    cursor = connection.cursor()
+    for model in reversed(DICTIONARY_MODELS):
+        cursor.execute('DROP TABLE IF EXISTS %s' % connection.ops.quote_name(model._meta.db_table))
+    generator = SyntheticDictionaryGenerator(num_concepts=num_concepts)
+    generator.create_schema()
+    generator.generate()
+
+
+def get_table_counts():
+    """Utility function: Returns a dictionary of the row count of each dictionary table"""
+    return dict((model._meta.db_table, model.objects.count()) for model in DICTIONARY_MODELS)
+
+
+def run_command(command_name, output_filename, **options):
+    """Utility function: Runs a management command with its stdout written to output_filename"""
+    stdout = sys.stdout
+    with open(output_filename, 'w') as output_file:
+        sys.stdout = output_file
+        try:
+            call_command(command_name, **options)
+        finally:
+            sys.stdout = stdout
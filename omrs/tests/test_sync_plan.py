@@ -0,0 +1,77 @@
+"""
+Tests that a planned and applied sync_bahmni_db change set gives the same dictionary as a
+direct sync, and that nothing is left to plan afterwards.
+"""
+import os
+import shutil
+import tempfile
+from django.db import connection
+from django.test import TransactionTestCase
+from omrs.models import (Concept, ConceptName, ConceptDescription, ConceptNumeric,
+                         ConceptReferenceTerm, ConceptReferenceMap, ConceptAnswer, ConceptSet)
+from omrs.tests import create_test_dictionary, get_table_counts, run_command
+
+
+class SyncPlanTest(TransactionTestCase):
+    """ Syncs the export of a synthetic dictionary into the same dictionary with its concepts removed """
+
+    NUM_CONCEPTS = 300
+
+    # Tables emptied before each sync; the classes, datatypes, sources and map types are kept
+    CONCEPT_MODELS = (ConceptSet, ConceptAnswer, ConceptReferenceMap, ConceptReferenceTerm,
+                      ConceptNumeric, ConceptDescription, ConceptName, Concept)
+
+    @classmethod
+    def setUpClass(cls):
+        super(SyncPlanTest, cls).setUpClass()
+        create_test_dictionary(cls.NUM_CONCEPTS)
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='omrs_test_')
+        self.concept_filename = self.path('concepts.json')
+        self.mapping_filename = self.path('mappings.json')
+        export_options = {'org_id': 'CIEL', 'source_id': 'CIEL', 'raw': True, 'verbosity': 0}
+        run_command('extract_db_sources', self.concept_filename, concept=True, **export_options)
+        run_command('extract_db_sources', self.mapping_filename, mapping=True, **export_options)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def path(self, filename):
+        return os.path.join(self.work_dir, filename)
+
+    def remove_concepts(self):
+        """ Deletes the concepts and all rows that belong to them """
+        cursor = connection.cursor()
+        for model in self.CONCEPT_MODELS:
+            cursor.execute('DELETE FROM %s' % connection.ops.quote_name(model._meta.db_table))
+
+    def sync(self, **options):
+        """ Runs sync_bahmni_db with the exported concept and mapping files """
+        run_command('sync_bahmni_db', self.path('sync.log'), org_id='CIEL', source_id='CIEL',
+                    concept_filename=self.concept_filename, mapping_filename=self.mapping_filename,
+                    verbosity=0, **options)
+
+    def count_plan_lines(self, plan_filename):
+        with open(plan_filename) as plan_file:
+            return sum(1 for line in plan_file)
+
+    def test_plan_and_apply_matches_direct_sync(self):
+        self.remove_concepts()
+        self.sync()
+        direct_counts = get_table_counts()
+        self.assertEqual(direct_counts['concept'], self.NUM_CONCEPTS)
+
+        self.remove_concepts()
+        plan_filename = self.path('plan.json')
+        self.sync(plan_filename=plan_filename)
+        self.assertGreater(self.count_plan_lines(plan_filename), 0)
+        self.assertEqual(Concept.objects.count(), 0)
+        run_command('sync_bahmni_db', self.path('apply.log'), apply_filename=plan_filename,
+                    verbosity=0)
+        self.assertEqual(get_table_counts(), direct_counts)
+
+        # Everything planned has been applied, so a second plan is empty
+        replan_filename = self.path('replan.json')
+        self.sync(plan_filename=replan_filename)
+        self.assertEqual(self.count_plan_lines(replan_filename), 0)
@@ -3,7 +3,12 @@ from django.conf.urls import patterns, include, url
 from django.contrib import admin
 admin.autodiscover()
 
+from omrs import views
+
 urlpatterns = patterns(
     '',
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^exports/(?P<export_type>concepts|mappings|retired)/$', views.export, name='export'),
+    url(r'^concepts/(?P<concept_id>\d+)/$', views.concept, name='concept'),
+    url(r'^concepts/(?P<concept_id>\d+)/mappings/$', views.concept_mappings, name='concept_mappings'),
 )
@@ -0,0 +1,108 @@
+"""
+HTTP views for on-demand dictionary exports.
+
+The export views stream the same JSON lines as "extract_db --raw" as a chunked response,
+built by the extract_db export generator one concept at a time:
+
+    GET /exports/concepts/?org=CIEL&source=CIEL
+    GET /exports/mappings/?org=CIEL&source=CIEL&since=2016-07-01
+    GET /exports/retired/
+
+Query parameters:
+- org, source: org_id and source_id of the dictionary in OCL (required for concepts and mappings)
+- since: only export concepts created, changed or retired since this date or date and time
+
+Each response has an ETag based on the dictionary stamp (see omrs/exports.py) and the query
+parameters. A request whose If-None-Match header matches the current ETag gets an empty 304
+response without running the export.
+
+The concept lookup views return the export JSON of a single concept (as "extract_db
+--concept_id") or a JSON list of its mappings, with the same org and source parameters:
+
+    GET /concepts/5839/?org=CIEL&source=CIEL
+    GET /concepts/5839/mappings/?org=CIEL&source=CIEL
+
+Lookups are cached in memory in an LRU cache limited to OMRS_CONCEPT_CACHE_BYTES bytes of JSON.
+Every lookup checks the concept's date_changed with one query and rebuilds the cached JSON if
+the concept changed.
+"""
+import hashlib
+import json
+from django.conf import settings
+from django.core.management import CommandError
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified,
+                         StreamingHttpResponse)
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.http import require_GET
+from omrs.cache import LRUCache
+from omrs.exports import get_dictionary_stamp, get_export_command, iterate_export_lines
+from omrs.models import Concept
+
+
+EXPORT_CONTENT_TYPE = 'application/x-ndjson; charset=utf-8'
+
+# Cache of the concept lookup JSON, 32 MB by default
+concept_cache = LRUCache(getattr(settings, 'OMRS_CONCEPT_CACHE_BYTES', 32 * 1024 * 1024))
+
+
+@require_GET
+def export(request, export_type):
+    """ Streams a concept, mapping or retired concept ID export as JSON lines """
+    org_id = request.GET.get('org')
+    source_id = request.GET.get('source')
+    since = request.GET.get('since')
+    try:
+        command = get_export_command(export_type, org_id=org_id, source_id=source_id, since=since)
+    except CommandError as e:
+        return HttpResponseBadRequest(str(e), content_type='text/plain')
+
+    # Unchanged exports are not built again
+    etag = hashlib.sha1(json.dumps(
+        [get_dictionary_stamp(), export_type, org_id, source_id, since])).hexdigest()
+    if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        response = HttpResponseNotModified()
+    else:
+        response = StreamingHttpResponse(iterate_export_lines(command),
+                                         content_type=EXPORT_CONTENT_TYPE)
+    response['ETag'] = quote_etag(etag)
+    return response
+
+
+@require_GET
+def concept(request, concept_id):
+    """ Returns the export JSON of one concept """
+    return lookup_concept(request, int(concept_id), 'concepts')
+
+
+@require_GET
+def concept_mappings(request, concept_id):
+    """ Returns the export JSON of the mappings of one concept, as a list """
+    return lookup_concept(request, int(concept_id), 'mappings')
+
+
+def lookup_concept(request, concept_id, export_type):
+    """
+    Returns the cached export JSON of a concept or its mappings, building it with the
+    extract_db export methods if it is not cached or the concept changed since.
+    """
+    org_id = request.GET.get('org')
+    source_id = request.GET.get('source')
+    date_changed = list(Concept.objects.filter(concept_id=concept_id).values_list('date_changed', flat=True))
+    if not date_changed:
+        raise Http404('Concept %s does not exist' % concept_id)
+
+    key = (export_type, concept_id, org_id, source_id)
+    body = concept_cache.get(key, version=date_changed[0])
+    if body is None:
+        try:
+            command = get_export_command(export_type, org_id=org_id, source_id=source_id)
+        except CommandError as e:
+            return HttpResponseBadRequest(str(e), content_type='text/plain')
+        concept = Concept.objects.get(concept_id=concept_id)
+        if export_type == 'concepts':
+            body = json.dumps(command.export_concept(concept))
+        else:
+            body = json.dumps(command.export_all_mappings_for_concept(concept) or [])
+        concept_cache.set(key, body, version=date_changed[0])
+    return HttpResponse(body, content_type='application/json')